@@ -3,12 +3,8 @@ OTA Client tự động - Tự động kiểm tra và cập nhật firmware
 Không cần khách tải, tự động chạy ở background
 """
 import time
+import random
 import threading
-try:
-    import schedule
-except ImportError:
-    print("Warning: schedule not installed. Install with: pip install schedule")
-    schedule = None
 from ota_client import OTAClient
 from typing import Optional, Callable
 import logging
@@ -19,7 +15,8 @@ logger = logging.getLogger(__name__)
 class AutoOTAClient:
     """
     OTA Client tự động
-    Tự động kiểm tra và cập nhật firmware định kỳ
+    Tự động kiểm tra và cập nhật firmware định kỳ, theo lịch server gợi ý
+    (next_check_after) để các thiết bị không gọi server cùng lúc
     """
     
     def __init__(
@@ -28,7 +25,9 @@ class AutoOTAClient:
         device_id: str,
         device_token: Optional[str] = None,
         check_interval_minutes: int = 60,
-        auto_install: bool = True
+        auto_install: bool = True,
+        push: bool = False,
+        channel: str = "stable"
     ):
         """
         Khởi tạo Auto OTA Client
@@ -37,23 +36,33 @@ class AutoOTAClient:
             server_url: URL của OTA server
             device_id: ID của thiết bị
             device_token: Device token (nếu server yêu cầu auth)
-            check_interval_minutes: Khoảng thời gian kiểm tra (phút)
+            check_interval_minutes: Khoảng thời gian kiểm tra (phút) khi server
+                                    không gửi next_check_after
             auto_install: Tự động cài đặt firmware mới
+            push: Nhận thông báo firmware mới qua /api/updates/stream (SSE);
+                  polling theo check_interval chỉ chạy khi stream mất kết nối
+            channel: Channel firmware mà thiết bị theo dõi (dùng để lọc thông báo)
         """
         self.server_url = server_url
         self.device_id = device_id
         self.device_token = device_token
         self.check_interval = check_interval_minutes
         self.auto_install = auto_install
+        self.push = push
+        self.channel = channel
         self.current_version = "0.0.0"
         self.is_running = False
         self.thread = None
+        self.push_thread = None
+        self.stream_connected = False
+        self._stop_event = threading.Event()
+        self._update_lock = threading.Lock()
         
         # Tạo OTA client
         self.client = OTAClient(server_url, device_id)
         if device_token:
             # Thêm token vào headers nếu cần
-            self.client.token = device_token
+            self.client.device_token = device_token
     
     def set_current_version(self, version: str):
         """Thiết lập phiên bản hiện tại"""
@@ -61,6 +70,10 @@ class AutoOTAClient:
         self.client.set_current_version(version)
         logger.info(f"Current version set to: {version}")
     
+    def set_current_image(self, file_path):
+        """Thiết lập file ảnh firmware đang chạy (dùng cho delta update)"""
+        self.client.set_current_image(file_path)
+    
     def set_install_callback(self, callback: Callable):
         """Thiết lập hàm cài đặt firmware"""
         self.install_callback = callback
@@ -90,24 +103,28 @@ class AutoOTAClient:
                 logger.info("Auto-install disabled. Update available but not installing.")
                 return True
             
-            # Tải và cài đặt
-            logger.info("Downloading firmware...")
-            file_path = self.client.download_firmware(
-                latest_version,
-                self.progress_callback if hasattr(self, 'progress_callback') else None
-            )
-            
-            if not file_path:
-                logger.error("Failed to download firmware")
-                return False
+            progress_callback = self.progress_callback if hasattr(self, 'progress_callback') else None
             
-            # Xác minh checksum
-            expected_checksum = firmware_info.get("checksum")
-            if expected_checksum:
-                if not self.client.verify_checksum(file_path, expected_checksum):
-                    logger.error("Checksum verification failed!")
+            # Thử cập nhật bằng patch trước (ảnh dựng lại đã được xác minh checksum)
+            file_path = self.client.apply_delta_update(firmware_info, progress_callback)
+            if file_path:
+                logger.info("Firmware rebuilt from delta patch")
+            else:
+                # Tải và cài đặt
+                logger.info("Downloading firmware...")
+                file_path = self.client.download_firmware(latest_version, progress_callback)
+                
+                if not file_path:
+                    logger.error("Failed to download firmware")
                     return False
-                logger.info("Checksum verified")
+                
+                # Xác minh checksum
+                expected_checksum = firmware_info.get("checksum")
+                if expected_checksum:
+                    if not self.client.verify_checksum(file_path, expected_checksum):
+                        logger.error("Checksum verification failed!")
+                        return False
+                    logger.info("Checksum verified")
             
             # Cài đặt
             if hasattr(self, 'install_callback'):
@@ -117,6 +134,7 @@ class AutoOTAClient:
                     logger.info(f"Firmware installed successfully! New version: {latest_version}")
                     self.current_version = latest_version
                     self.client.set_current_version(latest_version)
+                    self.client.set_current_image(file_path)
                     return True
                 except Exception as e:
                     logger.error(f"Installation failed: {e}")
@@ -129,6 +147,77 @@ class AutoOTAClient:
             logger.error(f"Error during update check: {e}")
             return False
     
+    def _locked_check(self):
+        """Chạy check_and_update, bỏ qua nếu một lần cập nhật khác đang chạy"""
+        if not self._update_lock.acquire(blocking=False):
+            return False
+        try:
+            return self.check_and_update()
+        finally:
+            self._update_lock.release()
+    
+    def _next_delay(self) -> float:
+        """Số giây đến lần polling tiếp theo: theo gợi ý của server, không có thì check_interval ± 10%"""
+        hint, self.client.next_check_after = self.client.next_check_after, None
+        if hint:
+            return hint
+        return self.check_interval * 60 * random.uniform(0.9, 1.1)
+    
+    def _scheduled_check(self):
+        """Polling định kỳ; ở push mode chỉ chạy khi stream đang mất kết nối"""
+        if self.push and self.stream_connected:
+            return
+        self._locked_check()
+    
+    @staticmethod
+    def _version_key(version: str) -> tuple:
+        parts = [int(x) for x in version.split('.')]
+        while len(parts) > 1 and parts[-1] == 0:
+            parts.pop()
+        return tuple(parts)
+    
+    def _is_newer(self, version: str) -> bool:
+        try:
+            return self._version_key(version) > self._version_key(self.current_version)
+        except ValueError:
+            # Không so sánh được thì để server quyết định
+            return True
+    
+    def _handle_event(self, event: dict):
+        """Sự kiện từ stream: chỉ check-update khi channel của thiết bị có version mới"""
+        latest = event.get("channels", {}).get(self.channel)
+        if not latest or not self._is_newer(latest):
+            return
+        # Rải lần check trong [0, spread] giây để cả fleet không gọi server cùng lúc
+        delay = random.uniform(0, event.get("spread", 0))
+        logger.info(f"New firmware announced: {latest} (checking in {delay:.1f}s)")
+        if self._stop_event.wait(delay):
+            return
+        self._locked_check()
+    
+    def _run_push(self):
+        """Giữ kết nối SSE, tự kết nối lại với backoff + jitter khi bị ngắt"""
+        last_event_id = None
+        backoff = 1
+        while self.is_running:
+            try:
+                for event in self.client.stream_updates(last_event_id):
+                    if not self.stream_connected:
+                        logger.info("Update stream connected")
+                        self.stream_connected = True
+                    backoff = 1
+                    last_event_id = event.get("id")
+                    self._handle_event(event)
+                    if not self.is_running:
+                        break
+            except Exception as e:
+                if self.is_running:
+                    logger.warning(f"Update stream dropped, falling back to polling: {e}")
+            self.stream_connected = False
+            if self._stop_event.wait(backoff * random.uniform(0.5, 1.5)):
+                break
+            backoff = min(backoff * 2, 300)
+    
     def start(self):
         """Bắt đầu tự động kiểm tra"""
         if self.is_running:
@@ -140,22 +229,22 @@ class AutoOTAClient:
         logger.info(f"  Device ID: {self.device_id}")
         logger.info(f"  Check interval: {self.check_interval} minutes")
         logger.info(f"  Auto install: {self.auto_install}")
+        logger.info(f"  Push mode: {self.push}")
         
         self.is_running = True
-        
-        # Lên lịch kiểm tra định kỳ
-        if schedule:
-            schedule.every(self.check_interval).minutes.do(self.check_and_update)
+        self._stop_event.clear()
         
         # Chạy ngay lập tức
-        self.check_and_update()
+        self._locked_check()
+        
+        if self.push:
+            self.push_thread = threading.Thread(target=self._run_push, daemon=True)
+            self.push_thread.start()
         
-        # Chạy scheduler trong thread riêng
+        # Chạy scheduler trong thread riêng, mỗi lần chờ theo next_check_after mới nhất
         def run_scheduler():
-            while self.is_running:
-                if schedule:
-                    schedule.run_pending()
-                time.sleep(1)
+            while not self._stop_event.wait(self._next_delay()):
+                self._scheduled_check()
         
         self.thread = threading.Thread(target=run_scheduler, daemon=True)
         self.thread.start()
@@ -169,18 +258,19 @@ class AutoOTAClient:
         
         logger.info("Stopping Auto OTA Client...")
         self.is_running = False
-        if schedule:
-            schedule.clear()
+        self._stop_event.set()
         
         if self.thread:
             self.thread.join(timeout=5)
+        if self.push_thread:
+            self.push_thread.join(timeout=5)
         
         logger.info("Auto OTA Client stopped")
     
     def force_check(self):
         """Kiểm tra ngay lập tức (không đợi lịch)"""
         logger.info("Force checking for updates...")
-        return self.check_and_update()
+        return self._locked_check()
 
 
 # Ví dụ sử dụng
@@ -196,7 +286,8 @@ if __name__ == "__main__":
         device_id=DEVICE_ID,
         device_token=DEVICE_TOKEN,
         check_interval_minutes=60,  # Kiểm tra mỗi 60 phút
-        auto_install=True
+        auto_install=True,
+        push=True  # Nhận thông báo ngay khi có firmware mới
     )
     
     # Thiết lập phiên bản hiện tại
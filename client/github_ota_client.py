@@ -8,6 +8,12 @@ from pathlib import Path
 from typing import Optional, Callable, Dict
 import re
 
+try:
+    # Các Content-Encoding mà urllib3 tự giải nén được (gzip, deflate, + br/zstd nếu có thư viện)
+    from urllib3.util.request import ACCEPT_ENCODING
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+
 class GitHubOTAClient:
     """Client để tải firmware từ GitHub Releases"""
     
@@ -194,10 +200,16 @@ class GitHubOTAClient:
             print(f"Đang tải firmware từ GitHub...")
             print(f"  URL: {download_url}")
             
-            response = requests.get(download_url, stream=True, timeout=30)
+            # Chấp nhận bản nén, requests giải nén trong lúc stream
+            headers = {"Accept-Encoding": ACCEPT_ENCODING}
+            response = requests.get(download_url, stream=True, headers=headers, timeout=30)
             response.raise_for_status()
             
-            total_size = int(response.headers.get('content-length', 0))
+            # Content-Length của bản nén không phải kích thước firmware
+            if response.headers.get('content-encoding'):
+                total_size = int(response.headers.get('x-firmware-size', 0))
+            else:
+                total_size = int(response.headers.get('content-length', 0))
             downloaded = 0
             
             with open(file_path, 'wb') as f:
@@ -6,8 +6,64 @@ import requests
 import hashlib
 import os
 from pathlib import Path
-from typing import Optional, Dict, Callable
+from typing import Optional, Dict, Callable, Iterable, List
 import json
+import random
+import struct
+import time
+import zlib
+from email.utils import parsedate_to_datetime
+
+try:
+    # Các Content-Encoding mà urllib3 tự giải nén được (gzip, deflate, + br/zstd nếu có thư viện)
+    from urllib3.util.request import ACCEPT_ENCODING
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+
+# Định dạng patch, khớp với server/delta.py
+PATCH_MAGIC = b"OTAPATCH1"
+
+def apply_patch(base: bytes, patch: bytes) -> bytes:
+    """Dựng lại ảnh firmware mới từ ảnh hiện tại và patch"""
+    if not patch.startswith(PATCH_MAGIC):
+        raise ValueError("Patch không hợp lệ")
+    ops = zlib.decompress(patch[len(PATCH_MAGIC):])
+    out = bytearray()
+    pos = 0
+    while pos < len(ops):
+        op = ops[pos:pos + 1]
+        if op == b"C":
+            offset, length = struct.unpack_from(">QI", ops, pos + 1)
+            out += base[offset:offset + length]
+            pos += 13
+        elif op == b"I":
+            (length,) = struct.unpack_from(">I", ops, pos + 1)
+            out += ops[pos + 5:pos + 5 + length]
+            pos += 5 + length
+        else:
+            raise ValueError("Patch không hợp lệ")
+    return bytes(out)
+
+def retry_after_seconds(value: Optional[str], attempt: int, max_delay: float = 600) -> float:
+    """
+    Thời gian chờ trước khi thử lại sau 503/429
+
+    Dùng Retry-After của server (số giây hoặc HTTP-date), không có thì lùi theo
+    cấp số nhân. Nhân thêm jitter ngẫu nhiên để các thiết bị không quay lại cùng lúc.
+    """
+    delay = None
+    if value:
+        value = value.strip()
+        if value.isdigit():
+            delay = float(value)
+        else:
+            try:
+                delay = parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError):
+                delay = None
+    if delay is None or delay < 0:
+        delay = min(2 ** attempt, max_delay)
+    return min(delay * random.uniform(1.0, 1.5), max_delay)
 
 class OTAClient:
     """Client để tương tác với OTA Server"""
@@ -28,8 +84,17 @@ class OTAClient:
         self.api_key = api_key
         self.device_token = device_token
         self.current_version = "0.0.0"
+        # Ảnh firmware đang chạy, dùng làm gốc cho delta update
+        self.current_image_path = None
         self.download_dir = Path("downloads")
         self.download_dir.mkdir(exist_ok=True)
+        # Số lần thử lại khi server trả 503/429 (quá tải) lúc tải firmware
+        self.max_retries = 5
+        # Gợi ý của server: số giây nên chờ trước lần check-update tiếp theo
+        self.next_check_after = None
+        # ETag và kết quả check-update gần nhất (server trả 304 khi không đổi)
+        self._check_etag = None
+        self._check_result = None
     
     def get_headers(self):
         """Lấy headers với authentication"""
@@ -40,6 +105,19 @@ class OTAClient:
             headers["Authorization"] = f"Bearer {self.device_token}"
         return headers
     
+    def _get_with_retry(self, url: str, headers: Dict, **kwargs) -> requests.Response:
+        """GET, chờ theo Retry-After rồi thử lại khi server đang quá tải (503/429)"""
+        attempt = 0
+        while True:
+            response = requests.get(url, headers=headers, **kwargs)
+            if response.status_code not in (429, 503) or attempt >= self.max_retries:
+                return response
+            delay = retry_after_seconds(response.headers.get("retry-after"), attempt)
+            response.close()
+            print(f"Server đang bận, thử lại sau {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+    
     def set_current_version(self, version: str):
         """Thiết lập phiên bản hiện tại của thiết bị"""
         self.current_version = version
@@ -48,9 +126,17 @@ class OTAClient:
         """Lấy phiên bản hiện tại"""
         return self.current_version
     
+    def set_current_image(self, file_path):
+        """
+        Thiết lập file ảnh firmware đang chạy trên thiết bị
+        Khi có, client sẽ tải patch thay vì cả ảnh nếu server hỗ trợ
+        """
+        self.current_image_path = Path(file_path) if file_path else None
+    
     def check_update(self) -> Dict:
         """
         Kiểm tra có firmware mới không
+        Gửi kèm ETag của lần trước; kết quả không đổi thì dùng lại kết quả đã lưu (304)
         
         Returns:
             Dict chứa thông tin update hoặc None nếu không có update
@@ -63,10 +149,26 @@ class OTAClient:
             }
             
             headers = self.get_headers()
-            response = requests.post(url, json=payload, headers=headers, timeout=10)
+            # GET có điều kiện: kết quả không đổi thì server chỉ trả 304 không có body
+            if self._check_etag:
+                headers["If-None-Match"] = self._check_etag
+            params = {k: v for k, v in payload.items() if v is not None}
+            response = requests.get(url, params=params, headers=headers, timeout=10)
+            if response.status_code == 405:
+                # Server cũ chưa có GET /api/check-update
+                response = requests.post(url, json=payload, headers=self.get_headers(), timeout=10)
             response.raise_for_status()
             
-            return response.json()
+            self._save_poll_hint(response)
+            if response.status_code == 304 and self._check_result is not None:
+                result = dict(self._check_result)
+            else:
+                result = response.json()
+                self._check_etag = response.headers.get("etag")
+                self._check_result = result
+            if self.next_check_after is not None:
+                result["next_check_after"] = self.next_check_after
+            return result
         except requests.exceptions.RequestException as e:
             print(f"Lỗi khi kiểm tra update: {e}")
             return {
@@ -74,9 +176,95 @@ class OTAClient:
                 "error": str(e)
             }
     
+    def _save_poll_hint(self, response: requests.Response):
+        """Lưu next_check_after từ header X-Next-Check-After (nếu server có gửi)"""
+        try:
+            self.next_check_after = int(response.headers["x-next-check-after"])
+        except (KeyError, ValueError):
+            self.next_check_after = None
+    
+    def check_updates_many(self, devices: Iterable[Dict], stream: bool = False,
+                           timeout: int = 60) -> Optional[List[Dict]]:
+        """
+        Kiểm tra update cho nhiều device trong một request (dùng cho gateway)
+        
+        Args:
+            devices: Danh sách dict {"device_id", "current_version", "device_type", "channel"}
+            stream: Yêu cầu server trả về NDJSON (đọc kết quả theo từng dòng)
+            timeout: Timeout (giây)
+        
+        Returns:
+            Danh sách kết quả theo thứ tự đầu vào (mỗi kết quả có device_id), None nếu lỗi
+        """
+        try:
+            url = f"{self.server_url}/api/check-update/batch"
+            headers = self.get_headers()
+            if stream:
+                headers["Accept"] = "application/x-ndjson"
+            payload = [
+                {k: v for k, v in device.items() if v is not None}
+                for device in devices
+            ]
+            with requests.post(url, json=payload, headers=headers, stream=True, timeout=timeout) as response:
+                response.raise_for_status()
+                self._save_poll_hint(response)
+                # Lô lớn luôn được server trả về dạng NDJSON
+                if "ndjson" in response.headers.get("content-type", ""):
+                    return [json.loads(line) for line in response.iter_lines() if line]
+                return response.json()["results"]
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Lỗi khi kiểm tra update hàng loạt: {e}")
+            return None
+    
+    def stream_updates(self, last_event_id: Optional[str] = None, read_timeout: float = 90):
+        """
+        Kết nối /api/updates/stream (Server-Sent Events) và trả về từng sự kiện
+        
+        Generator chạy đến khi kết nối bị ngắt (raise RequestException).
+        read_timeout nên lớn hơn chu kỳ keepalive của server (mặc định 25 giây).
+        
+        Yields:
+            Dict sự kiện: id, channels ({channel: version mới nhất}), spread
+        """
+        url = f"{self.server_url}/api/updates/stream"
+        headers = self.get_headers()
+        headers["Accept"] = "text/event-stream"
+        if last_event_id:
+            headers["Last-Event-ID"] = last_event_id
+        with requests.get(url, headers=headers, stream=True, timeout=(10, read_timeout)) as response:
+            response.raise_for_status()
+            data = []
+            for line in response.iter_lines(decode_unicode=True):
+                if line is None:
+                    continue
+                if line == "":
+                    # Dòng trống kết thúc một sự kiện
+                    if data:
+                        yield json.loads("\n".join(data))
+                        data = []
+                elif line.startswith("data:"):
+                    data.append(line[5:].lstrip())
+    
+    def wait_for_update(self, last_event_id: Optional[str] = None, timeout: float = 30) -> Optional[Dict]:
+        """
+        Long-poll /api/updates/poll (dùng khi proxy không hỗ trợ SSE)
+        
+        Returns:
+            Sự kiện mới (khác last_event_id), hoặc None nếu hết timeout
+        """
+        url = f"{self.server_url}/api/updates/poll"
+        params = {"timeout": timeout}
+        if last_event_id:
+            params["last_event_id"] = last_event_id
+        response = requests.get(url, params=params, headers=self.get_headers(), timeout=timeout + 10)
+        response.raise_for_status()
+        if response.status_code == 204:
+            return None
+        return response.json()
+    
     def download_firmware(self, version: str, progress_callback: Optional[Callable] = None) -> Optional[Path]:
         """
-        Tải firmware về
+        Tải firmware về (tự tải tiếp phần còn thiếu nếu lần trước bị ngắt)
         
         Args:
             version: Phiên bản firmware cần tải
@@ -85,10 +273,27 @@ class OTAClient:
         Returns:
             Path đến file đã tải về hoặc None nếu lỗi
         """
+        # File tải dở được giữ lại để tải tiếp bằng Range/If-Range
+        part_path = self.download_dir / f"firmware_{version}.part"
+        etag_path = self.download_dir / f"firmware_{version}.etag"
         try:
             url = f"{self.server_url}/api/download/{version}"
             headers = self.get_headers()
-            response = requests.get(url, stream=True, headers=headers, timeout=30)
+            # Server gửi bản nén sẵn nếu có, requests giải nén trong lúc stream
+            headers["Accept-Encoding"] = ACCEPT_ENCODING
+            resume_from = 0
+            if part_path.exists() and etag_path.exists():
+                resume_from = part_path.stat().st_size
+                headers["Range"] = f"bytes={resume_from}-"
+                headers["If-Range"] = etag_path.read_text().strip()
+                # Range tính theo bytes của bản gốc (file .part đã giải nén)
+                headers["Accept-Encoding"] = "identity"
+            response = self._get_with_retry(url, headers, stream=True, timeout=30)
+            if response.status_code == 416:
+                # Phần đã tải không còn hợp lệ: tải lại từ đầu
+                part_path.unlink(missing_ok=True)
+                etag_path.unlink(missing_ok=True)
+                return self.download_firmware(version, progress_callback)
             response.raise_for_status()
             
             # Lấy tên file từ header hoặc URL
@@ -100,11 +305,26 @@ class OTAClient:
             
             file_path = self.download_dir / filename
             
-            # Tải file với progress tracking
-            total_size = int(response.headers.get('content-length', 0))
-            downloaded = 0
+            # 206: nối tiếp vào file tải dở, 200: tải lại từ đầu
+            if response.status_code == 206:
+                mode = 'ab'
+                downloaded = resume_from
+            else:
+                mode = 'wb'
+                downloaded = 0
+            # Lưu ETag của bản gốc (không phải "<checksum>-gzip") để lần sau tải tiếp được
+            checksum = response.headers.get('x-firmware-checksum')
+            etag = f'"{checksum}"' if checksum else response.headers.get('etag')
+            if etag:
+                etag_path.write_text(etag)
             
-            with open(file_path, 'wb') as f:
+            # Tải file với progress tracking (tính theo bytes đã giải nén)
+            if response.headers.get('content-encoding'):
+                total_size = int(response.headers.get('x-firmware-size', 0))
+            else:
+                total_size = downloaded + int(response.headers.get('content-length', 0))
+            
+            with open(part_path, mode) as f:
                 for chunk in response.iter_content(chunk_size=8192):
                     if chunk:
                         f.write(chunk)
@@ -112,12 +332,69 @@ class OTAClient:
                         if progress_callback:
                             progress_callback(downloaded, total_size)
             
+            os.replace(part_path, file_path)
+            etag_path.unlink(missing_ok=True)
             return file_path
             
         except requests.exceptions.RequestException as e:
             print(f"Lỗi khi tải firmware: {e}")
             return None
     
+    def apply_delta_update(self, firmware_info: Dict,
+                           progress_callback: Optional[Callable] = None) -> Optional[Path]:
+        """
+        Cập nhật bằng patch: tải patch, dựng lại ảnh mới từ ảnh hiện tại và xác minh
+        
+        Args:
+            firmware_info: firmware_info từ check_update (có field "patch")
+            progress_callback: Hàm callback hiển thị tiến trình tải patch
+        
+        Returns:
+            Path đến ảnh mới đã xác minh checksum, hoặc None (cần tải cả ảnh)
+        """
+        patch = firmware_info.get("patch")
+        if not patch or not self.current_image_path or not self.current_image_path.exists():
+            return None
+        
+        try:
+            base = self.current_image_path.read_bytes()
+            if hashlib.sha256(base).hexdigest() != patch["base_checksum"].lower():
+                print("Ảnh hiện tại không khớp base của patch, tải cả ảnh")
+                return None
+            
+            url = f"{self.server_url}{patch['download_url']}"
+            response = self._get_with_retry(url, self.get_headers(), stream=True, timeout=30)
+            response.raise_for_status()
+            
+            chunks = []
+            downloaded = 0
+            for chunk in response.iter_content(chunk_size=8192):
+                if chunk:
+                    chunks.append(chunk)
+                    downloaded += len(chunk)
+                    if progress_callback:
+                        progress_callback(downloaded, patch["size"])
+            patch_data = b"".join(chunks)
+            
+            if hashlib.sha256(patch_data).hexdigest() != patch["checksum"].lower():
+                print("Checksum patch không khớp, tải cả ảnh")
+                return None
+            
+            image = apply_patch(base, patch_data)
+            if hashlib.sha256(image).hexdigest() != firmware_info["checksum"].lower():
+                print("Ảnh dựng từ patch không khớp checksum, tải cả ảnh")
+                return None
+            
+            file_path = self.download_dir / f"firmware_{firmware_info['version']}.bin"
+            tmp_path = file_path.with_suffix(".tmp")
+            tmp_path.write_bytes(image)
+            os.replace(tmp_path, file_path)
+            print(f"Đã cập nhật bằng patch: {len(patch_data):,} bytes thay vì {len(image):,} bytes")
+            return file_path
+        except (requests.exceptions.RequestException, ValueError, zlib.error, KeyError) as e:
+            print(f"Lỗi khi cập nhật bằng patch: {e}")
+            return None
+    
     def verify_checksum(self, file_path: Path, expected_checksum: str) -> bool:
         """
         Xác minh checksum của file firmware
@@ -173,29 +450,33 @@ class OTAClient:
         print(f"Tìm thấy firmware mới: {latest_version}")
         print(f"Mô tả: {firmware_info.get('description', 'N/A')}")
         
-        # Tải firmware
-        print(f"Đang tải firmware {latest_version}...")
-        file_path = self.download_firmware(latest_version, progress_callback)
+        # Thử cập nhật bằng patch trước (ảnh mới đã được xác minh checksum)
+        file_path = self.apply_delta_update(firmware_info, progress_callback)
         
         if not file_path:
-            return {
-                "success": False,
-                "message": "Lỗi khi tải firmware"
-            }
-        
-        print(f"Đã tải firmware: {file_path}")
-        
-        # Xác minh checksum
-        print("Đang xác minh checksum...")
-        if not self.verify_checksum(file_path, checksum):
-            print("Lỗi: Checksum không khớp! File có thể bị hỏng.")
-            file_path.unlink()  # Xóa file không hợp lệ
-            return {
-                "success": False,
-                "message": "Checksum không khớp"
-            }
-        
-        print("Checksum hợp lệ!")
+            # Tải firmware
+            print(f"Đang tải firmware {latest_version}...")
+            file_path = self.download_firmware(latest_version, progress_callback)
+            
+            if not file_path:
+                return {
+                    "success": False,
+                    "message": "Lỗi khi tải firmware"
+                }
+            
+            print(f"Đã tải firmware: {file_path}")
+            
+            # Xác minh checksum
+            print("Đang xác minh checksum...")
+            if not self.verify_checksum(file_path, checksum):
+                print("Lỗi: Checksum không khớp! File có thể bị hỏng.")
+                file_path.unlink()  # Xóa file không hợp lệ
+                return {
+                    "success": False,
+                    "message": "Checksum không khớp"
+                }
+            
+            print("Checksum hợp lệ!")
         
         # Cài đặt firmware
         if install_callback:
@@ -206,6 +487,7 @@ class OTAClient:
                 
                 # Cập nhật phiên bản hiện tại
                 self.current_version = latest_version
+                self.current_image_path = file_path
                 
                 return {
                     "success": True,
@@ -244,14 +526,24 @@ class OTAClient:
             print(f"Lỗi khi lấy danh sách firmware: {e}")
             return {"firmwares": [], "error": str(e)}
     
-    def register_device(self, device_name: Optional[str] = None, device_type: Optional[str] = None) -> Optional[str]:
+    def register_device(self, device_name: Optional[str] = None, device_type: Optional[str] = None,
+                        devices: Optional[Iterable] = None):
         """
         Đăng ký device và nhận token
         Yêu cầu API key
         
+        Args:
+            device_name: Tên device
+            device_type: Loại device
+            devices: Chế độ hàng loạt cho gateway, danh sách device_id hoặc dict
+                     {"device_id", "device_name", "device_type"} (xem register_devices)
+        
         Returns:
-            Device token hoặc None nếu lỗi
+            Device token hoặc None nếu lỗi; với devices: dict {device_id: token}
         """
+        if devices is not None:
+            return self.register_devices(devices)
+        
         if not self.api_key:
             print("Lỗi: Cần API key để đăng ký device")
             return None
@@ -275,6 +567,53 @@ class OTAClient:
         except requests.exceptions.RequestException as e:
             print(f"Lỗi khi đăng ký device: {e}")
             return None
+    
+    def register_devices(self, devices: Iterable, timeout: int = 300) -> Optional[Dict[str, str]]:
+        """
+        Đăng ký nhiều device trong một request (/api/auth/register/bulk)
+        Danh sách được gửi dạng NDJSON theo kiểu streaming, kết quả đọc theo từng dòng
+        
+        Args:
+            devices: device_id hoặc dict {"device_id", "device_name", "device_type"}
+            timeout: Timeout (giây)
+        
+        Returns:
+            Dict {device_id: token} cho các device đăng ký thành công, None nếu lỗi
+        """
+        if not self.api_key:
+            print("Lỗi: Cần API key để đăng ký device")
+            return None
+        
+        def body():
+            for device in devices:
+                if isinstance(device, str):
+                    device = {"device_id": device}
+                yield (json.dumps(device) + "\n").encode()
+        
+        try:
+            url = f"{self.server_url}/api/auth/register/bulk"
+            headers = {
+                "X-API-Key": self.api_key,
+                "Content-Type": "application/x-ndjson"
+            }
+            tokens = {}
+            failed = 0
+            with requests.post(url, data=body(), headers=headers, stream=True, timeout=timeout) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    item = json.loads(line)
+                    if "token" in item:
+                        tokens[item["device_id"]] = item["token"]
+                    else:
+                        failed += 1
+                        print(f"Không đăng ký được {item.get('device_id', '#' + str(item.get('index')))}: {item.get('error')}")
+            print(f"Đã đăng ký {len(tokens)} device" + (f", {failed} lỗi" if failed else ""))
+            return tokens
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Lỗi khi đăng ký device: {e}")
+            return None
 
 
 # Ví dụ sử dụng
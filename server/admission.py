@@ -0,0 +1,186 @@
+"""
+Kiểm soát tải firmware: giới hạn số download đồng thời, tần suất theo device
+và tổng băng thông gửi đi (token bucket)
+
+Chạy trên event loop (endpoint async) nên không cần lock. Giới hạn tính theo
+từng worker process.
+"""
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from typing import Optional
+
+from fastapi.responses import JSONResponse, Response
+
+
+class TokenBucket:
+    """Token bucket: rate token mỗi giây, tối đa burst token"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, amount: float = 1) -> float:
+        """Lấy token nếu đủ và trả về 0, không đủ thì trả về số giây cần chờ (không lấy)"""
+        self._refill()
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def reserve(self, amount: float) -> float:
+        """
+        Lấy token kể cả khi chưa đủ (số dư âm), trả về số giây phải chờ trước khi dùng
+        Nhiều stream cùng reserve sẽ xếp hàng lần lượt, tổng tốc độ không vượt rate
+        """
+        self._refill()
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class AdmittedResponse(Response):
+    """Bọc response tải firmware, trả slot download khi gửi xong hoặc client ngắt"""
+
+    def __init__(self, response: Response, release):
+        self.response = response
+        self.release = release
+        self.status_code = response.status_code
+        self.raw_headers = response.raw_headers
+        self.background = None
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await self.response(scope, receive, send)
+        finally:
+            self.release()
+        if self.background is not None:
+            await self.background()
+
+
+class DownloadLimiter:
+    """
+    Admission control cho /api/download và /api/patch
+
+    - max_concurrent: số download đang gửi tối đa (0 = không giới hạn)
+    - device_rate: số download mỗi phút của một device/IP (0 = không giới hạn)
+    - egress_rate: tổng bytes/giây gửi đi của mọi download (0 = không giới hạn)
+
+    Request bị từ chối nhận 503 với Retry-After ước lượng từ thời gian tải
+    trung bình và số request đang phải chờ (bị từ chối gần đây).
+    """
+
+    MAX_RETRY_AFTER = 600
+
+    def __init__(self, max_concurrent: int, device_rate: float, egress_rate: float,
+                 chunk_size: int, max_devices: int = 100000):
+        self.max_concurrent = max_concurrent
+        self.device_rate = device_rate
+        self.max_devices = max_devices
+        # Burst ít nhất một chunk để stream không bị kẹt
+        self.egress = TokenBucket(egress_rate, max(egress_rate, chunk_size)) if egress_rate > 0 else None
+        self._devices = OrderedDict()
+        self._recent_rejects = deque()
+        self.avg_duration = 5.0
+        self.active = 0
+        self.admitted = 0
+        self.rejected_busy = 0
+        self.rejected_rate = 0
+        self.throttled_seconds = 0.0
+
+    def _queue_depth(self) -> int:
+        """Số request bị từ chối trong khoảng một lần tải trung bình (sẽ quay lại)"""
+        horizon = time.monotonic() - max(self.avg_duration, 1.0)
+        while self._recent_rejects and self._recent_rejects[0] < horizon:
+            self._recent_rejects.popleft()
+        return len(self._recent_rejects)
+
+    def retry_after(self) -> int:
+        """Số giây client nên chờ: lâu hơn khi nhiều request đang xếp hàng"""
+        slots = max(self.max_concurrent, 1)
+        seconds = self.avg_duration * (1 + self._queue_depth() / slots)
+        return min(max(math.ceil(seconds), 1), self.MAX_RETRY_AFTER)
+
+    def _device_wait(self, key: Optional[str]) -> float:
+        if self.device_rate <= 0 or not key:
+            return 0.0
+        bucket = self._devices.get(key)
+        if bucket is None:
+            # Cho phép tải liền device_rate lần, sau đó hồi dần theo phút
+            bucket = TokenBucket(self.device_rate / 60, max(1.0, self.device_rate))
+            self._devices[key] = bucket
+            if len(self._devices) > self.max_devices:
+                self._devices.popitem(last=False)
+        else:
+            self._devices.move_to_end(key)
+        return bucket.try_take(1)
+
+    def admit(self, key: Optional[str]) -> Optional[Response]:
+        """
+        Xin slot download cho client key (device_id hoặc IP)
+
+        Returns:
+            None nếu được nhận (phải gọi release() khi xong), hoặc response 503
+        """
+        if self.max_concurrent and self.active >= self.max_concurrent:
+            self.rejected_busy += 1
+            retry_after = self.retry_after()
+            self._recent_rejects.append(time.monotonic())
+            return self._busy(retry_after, "Server đang có quá nhiều lượt tải, vui lòng thử lại sau")
+        wait = self._device_wait(key)
+        if wait > 0:
+            self.rejected_rate += 1
+            return self._busy(math.ceil(wait), "Thiết bị tải quá thường xuyên, vui lòng thử lại sau")
+        self.active += 1
+        self.admitted += 1
+        return None
+
+    @staticmethod
+    def _busy(retry_after: int, detail: str) -> Response:
+        return JSONResponse(
+            status_code=503,
+            content={"detail": detail},
+            headers={"Retry-After": str(retry_after)}
+        )
+
+    def release_callback(self):
+        """Hàm trả slot, cập nhật thời gian tải trung bình (EMA)"""
+        started = time.monotonic()
+
+        def release():
+            self.active -= 1
+            duration = time.monotonic() - started
+            self.avg_duration = 0.8 * self.avg_duration + 0.2 * duration
+
+        return release
+
+    async def throttle(self, size: int):
+        """Chờ đủ "token" băng thông trước khi gửi size bytes"""
+        delay = self.egress.reserve(size)
+        if delay > 0:
+            self.throttled_seconds += delay
+            await asyncio.sleep(delay)
+
+    @property
+    def shaping(self) -> bool:
+        return self.egress is not None
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "max_concurrent": self.max_concurrent,
+            "admitted": self.admitted,
+            "rejected_busy": self.rejected_busy,
+            "rejected_rate": self.rejected_rate,
+            "queue_depth": self._queue_depth(),
+            "avg_duration": round(self.avg_duration, 3),
+            "egress_bytes_per_sec": self.egress.rate if self.egress else 0,
+            "throttled_seconds": round(self.throttled_seconds, 3),
+        }
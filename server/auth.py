@@ -3,8 +3,12 @@ Authentication và Authorization cho OTA Server
 """
 import os
 import jwt
+import atexit
 import hashlib
 import secrets
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Optional
 from fastapi import HTTPException, Security, Header
@@ -12,27 +16,206 @@ from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import json
 from pathlib import Path
 
+from locks import FileLock, file_stamp
+from metrics import AUTH_SECONDS
+
 # Security scheme
 security = HTTPBearer()
+# Bearer token không bắt buộc (dùng cho require_auth)
+optional_security = HTTPBearer(auto_error=False)
 
-# File lưu API keys và device tokens
-AUTH_DIR = Path(__file__).parent.parent / "auth"
-AUTH_DIR.mkdir(exist_ok=True)
+# File lưu API keys và device tokens (đổi thư mục bằng OTA_AUTH_DIR)
+AUTH_DIR = Path(os.getenv("OTA_AUTH_DIR", str(Path(__file__).parent.parent / "auth")))
+AUTH_DIR.mkdir(parents=True, exist_ok=True)
 API_KEYS_FILE = AUTH_DIR / "api_keys.json"
 DEVICE_TOKENS_FILE = AUTH_DIR / "device_tokens.json"
-JWT_SECRET = os.getenv("JWT_SECRET", secrets.token_urlsafe(32))
+REVOKED_TOKENS_FILE = AUTH_DIR / "revoked_tokens.json"
+JWT_SECRET_FILE = AUTH_DIR / "jwt_secret"
+# Khóa file giữa các worker cho các chuỗi đọc-sửa-ghi file trong AUTH_DIR
+AUTH_LOCK = FileLock(AUTH_DIR / ".auth.lock")
+# Chu kỳ ghi last_used của API key xuống file (giây)
+API_KEY_FLUSH_INTERVAL = float(os.getenv("API_KEY_FLUSH_INTERVAL", "30"))
+# Số device token đã xác minh được giữ trong cache (0 = tắt cache)
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "100000"))
+# Chu kỳ (giây) kiểm tra danh sách thu hồi do worker khác ghi
+REVOCATION_CHECK_INTERVAL = float(os.getenv("REVOCATION_CHECK_INTERVAL", "1"))
+
+def load_jwt_secret() -> str:
+    """
+    Secret ký JWT: biến môi trường JWT_SECRET, nếu không có thì đọc auth/jwt_secret
+
+    File được tạo một lần (ghi file tạm rồi os.link, thất bại nếu file đã có)
+    nên mọi worker và mọi lần khởi động lại đều dùng cùng một secret.
+    """
+    secret = os.getenv("JWT_SECRET")
+    if secret:
+        return secret
+    if not JWT_SECRET_FILE.exists():
+        tmp_file = JWT_SECRET_FILE.with_name(f"{JWT_SECRET_FILE.name}.{os.getpid()}.tmp")
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_urlsafe(32))
+        try:
+            os.link(tmp_file, JWT_SECRET_FILE)
+        except FileExistsError:
+            # Worker khác đã tạo trước
+            pass
+        finally:
+            tmp_file.unlink(missing_ok=True)
+    return JWT_SECRET_FILE.read_text().strip()
+
+JWT_SECRET = load_jwt_secret()
+
+class ApiKeyStore:
+    """
+    API keys giữ trong bộ nhớ, tra cứu O(1)
+
+    File api_keys.json chỉ được đọc lại khi file thay đổi (worker khác thêm key),
+    và chỉ kiểm tra khi tra cứu trượt nên request hợp lệ không tốn syscall.
+    Cập nhật last_used chỉ đánh dấu "dirty" trong bộ nhớ, một thread nền ghi
+    file (atomic) mỗi flush_interval giây và khi server tắt, thay vì ghi lại cả
+    file ở mỗi request. Mọi lần ghi đều gộp với nội dung file dưới khóa file.
+    """
+
+    def __init__(self, keys_file: Path, flush_interval: float, lock: Optional[FileLock] = None):
+        self.keys_file = Path(keys_file)
+        self.flush_interval = flush_interval
+        self._keys = None
+        self._stamp = None
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._file_lock = lock or FileLock(self.keys_file.with_name(self.keys_file.name + ".lock"))
+        self._flusher = None
+        self._stop = threading.Event()
+        self.flushes = 0
+        self.reloads = 0
+
+    def _read_file(self) -> dict:
+        if self.keys_file.exists():
+            with open(self.keys_file, 'r') as f:
+                return json.load(f)
+        return {}
+
+    def _load(self):
+        """Đọc file vào bộ nhớ (gọi khi giữ self._lock)"""
+        stamp = file_stamp(self.keys_file)
+        keys = self._read_file()
+        if self._keys is not None:
+            self.reloads += 1
+            # Giữ last_used chưa ghi của process này
+            for api_key, info in self._keys.items():
+                if api_key in keys and info.get("last_used"):
+                    keys[api_key]["last_used"] = max(info["last_used"], keys[api_key].get("last_used") or "")
+        self._keys = keys
+        self._stamp = stamp
+
+    def keys(self) -> dict:
+        """Dict API keys hiện tại (dùng chung, không sửa trực tiếp)"""
+        keys = self._keys
+        if keys is None:
+            with self._lock:
+                if self._keys is None:
+                    self._load()
+                keys = self._keys
+        return keys
+
+    def _reload_if_changed(self) -> bool:
+        with self._lock:
+            if file_stamp(self.keys_file) == self._stamp:
+                return False
+            self._load()
+            return True
+
+    def verify(self, api_key: str) -> bool:
+        info = self.keys().get(api_key)
+        if info is None:
+            # Key có thể vừa được worker khác tạo
+            if not self._reload_if_changed():
+                return False
+            info = self._keys.get(api_key)
+            if info is None:
+                return False
+        info["last_used"] = datetime.now().isoformat()
+        if not self._dirty:
+            self._dirty = True
+            self._start_flusher()
+        return True
+
+    def add(self, api_key: str, info: dict):
+        """Thêm key mới và ghi file ngay (key mới không được phép mất)"""
+        with self._file_lock, self._lock:
+            self._load()
+            keys = dict(self._keys)
+            keys[api_key] = info
+            self._keys = keys
+            self._write(keys)
+
+    def replace(self, keys: dict):
+        with self._file_lock, self._lock:
+            self._keys = keys
+            self._write(keys)
+
+    def _write(self, keys: dict):
+        tmp_file = self.keys_file.with_name(self.keys_file.name + ".tmp")
+        with open(tmp_file, 'w') as f:
+            json.dump(keys, f, indent=2)
+        os.replace(tmp_file, self.keys_file)
+        self._stamp = file_stamp(self.keys_file)
+        self._dirty = False
+        self.flushes += 1
+
+    def flush(self):
+        """Ghi các thay đổi last_used đang chờ xuống file"""
+        if not self._dirty:
+            return
+        with self._file_lock, self._lock:
+            if self._dirty and self._keys is not None:
+                # Gộp với file để không ghi đè key do worker khác thêm
+                self._load()
+                self._write(self._keys)
+
+    def _start_flusher(self):
+        if self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, name="api-key-flush", daemon=True)
+                self._flusher.start()
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"Lỗi khi ghi API keys: {e}")
+
+    def close(self):
+        self._stop.set()
+        self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "keys": len(self.keys()),
+            "pending_flush": self._dirty,
+            "flushes": self.flushes,
+            "reloads": self.reloads,
+            "flush_interval": self.flush_interval,
+        }
+
+api_key_store = ApiKeyStore(API_KEYS_FILE, API_KEY_FLUSH_INTERVAL, AUTH_LOCK)
+atexit.register(api_key_store.flush)
 
 def load_api_keys():
-    """Load API keys từ file"""
-    if API_KEYS_FILE.exists():
-        with open(API_KEYS_FILE, 'r') as f:
-            return json.load(f)
-    return {}
+    """Lấy API keys (từ bộ nhớ, file chỉ được đọc lần đầu)"""
+    return api_key_store.keys()
 
 def save_api_keys(keys):
     """Lưu API keys vào file"""
-    with open(API_KEYS_FILE, 'w') as f:
-        json.dump(keys, f, indent=2)
+    api_key_store.replace(keys)
+
+def flush_api_keys():
+    """Ghi last_used đang chờ xuống file (gọi khi server tắt)"""
+    api_key_store.close()
 
 def load_device_tokens():
     """Load device tokens từ file"""
@@ -42,106 +225,305 @@ def load_device_tokens():
     return {}
 
 def save_device_tokens(tokens):
-    """Lưu device tokens vào file"""
-    with open(DEVICE_TOKENS_FILE, 'w') as f:
+    """Lưu device tokens vào file (ghi file tạm rồi os.replace, không để lại file dở)"""
+    tmp_file = DEVICE_TOKENS_FILE.with_name(DEVICE_TOKENS_FILE.name + ".tmp")
+    with open(tmp_file, 'w') as f:
         json.dump(tokens, f, indent=2)
+    os.replace(tmp_file, DEVICE_TOKENS_FILE)
 
 def generate_api_key(name: str = "default") -> str:
     """Tạo API key mới"""
     api_key = secrets.token_urlsafe(32)
-    keys = load_api_keys()
-    keys[api_key] = {
+    api_key_store.add(api_key, {
         "name": name,
         "created_at": datetime.now().isoformat(),
         "last_used": None
-    }
-    save_api_keys(keys)
+    })
     return api_key
 
 def verify_api_key(api_key: str) -> bool:
-    """Xác minh API key"""
-    keys = load_api_keys()
-    if api_key in keys:
-        # Cập nhật last_used
-        keys[api_key]["last_used"] = datetime.now().isoformat()
-        save_api_keys(keys)
-        return True
-    return False
+    """Xác minh API key (last_used được ghi xuống file theo chu kỳ)"""
+    return api_key_store.verify(api_key)
+
+def token_fingerprint(token: str) -> str:
+    """SHA256 của token, dùng làm khóa danh sách thu hồi (không lưu token gốc)"""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+class TokenCache:
+    """
+    Cache LRU các device token đã xác minh: token -> (device_id, exp)
+
+    Token hết hạn (theo claim exp) bị loại khi tra cứu. Token bị thu hồi được
+    ghi vào revoked_tokens.json (theo fingerprint, kèm exp để dọn khi hết hạn)
+    và bị xóa khỏi cache, nên lần tra cứu cache trúng không cần kiểm tra lại.
+    Khi chạy nhiều worker, file được kiểm tra (stat) tối đa mỗi check_interval
+    giây để bỏ khỏi cache các token do worker khác thu hồi.
+    """
+
+    def __init__(self, max_size: int, revoked_file: Path, check_interval: float = 1.0,
+                 lock: Optional[FileLock] = None):
+        self.max_size = max_size
+        self.revoked_file = Path(revoked_file)
+        self.check_interval = check_interval
+        self._file_lock = lock or FileLock(self.revoked_file.with_name(self.revoked_file.name + ".lock"))
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._revoked = None
+        self._stamp = None
+        self._next_check = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def get(self, token: str) -> Optional[str]:
+        if time.monotonic() >= self._next_check:
+            self._refresh_revoked()
+        with self._lock:
+            entry = self._items.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+            device_id, exp = entry
+            if exp is not None and exp <= time.time():
+                del self._items[token]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._items.move_to_end(token)
+            self.hits += 1
+            return device_id
+
+    def put(self, token: str, device_id: str, exp: Optional[float]):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._items[token] = (device_id, exp)
+            self._items.move_to_end(token)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def _read_revoked(self) -> dict:
+        if self.revoked_file.exists():
+            with open(self.revoked_file, 'r') as f:
+                return json.load(f)
+        return {}
+
+    def _revoked_set(self) -> dict:
+        if self._revoked is None:
+            self._stamp = file_stamp(self.revoked_file)
+            self._revoked = self._read_revoked()
+        return self._revoked
+
+    def _refresh_revoked(self):
+        """Đọc lại danh sách thu hồi nếu worker khác đã ghi, rồi bỏ các token đó khỏi cache"""
+        self._next_check = time.monotonic() + self.check_interval
+        stamp = file_stamp(self.revoked_file)
+        if self._revoked is not None and stamp == self._stamp:
+            return
+        revoked = self._read_revoked()
+        with self._lock:
+            self._revoked = revoked
+            self._stamp = stamp
+            if revoked and self._items:
+                for token in [t for t in self._items if token_fingerprint(t) in revoked]:
+                    del self._items[token]
+
+    def is_revoked(self, token: str) -> bool:
+        revoked = self._revoked_set()
+        return bool(revoked) and token_fingerprint(token) in revoked
+
+    def revoke(self, token: str, exp: Optional[float]):
+        """Thu hồi token: ghi file (atomic), bỏ token hết hạn khỏi danh sách, xóa khỏi cache"""
+        with self._file_lock, self._lock:
+            now = time.time()
+            revoked = {
+                fp: fp_exp for fp, fp_exp in self._read_revoked().items()
+                if fp_exp is None or fp_exp > now
+            }
+            revoked[token_fingerprint(token)] = exp
+            tmp_file = self.revoked_file.with_name(self.revoked_file.name + ".tmp")
+            with open(tmp_file, 'w') as f:
+                json.dump(revoked, f, indent=2)
+            os.replace(tmp_file, self.revoked_file)
+            self._revoked = revoked
+            self._stamp = file_stamp(self.revoked_file)
+            self._items.pop(token, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._items),
+            "max_entries": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expired": self.expired,
+            "revoked": len(self._revoked_set()),
+        }
+
+token_cache = TokenCache(TOKEN_CACHE_SIZE, REVOKED_TOKENS_FILE, REVOCATION_CHECK_INTERVAL, AUTH_LOCK)
 
 def generate_device_token(device_id: str, expires_hours: int = 24 * 30) -> str:
     """Tạo JWT token cho device"""
-    payload = {
-        "device_id": device_id,
-        "exp": datetime.utcnow() + timedelta(hours=expires_hours),
-        "iat": datetime.utcnow()
-    }
-    token = jwt.encode(payload, JWT_SECRET, algorithm="HS256")
-    
+    return generate_device_tokens([{"device_id": device_id}], expires_hours)[0]["token"]
+
+def generate_device_tokens(devices: list, expires_hours: int = 24 * 30) -> list:
+    """
+    Tạo token cho nhiều device trong một lượt
+
+    device_tokens.json chỉ được đọc một lần và ghi một lần (atomic) cho cả lô,
+    thay vì đọc/ghi lại cả file cho từng device.
+
+    Args:
+        devices: Danh sách dict có device_id, device_name, device_type (tùy chọn)
+
+    Returns:
+        Danh sách dict device_id, token, expires_at theo thứ tự đầu vào
+    """
+    now = datetime.utcnow()
+    exp = now + timedelta(hours=expires_hours)
+    created_at = datetime.now().isoformat()
+    expires_at = (datetime.now() + timedelta(hours=expires_hours)).isoformat()
+
+    # Chỉ ký JWT ngoài khóa, khóa file chỉ giữ trong lúc đọc-gộp-ghi
+    issued = []
+    records = {}
+    for device in devices:
+        device_id = device["device_id"]
+        payload = {
+            "device_id": device_id,
+            "exp": exp,
+            "iat": now,
+            # Mỗi token là duy nhất, để thu hồi token cũ không ảnh hưởng token cấp lại
+            "jti": secrets.token_hex(8)
+        }
+        token = jwt.encode(payload, JWT_SECRET, algorithm="HS256")
+        record = {
+            "token": token,
+            "created_at": created_at,
+            "expires_at": expires_at
+        }
+        for field in ("device_name", "device_type"):
+            if device.get(field):
+                record[field] = device[field]
+        records[device_id] = record
+        issued.append({"device_id": device_id, "token": token, "expires_at": expires_at})
+
     # Lưu token vào file
-    tokens = load_device_tokens()
-    tokens[device_id] = {
-        "token": token,
-        "created_at": datetime.now().isoformat(),
-        "expires_at": (datetime.now() + timedelta(hours=expires_hours)).isoformat()
-    }
-    save_device_tokens(tokens)
-    
-    return token
+    with AUTH_LOCK:
+        tokens = load_device_tokens()
+        tokens.update(records)
+        save_device_tokens(tokens)
+    return issued
 
-def verify_device_token(token: str) -> Optional[str]:
-    """Xác minh device token và trả về device_id"""
+def decode_device_token(token: str) -> Optional[dict]:
+    """Giải mã và kiểm tra chữ ký JWT (không qua cache)"""
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
-        return payload.get("device_id")
+        return jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
     except jwt.ExpiredSignatureError:
         return None
     except jwt.InvalidTokenError:
         return None
 
+def verify_device_token(token: str) -> Optional[str]:
+    """Xác minh device token và trả về device_id (token đã xác minh được cache đến khi hết hạn)"""
+    device_id = token_cache.get(token)
+    if device_id is not None:
+        return device_id
+
+    payload = decode_device_token(token)
+    if payload is None or token_cache.is_revoked(token):
+        return None
+    device_id = payload.get("device_id")
+    if device_id:
+        token_cache.put(token, device_id, payload.get("exp"))
+    return device_id
+
+def revoke_device_token(device_id: str) -> bool:
+    """Thu hồi token hiện tại của device (device phải đăng ký lại để có token mới)"""
+    info = load_device_tokens().get(device_id)
+    if not info:
+        return False
+    token = info["token"]
+    payload = decode_device_token(token)
+    token_cache.revoke(token, payload.get("exp") if payload else None)
+    return True
+
 def require_api_key(api_key: str = Header(None, alias="X-API-Key")):
     """Middleware yêu cầu API key"""
-    if not api_key:
-        raise HTTPException(
-            status_code=401,
-            detail="API key required. Use header: X-API-Key"
-        )
-    
-    if not verify_api_key(api_key):
-        raise HTTPException(
-            status_code=401,
-            detail="Invalid API key"
-        )
-    
-    return api_key
+    started = time.perf_counter()
+    scheme = "rejected"
+    try:
+        if not api_key:
+            raise HTTPException(
+                status_code=401,
+                detail="API key required. Use header: X-API-Key"
+            )
+        
+        if not verify_api_key(api_key):
+            raise HTTPException(
+                status_code=401,
+                detail="Invalid API key"
+            )
+        
+        scheme = "api_key"
+        return api_key
+    finally:
+        AUTH_SECONDS.labels(scheme).observe(time.perf_counter() - started)
 
 def require_device_token(credentials: HTTPAuthorizationCredentials = Security(security)):
     """Middleware yêu cầu device token"""
-    token = credentials.credentials
-    device_id = verify_device_token(token)
-    
-    if not device_id:
-        raise HTTPException(
-            status_code=401,
-            detail="Invalid or expired device token"
-        )
-    
-    return device_id
+    started = time.perf_counter()
+    scheme = "rejected"
+    try:
+        token = credentials.credentials
+        device_id = verify_device_token(token)
+        
+        if not device_id:
+            raise HTTPException(
+                status_code=401,
+                detail="Invalid or expired device token"
+            )
+        
+        scheme = "device_token"
+        return device_id
+    finally:
+        AUTH_SECONDS.labels(scheme).observe(time.perf_counter() - started)
 
 def require_auth(api_key: Optional[str] = Header(None, alias="X-API-Key"),
-                 credentials: Optional[HTTPAuthorizationCredentials] = Security(security, auto_error=False)):
+                 credentials: Optional[HTTPAuthorizationCredentials] = Security(optional_security)):
     """Middleware linh hoạt: chấp nhận API key hoặc device token"""
-    # Thử API key trước
-    if api_key and verify_api_key(api_key):
-        return {"type": "api_key", "value": api_key}
-    
-    # Thử device token
-    if credentials:
-        device_id = verify_device_token(credentials.credentials)
-        if device_id:
-            return {"type": "device_token", "device_id": device_id}
-    
-    raise HTTPException(
-        status_code=401,
-        detail="Authentication required. Use X-API-Key header or Bearer token"
-    )
+    started = time.perf_counter()
+    scheme = "rejected"
+    try:
+        # Thử API key trước (tra cứu trong bộ nhớ, không đọc file)
+        if api_key and verify_api_key(api_key):
+            scheme = "api_key"
+            return {"type": "api_key", "value": api_key}
+        
+        # Thử device token
+        if credentials:
+            device_id = verify_device_token(credentials.credentials)
+            if device_id:
+                scheme = "device_token"
+                return {"type": "device_token", "device_id": device_id}
+        
+        raise HTTPException(
+            status_code=401,
+            detail="Authentication required. Use X-API-Key header or Bearer token"
+        )
+    finally:
+        AUTH_SECONDS.labels(scheme).observe(time.perf_counter() - started)
 
@@ -0,0 +1,63 @@
+"""
+Kho firmware theo nội dung (content-addressed)
+Mỗi file firmware được lưu một lần theo SHA256: blobs/ab/abcdef...
+"""
+import os
+import re
+from pathlib import Path
+
+from compression import SUFFIXES
+
+DIGEST_RE = re.compile(r"[0-9a-f]{64}")
+VARIANT_SUFFIXES = set(SUFFIXES.values())
+
+
+class BlobStore:
+    """Lưu bytes firmware theo digest SHA256, tự khử trùng lặp"""
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def path_for(self, digest: str) -> Path:
+        digest = digest.lower()
+        return self.root / digest[:2] / digest
+
+    def exists(self, digest: str) -> bool:
+        return self.path_for(digest).exists()
+
+    def put(self, tmp_path: Path, digest: str) -> bool:
+        """
+        Đưa file tạm (đã tính digest) vào kho
+
+        Returns:
+            True nếu bytes mới được lưu, False nếu blob đã có sẵn (file tạm bị bỏ)
+        """
+        blob_path = self.path_for(digest)
+        if blob_path.exists():
+            Path(tmp_path).unlink(missing_ok=True)
+            return False
+        blob_path.parent.mkdir(exist_ok=True)
+        os.replace(tmp_path, blob_path)
+        return True
+
+    def delete(self, digest: str) -> bool:
+        blob_path = self.path_for(digest)
+        if blob_path.exists():
+            blob_path.unlink()
+            return True
+        return False
+
+    def stats(self) -> dict:
+        """Số blob và dung lượng; bản nén cạnh blob (<sha>.gz, <sha>.zst) tính riêng"""
+        count = total = variants = variant_bytes = 0
+        for path in self.root.glob("??/*"):
+            if not path.is_file():
+                continue
+            if DIGEST_RE.fullmatch(path.name):
+                count += 1
+                total += path.stat().st_size
+            elif DIGEST_RE.fullmatch(path.stem) and path.suffix in VARIANT_SUFFIXES:
+                variants += 1
+                variant_bytes += path.stat().st_size
+        return {"blobs": count, "bytes": total, "variants": variants, "variant_bytes": variant_bytes}
@@ -0,0 +1,425 @@
+"""
+Catalog firmware trong bộ nhớ
+Load metadata một lần cho cả process, chỉ reload khi backend báo có thay đổi
+"""
+import base64
+import copy
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from metrics import METADATA_LOAD_SECONDS
+
+
+def parse_version(version: str) -> tuple:
+    """
+    Chuyển version string thành tuple để so sánh, ví dụ "1.2.0" -> (1, 2)
+    Bỏ các số 0 ở cuối để "1.2" == "1.2.0" giống compare_versions()
+    """
+    parts = [int(x) for x in version.split('.')]
+    while len(parts) > 1 and parts[-1] == 0:
+        parts.pop()
+    return tuple(parts)
+
+
+DEFAULT_CHANNEL = "stable"
+
+
+def firmware_channel(firmware: dict) -> str:
+    """Channel của firmware (entry cũ không có field channel thuộc "stable")"""
+    return firmware.get("channel") or DEFAULT_CHANNEL
+
+
+def storage_key(firmware: dict) -> str:
+    """
+    Khóa vùng lưu bytes của firmware: digest blob, hoặc tên file với layout cũ
+    Nhiều entry có thể trỏ đến cùng một khóa (promote, upload trùng nội dung)
+    """
+    if firmware.get("blob"):
+        return "blob:" + firmware["blob"]
+    return "file:" + firmware.get("filename", "")
+
+
+class VersionIndex:
+    """
+    Index các firmware theo version, mỗi version chỉ parse một lần
+
+    - get(version): O(1) theo version string
+    - latest: firmware mới nhất, được cache
+    - newest_greater(key): O(log n) firmware mới nhất có version > key
+    - refcount(key): số entry đang dùng một vùng lưu bytes (xem storage_key)
+    - ordered(...): duyệt theo version trong một khoảng, tiếp tục sau một cursor
+    """
+
+    def __init__(self, firmwares=()):
+        self._by_version = {}
+        self._key_of = {}
+        self._refs = {}
+        self._channel_latest = {}
+        self._channels = None
+        # Hai list song song, sắp xếp tăng dần theo version key
+        self._keys = []
+        self._versions = []
+        self.latest = None
+        self.latest_key = None
+        self.total_size = 0
+        for firmware in firmwares:
+            self._insert(firmware)
+        self._refresh_latest()
+
+    def __len__(self):
+        return len(self._by_version)
+
+    def __contains__(self, version: str):
+        return version in self._by_version
+
+    def get(self, version: str) -> Optional[dict]:
+        return self._by_version.get(version)
+
+    def _insert(self, firmware: dict):
+        version = firmware["version"]
+        if version in self._by_version:
+            self._remove(version)
+        self._by_version[version] = firmware
+        ref = storage_key(firmware)
+        self._refs[ref] = self._refs.get(ref, 0) + 1
+        self.total_size += firmware.get("size", 0)
+        try:
+            key = parse_version(version)
+        except ValueError:
+            # Version không hợp lệ: vẫn tra cứu được nhưng không tham gia so sánh
+            return
+        self._key_of[version] = key
+        i = bisect_right(self._keys, key)
+        self._keys.insert(i, key)
+        self._versions.insert(i, version)
+
+    def _remove(self, version: str) -> Optional[dict]:
+        firmware = self._by_version.pop(version, None)
+        if firmware is None:
+            return None
+        self.total_size -= firmware.get("size", 0)
+        ref = storage_key(firmware)
+        if self._refs.get(ref, 0) <= 1:
+            self._refs.pop(ref, None)
+        else:
+            self._refs[ref] -= 1
+        key = self._key_of.pop(version, None)
+        if key is None:
+            return firmware
+        i = bisect_left(self._keys, key)
+        while i < len(self._keys) and self._keys[i] == key:
+            if self._versions[i] == version:
+                del self._keys[i]
+                del self._versions[i]
+                break
+            i += 1
+        return firmware
+
+    def _refresh_latest(self):
+        self._channel_latest = {}
+        self._channels = None
+        if self._versions:
+            self.latest = self._by_version[self._versions[-1]]
+            self.latest_key = self._keys[-1]
+        else:
+            self.latest = None
+            self.latest_key = None
+
+    def copy(self) -> "VersionIndex":
+        """Bản sao độc lập (không parse lại version), dùng để sửa copy-on-write"""
+        clone = VersionIndex.__new__(VersionIndex)
+        clone._by_version = dict(self._by_version)
+        clone._key_of = dict(self._key_of)
+        clone._refs = dict(self._refs)
+        clone._keys = list(self._keys)
+        clone._versions = list(self._versions)
+        clone.total_size = self.total_size
+        clone._refresh_latest()
+        return clone
+
+    def add(self, firmware: dict):
+        """Thêm hoặc thay thế một firmware"""
+        self._insert(firmware)
+        self._refresh_latest()
+
+    def remove(self, version: str) -> Optional[dict]:
+        """Xóa firmware theo version, trả về entry đã xóa"""
+        firmware = self._remove(version)
+        self._refresh_latest()
+        return firmware
+
+    def key_of(self, version: str) -> Optional[tuple]:
+        """Version key đã parse sẵn (None nếu version không hợp lệ)"""
+        return self._key_of.get(version)
+
+    def refcount(self, ref: str) -> int:
+        return self._refs.get(ref, 0)
+
+    def newest(self, channel: Optional[str] = None) -> Optional[dict]:
+        """Firmware mới nhất (trong channel nếu có chỉ định), cache theo channel"""
+        if channel is None:
+            return self.latest
+        if channel in self._channel_latest:
+            return self._channel_latest[channel]
+        newest = None
+        for i in range(len(self._versions) - 1, -1, -1):
+            firmware = self._by_version[self._versions[i]]
+            if firmware_channel(firmware) == channel:
+                newest = firmware
+                break
+        self._channel_latest[channel] = newest
+        return newest
+
+    def channels(self) -> dict:
+        """{channel: version mới nhất của channel} cho mọi channel đang có, được cache"""
+        if self._channels is None:
+            channels = {}
+            for i in range(len(self._versions) - 1, -1, -1):
+                firmware = self._by_version[self._versions[i]]
+                channels.setdefault(firmware_channel(firmware), firmware["version"])
+            self._channels = channels
+        return self._channels
+
+    def newest_greater(self, key: tuple, channel: Optional[str] = None) -> Optional[dict]:
+        """Firmware mới nhất có version > key (key từ parse_version)"""
+        if channel is None:
+            if self.latest_key is not None and self.latest_key > key:
+                return self.latest
+            return None
+        newest = self.newest(channel)
+        if newest is not None and self._key_of[newest["version"]] > key:
+            return newest
+        return None
+
+    def newer_than(self, key: tuple) -> Iterator[dict]:
+        """Duyệt các firmware có version > key, từ mới nhất đến cũ nhất"""
+        start = bisect_right(self._keys, key)
+        for i in range(len(self._versions) - 1, start - 1, -1):
+            yield self._by_version[self._versions[i]]
+
+    def sorted_count(self, min_key: Optional[tuple] = None, max_key: Optional[tuple] = None) -> int:
+        """Số firmware có version hợp lệ trong [min_key, max_key]"""
+        lo, hi = self._bounds(min_key, max_key)
+        return max(0, hi - lo)
+
+    def _bounds(self, min_key: Optional[tuple], max_key: Optional[tuple]) -> Tuple[int, int]:
+        lo = 0 if min_key is None else bisect_left(self._keys, min_key)
+        hi = len(self._keys) if max_key is None else bisect_right(self._keys, max_key)
+        return lo, hi
+
+    def _position(self, version: str) -> Tuple[int, int]:
+        """
+        Khoảng [start, end) của version trong list đã sắp xếp: đúng vị trí nếu
+        version còn trong index, nếu không thì cả khoảng các version cùng key
+        """
+        key = parse_version(version)
+        start = bisect_left(self._keys, key)
+        end = bisect_right(self._keys, key)
+        for i in range(start, end):
+            if self._versions[i] == version:
+                return i, i + 1
+        return start, end
+
+    def ordered(self, descending: bool = False, min_key: Optional[tuple] = None,
+                max_key: Optional[tuple] = None, after: Optional[str] = None) -> Iterator[dict]:
+        """
+        Duyệt các firmware có version trong [min_key, max_key] theo thứ tự version,
+        bắt đầu ngay sau version `after` (theo chiều duyệt). Vị trí bắt đầu tìm bằng
+        bisect, không copy list. Version không hợp lệ không có thứ tự nên bị bỏ qua.
+        """
+        lo, hi = self._bounds(min_key, max_key)
+        if after is not None:
+            start, end = self._position(after)
+            if descending:
+                hi = min(hi, start)
+            else:
+                lo = max(lo, end)
+        indices = range(hi - 1, lo - 1, -1) if descending else range(lo, hi)
+        for i in indices:
+            yield self._by_version[self._versions[i]]
+
+
+def encode_cursor(version: str) -> str:
+    """Cursor phân trang (không cần hiểu nội dung) trỏ đến firmware cuối của trang"""
+    return base64.urlsafe_b64encode(version.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> str:
+    """Version trong cursor, ValueError nếu cursor không hợp lệ"""
+    try:
+        version = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError(f"Cursor không hợp lệ: {cursor}")
+    try:
+        parse_version(version)
+    except ValueError:
+        raise ValueError(f"Cursor không hợp lệ: {cursor}")
+    return version
+
+
+def firmware_page(index: VersionIndex, limit: int, descending: bool = True,
+                  min_key: Optional[tuple] = None, max_key: Optional[tuple] = None,
+                  after: Optional[str] = None,
+                  match: Optional[Callable[[dict], bool]] = None) -> Tuple[List[dict], Optional[str]]:
+    """
+    Một trang firmware theo version: (tối đa limit entry, cursor của trang sau hoặc None)
+    Chỉ duyệt đến khi đủ limit + 1 entry thỏa match.
+    """
+    page = []
+    for firmware in index.ordered(descending, min_key, max_key, after):
+        if match is not None and not match(firmware):
+            continue
+        if len(page) == limit:
+            return page, encode_cursor(page[-1]["version"])
+        page.append(firmware)
+    return page, None
+
+
+class FirmwareCatalog:
+    """
+    Giữ metadata firmware đã parse trong bộ nhớ
+
+    Mỗi lần truy cập chỉ hỏi backend một "change token" rẻ (stat() với JSON,
+    PRAGMA data_version với SQLite). Nội dung chỉ được load lại khi token
+    thay đổi (ví dụ sửa tay hoặc process khác ghi), còn các thay đổi qua
+    upload/delete của server được cập nhật thẳng vào bộ nhớ.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.RLock()
+        self._metadata: Optional[dict] = None
+        self._index = VersionIndex()
+        self._stamp = None
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """Đăng ký hàm được gọi (không tham số) mỗi khi catalog thay đổi"""
+        self._listeners.append(callback)
+
+    def _changed(self):
+        self.generation += 1
+        for callback in self._listeners:
+            callback()
+
+    def load(self, copy_for_update: bool = False) -> dict:
+        """
+        Lấy metadata hiện tại
+
+        Dict trả về được dùng chung, không được sửa trực tiếp.
+        Dùng copy_for_update=True khi cần sửa rồi save().
+        """
+        stamp = self.store.change_token()
+        metadata = self._metadata
+        if metadata is not None and stamp == self._stamp:
+            self.hits += 1
+        else:
+            with self._lock:
+                stamp = self.store.change_token()
+                if self._metadata is None:
+                    self.misses += 1
+                elif stamp != self._stamp:
+                    self.reloads += 1
+                if self._metadata is None or stamp != self._stamp:
+                    started = time.perf_counter()
+                    self._set(self.store.load())
+                    METADATA_LOAD_SECONDS.observe(time.perf_counter() - started)
+                    self._stamp = stamp
+                metadata = self._metadata
+        if copy_for_update:
+            return copy.deepcopy(metadata)
+        return metadata
+
+    def index(self) -> VersionIndex:
+        """
+        Index version của metadata hiện tại
+
+        Index trả về không bao giờ bị sửa: upsert/remove sửa trên bản sao rồi mới
+        thay vào, nên có thể giữ lại làm snapshot (ví dụ cả lô check-update
+        stream trong threadpool).
+        """
+        self.load()
+        return self._index
+
+    def _set(self, metadata: dict):
+        """Thay toàn bộ metadata và build lại index"""
+        self._metadata = metadata
+        self._index = VersionIndex(metadata.get("firmwares", []))
+        self._changed()
+
+    def save(self, metadata: dict):
+        """Ghi toàn bộ metadata xuống backend và cập nhật bộ nhớ"""
+        with self._lock, self.store.write_lock():
+            self.store.save(metadata)
+            self._stamp = self.store.change_token()
+            self._set(metadata)
+
+    @contextmanager
+    def write_lock(self):
+        """
+        Giữ khóa ghi catalog (giữa các thread và các process) cho chuỗi thao tác
+        nhiều bước, ví dụ upsert rồi xóa bytes không còn dùng; upsert/remove/save
+        gọi lồng bên trong được
+        """
+        with self._lock, self.store.write_lock():
+            yield
+
+    def upsert(self, firmware: dict):
+        """Thêm hoặc cập nhật một firmware, index được cập nhật tăng dần trên bản sao"""
+        # Khóa file: process khác không ghi xen giữa lúc load lại và lúc ghi
+        with self._lock, self.store.write_lock():
+            metadata = self.load()
+            firmwares = [f for f in metadata.get("firmwares", []) if f["version"] != firmware["version"]]
+            firmwares.append(firmware)
+            # Copy-on-write: request đang đọc metadata cũ không bị ảnh hưởng
+            metadata = dict(metadata, firmwares=firmwares)
+            self.store.upsert(firmware, metadata)
+            self._stamp = self.store.change_token()
+            self._metadata = metadata
+            index = self._index.copy()
+            index.add(firmware)
+            self._index = index
+            self._changed()
+
+    def remove(self, version: str) -> Optional[dict]:
+        """Xóa firmware theo version, trả về entry đã xóa (hoặc None)"""
+        with self._lock, self.store.write_lock():
+            metadata = self.load()
+            if version not in self._index:
+                return None
+            firmwares = [f for f in metadata.get("firmwares", []) if f["version"] != version]
+            metadata = dict(metadata, firmwares=firmwares)
+            self.store.delete(version, metadata)
+            self._stamp = self.store.change_token()
+            self._metadata = metadata
+            index = self._index.copy()
+            removed = index.remove(version)
+            self._index = index
+            self._changed()
+            return removed
+
+    def invalidate(self):
+        """Bắt buộc load lại từ backend ở lần truy cập tiếp theo"""
+        with self._lock:
+            self._stamp = None
+
+    def stats(self) -> dict:
+        """Thống kê hit/miss/reload"""
+        total = self.hits + self.misses + self.reloads
+        return {
+            "backend": self.store.name,
+            "hits": self.hits,
+            "misses": self.misses,
+            "reloads": self.reloads,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            "generation": self.generation,
+            "firmware_count": len(self._index),
+            "latest_version": self._index.latest["version"] if self._index.latest else None,
+        }
@@ -0,0 +1,104 @@
+"""
+Bản nén sẵn (gzip, zstd) của file firmware
+Tạo một lần ở background sau khi upload, lưu cạnh file gốc: <file>.gz, <file>.zst
+"""
+import gzip
+import os
+import shutil
+from pathlib import Path
+from typing import Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Thứ tự ưu tiên khi client chấp nhận nhiều encoding
+ENCODINGS = ["zstd", "gzip"] if zstandard else ["gzip"]
+SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+
+# Bỏ bản nén nếu không nhỏ hơn ít nhất 5% so với file gốc
+MIN_SAVING = 0.05
+
+
+def variant_path(file_path: Path, encoding: str) -> Path:
+    file_path = Path(file_path)
+    return file_path.with_name(file_path.name + SUFFIXES[encoding])
+
+
+def _compress(src: Path, dst: Path, encoding: str):
+    with open(src, "rb") as f_in, open(dst, "wb") as f_out:
+        if encoding == "gzip":
+            with gzip.GzipFile(fileobj=f_out, mode="wb", compresslevel=9, mtime=0) as gz:
+                shutil.copyfileobj(f_in, gz, 1024 * 1024)
+        else:
+            zstandard.ZstdCompressor(level=19).copy_stream(f_in, f_out)
+
+
+def build_variants(file_path: Path) -> dict:
+    """
+    Tạo các bản nén cho file_path (bỏ qua bản đã có)
+
+    Returns:
+        {encoding: size} của các bản nén đang có
+    """
+    file_path = Path(file_path)
+    original_size = file_path.stat().st_size
+    variants = {}
+    for encoding in ENCODINGS:
+        dst = variant_path(file_path, encoding)
+        if not dst.exists():
+            tmp = dst.with_name(dst.name + ".tmp")
+            try:
+                _compress(file_path, tmp, encoding)
+                if tmp.stat().st_size > original_size * (1 - MIN_SAVING):
+                    # Nén không đáng kể (ví dụ ảnh đã mã hóa): gửi bản gốc
+                    tmp.unlink()
+                    continue
+                os.replace(tmp, dst)
+            except Exception as e:
+                tmp.unlink(missing_ok=True)
+                print(f"Lỗi khi nén {file_path.name} ({encoding}): {e}")
+                continue
+        variants[encoding] = dst.stat().st_size
+    return variants
+
+
+def remove_variants(file_path: Path):
+    for encoding in SUFFIXES:
+        variant_path(file_path, encoding).unlink(missing_ok=True)
+
+
+def parse_accept_encoding(header: Optional[str]) -> dict:
+    """Parse Accept-Encoding thành {encoding: q}"""
+    accepted = {}
+    if not header:
+        return accepted
+    for item in header.split(","):
+        name, _, params = item.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name] = q
+    return accepted
+
+
+def choose_encoding(header: Optional[str], file_path: Path) -> Optional[str]:
+    """Chọn bản nén tốt nhất mà client chấp nhận và đang có trên disk"""
+    accepted = parse_accept_encoding(header)
+    if not accepted:
+        return None
+    best = None
+    best_q = 0.0
+    for encoding in ENCODINGS:
+        q = accepted.get(encoding, accepted.get("*", 0.0))
+        if q > best_q and variant_path(file_path, encoding).exists():
+            best, best_q = encoding, q
+    return best
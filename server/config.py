@@ -8,17 +8,105 @@ from pathlib import Path
 SERVER_HOST = os.getenv("OTA_SERVER_HOST", "0.0.0.0")
 SERVER_PORT = int(os.getenv("OTA_SERVER_PORT", "8000"))
 
-# Thư mục firmware
+# Số process worker (uvicorn --workers), mỗi worker dùng một core
+# Với nhiều worker nên dùng OTA_METADATA_BACKEND=sqlite
+SERVER_WORKERS = int(os.getenv("OTA_WORKERS", "1"))
+# Số kết nối/task đồng thời tối đa mỗi worker trước khi trả 503 (0 = không giới hạn)
+LIMIT_CONCURRENCY = int(os.getenv("OTA_LIMIT_CONCURRENCY", "0"))
+# Độ dài hàng đợi kết nối chờ accept
+SERVER_BACKLOG = int(os.getenv("OTA_BACKLOG", "2048"))
+# Thời gian giữ kết nối keep-alive (giây)
+KEEPALIVE_TIMEOUT = int(os.getenv("OTA_KEEPALIVE_TIMEOUT", "5"))
+
+# Thư mục firmware (chứa cả blobs/, patches/ và metadata)
 BASE_DIR = Path(__file__).parent.parent
-FIRMWARE_DIR = BASE_DIR / "firmware"
-FIRMWARE_DIR.mkdir(exist_ok=True)
+FIRMWARE_DIR = Path(os.getenv("OTA_FIRMWARE_DIR", str(BASE_DIR / "firmware")))
+FIRMWARE_DIR.mkdir(parents=True, exist_ok=True)
+
+# Kho firmware theo nội dung: blobs/<2 ký tự đầu>/<sha256>
+BLOB_DIR = FIRMWARE_DIR / "blobs"
+
+# Cache patch (binary delta) giữa các phiên bản
+PATCH_DIR = FIRMWARE_DIR / "patches"
+# Ngân sách disk cho patch (MB), 0 = tắt delta update
+PATCH_CACHE_SIZE = int(os.getenv("PATCH_CACHE_MB", "256")) * 1024 * 1024
+# Chỉ dùng patch khi nhỏ hơn tỉ lệ này so với ảnh đầy đủ
+PATCH_MAX_RATIO = float(os.getenv("PATCH_MAX_RATIO", "0.5"))
 
 # File metadata
 METADATA_FILE = FIRMWARE_DIR / "metadata.json"
 
+# Backend lưu metadata: "json" (metadata.json) hoặc "sqlite" (metadata.db, chế độ WAL)
+# Với sqlite, metadata.json cũ được import tự động ở lần chạy đầu tiên
+METADATA_BACKEND = os.getenv("OTA_METADATA_BACKEND", "json").lower()
+METADATA_DB_FILE = FIRMWARE_DIR / "metadata.db"
+
 # Giới hạn kích thước file upload (MB)
 MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE_MB", "50")) * 1024 * 1024
 
+# Cache RAM cho ảnh firmware đang được tải nhiều (MB), 0 = tắt
+DOWNLOAD_CACHE_SIZE = int(os.getenv("DOWNLOAD_CACHE_MB", "64")) * 1024 * 1024
+# Ảnh lớn hơn ngưỡng này luôn đọc từ disk (MB)
+DOWNLOAD_CACHE_MAX_ITEM = int(os.getenv("DOWNLOAD_CACHE_MAX_ITEM_MB", "16")) * 1024 * 1024
+
+# Kiểm soát tải firmware (/api/download, /api/patch), tính theo từng worker:
+# số download đồng thời tối đa, số lần tải mỗi phút của một device/IP và tổng
+# băng thông gửi đi (MB/s). 0 = không giới hạn. Vượt giới hạn nhận 503 + Retry-After
+DOWNLOAD_MAX_CONCURRENT = int(os.getenv("DOWNLOAD_MAX_CONCURRENT", "256"))
+DOWNLOAD_DEVICE_RATE_PER_MIN = float(os.getenv("DOWNLOAD_DEVICE_RATE_PER_MIN", "0"))
+DOWNLOAD_EGRESS_BYTES_PER_SEC = int(float(os.getenv("DOWNLOAD_EGRESS_MB_PER_SEC", "0")) * 1024 * 1024)
+
+# Tạo bản nén sẵn gzip/zstd cho firmware sau khi upload
+PRECOMPRESS_FIRMWARE = os.getenv("PRECOMPRESS_FIRMWARE", "true").lower() == "true"
+
+# Kích thước mỗi chunk khi ghi file upload (KB), bộ nhớ mỗi upload chỉ cỡ một chunk
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE_KB", "1024")) * 1024
+
+# Thông báo firmware mới (/api/updates/stream, /api/updates/poll)
+# Số check-update mỗi giây server muốn nhận sau một thông báo; thiết bị rải lần check
+# trong khoảng subscribers / NOTIFY_CHECK_RATE giây (tối đa NOTIFY_MAX_SPREAD)
+NOTIFY_CHECK_RATE = float(os.getenv("NOTIFY_CHECK_RATE", "500"))
+NOTIFY_MAX_SPREAD = float(os.getenv("NOTIFY_MAX_SPREAD", "120"))
+# Chu kỳ gửi comment giữ kết nối SSE và thời gian chờ tối đa của long-poll (giây)
+NOTIFY_KEEPALIVE = float(os.getenv("NOTIFY_KEEPALIVE", "25"))
+NOTIFY_LONGPOLL_TIMEOUT = float(os.getenv("NOTIFY_LONGPOLL_TIMEOUT", "60"))
+# Chu kỳ kiểm tra catalog do worker khác hoặc sửa tay thay đổi (giây)
+NOTIFY_POLL_INTERVAL = float(os.getenv("NOTIFY_POLL_INTERVAL", "2"))
+
+# Gợi ý lịch polling (next_check_after trong kết quả check-update): chu kỳ cơ bản
+# và tối đa (giây), số check-update mỗi giây mỗi worker muốn nhận; vượt mức này
+# thì chu kỳ được kéo dài theo tỉ lệ
+POLL_INTERVAL = float(os.getenv("POLL_INTERVAL", "3600"))
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", "86400"))
+POLL_TARGET_RATE = float(os.getenv("POLL_TARGET_RATE", "50"))
+
+# Kiểm tra update hàng loạt (/api/check-update/batch): số device tối đa mỗi lô,
+# và lô lớn hơn ngưỡng này được trả về dạng NDJSON streaming
+BATCH_CHECK_MAX = int(os.getenv("BATCH_CHECK_MAX", "10000"))
+BATCH_STREAM_THRESHOLD = int(os.getenv("BATCH_STREAM_THRESHOLD", "500"))
+
+# Số body JSON serialize sẵn giữ trong RAM (check-update "không có update", danh
+# sách firmware), xóa mỗi khi catalog thay đổi; 0 = tắt
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "4096"))
+
+# Phân trang /api/firmwares: số entry mặc định và tối đa mỗi trang
+FIRMWARE_PAGE_LIMIT = int(os.getenv("FIRMWARE_PAGE_LIMIT", "100"))
+FIRMWARE_PAGE_MAX = int(os.getenv("FIRMWARE_PAGE_MAX", "1000"))
+
+# Số device tối đa trong một lần đăng ký hàng loạt (/api/auth/register/bulk)
+BULK_REGISTER_MAX = int(os.getenv("BULK_REGISTER_MAX", "100000"))
+
+# Endpoint /metrics (định dạng Prometheus) và middleware đo latency mỗi request
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+# Profile request (cProfile/tracemalloc), xem profiling.py: tỉ lệ request được
+# profile ngẫu nhiên (0 = chỉ khi có header X-Profile + API key), thư mục và số file giữ lại
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = Path(os.getenv("PROFILE_DIR", str(BASE_DIR / "profiles")))
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "50"))
+# Chụp tracemalloc cho mọi upload (tốn CPU/bộ nhớ, chỉ bật khi điều tra)
+PROFILE_TRACE_UPLOADS = os.getenv("PROFILE_TRACE_UPLOADS", "false").lower() == "true"
+
 # Cấu hình bảo mật (tùy chọn)
 REQUIRE_AUTH = os.getenv("REQUIRE_AUTH", "false").lower() == "true"
 API_KEY = os.getenv("API_KEY", "")
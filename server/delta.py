@@ -0,0 +1,275 @@
+"""
+Binary delta (patch) giữa hai phiên bản firmware
+
+Định dạng patch (client/ota_client.py có hàm apply_patch tương ứng):
+    b"OTAPATCH1" + zlib(chuỗi lệnh)
+    - b"C" + offset (8 byte) + length (4 byte): copy từ ảnh gốc
+    - b"I" + length (4 byte) + data: chèn bytes mới
+
+Patch được tạo ở background, lưu trong PATCH_DIR và giới hạn theo dung lượng;
+khi vượt ngân sách thì xóa cặp (base, target) ít được yêu cầu nhất.
+"""
+import hashlib
+import json
+import os
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+from locks import FileLock, file_stamp
+
+PATCH_MAGIC = b"OTAPATCH1"
+BLOCK_SIZE = 32
+MAX_OP_LENGTH = 0xFFFFFFFF
+
+
+def make_patch(base: bytes, target: bytes, block_size: int = BLOCK_SIZE) -> bytes:
+    """
+    Tạo patch biến base thành target
+
+    Index các block căn theo block_size của base, quét target tìm block trùng,
+    rồi mở rộng đoạn trùng về hai phía. Phần không khớp được chèn nguyên văn.
+    """
+    index = {}
+    for offset in range(0, len(base) - block_size + 1, block_size):
+        index.setdefault(base[offset:offset + block_size], offset)
+
+    ops = bytearray()
+    n = len(target)
+    literal_start = 0
+    i = 0
+
+    def emit_insert(start, end):
+        while start < end:
+            length = min(end - start, MAX_OP_LENGTH)
+            ops.extend(b"I" + struct.pack(">I", length) + target[start:start + length])
+            start += length
+
+    while i + block_size <= n:
+        base_offset = index.get(target[i:i + block_size])
+        if base_offset is None:
+            i += 1
+            continue
+
+        # Mở rộng về phía trước (vào phần literal đang chờ)
+        t_start, b_start = i, base_offset
+        while t_start > literal_start and b_start > 0 and target[t_start - 1] == base[b_start - 1]:
+            t_start -= 1
+            b_start -= 1
+
+        # Mở rộng về phía sau, so sánh theo khối lớn trước rồi từng byte
+        t_end, b_end = i + block_size, base_offset + block_size
+        step = 4096
+        while step >= 1:
+            while (t_end + step <= n and b_end + step <= len(base)
+                   and target[t_end:t_end + step] == base[b_end:b_end + step]):
+                t_end += step
+                b_end += step
+            step //= 8
+
+        emit_insert(literal_start, t_start)
+        ops.extend(b"C" + struct.pack(">QI", b_start, t_end - t_start))
+        literal_start = i = t_end
+
+    emit_insert(literal_start, n)
+    return PATCH_MAGIC + zlib.compress(bytes(ops), 9)
+
+
+def apply_patch(base: bytes, patch: bytes) -> bytes:
+    """Dựng lại ảnh target từ base và patch"""
+    if not patch.startswith(PATCH_MAGIC):
+        raise ValueError("Patch không hợp lệ")
+    ops = zlib.decompress(patch[len(PATCH_MAGIC):])
+    out = bytearray()
+    pos = 0
+    while pos < len(ops):
+        op = ops[pos:pos + 1]
+        if op == b"C":
+            offset, length = struct.unpack_from(">QI", ops, pos + 1)
+            out += base[offset:offset + length]
+            pos += 13
+        elif op == b"I":
+            (length,) = struct.unpack_from(">I", ops, pos + 1)
+            out += ops[pos + 5:pos + 5 + length]
+            pos += 5 + length
+        else:
+            raise ValueError("Patch không hợp lệ")
+    return bytes(out)
+
+
+class PatchStore:
+    """
+    Cache patch trên disk, giới hạn theo dung lượng
+
+    Khóa là cặp checksum (base, target) nên không phụ thuộc tên version.
+    Số lần được yêu cầu của mỗi cặp dùng để chọn patch bị xóa khi vượt ngân sách.
+    Khi nhiều worker dùng chung PATCH_DIR, index.json được gộp với nội dung trên
+    disk dưới khóa file mỗi lần ghi, và đọc lại khi tra cứu trượt mà file đã đổi.
+    """
+
+    def __init__(self, root: Path, max_bytes: int, max_ratio: float = 0.5):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.index_file = self.root / "index.json"
+        self._file_lock = FileLock(self.root / "index.lock")
+        self._stamp = None
+        self.max_bytes = max_bytes
+        self.max_ratio = max_ratio
+        self._lock = threading.Lock()
+        self._entries = self._load_index()
+        # Cặp đang tạo hoặc patch không đáng dùng (lớn hơn max_ratio * target)
+        self._pending = set()
+        self._rejected = set()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ota-delta")
+        self.generated = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def pair_key(base_checksum: str, target_checksum: str) -> str:
+        return f"{base_checksum}-{target_checksum}"
+
+    def _load_index(self) -> dict:
+        self._stamp = file_stamp(self.index_file)
+        if self.index_file.exists():
+            try:
+                with open(self.index_file, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                pass
+        return {}
+
+    def _save_index(self, removed=()):
+        """Gộp với index trên disk (patch do worker khác tạo) rồi ghi atomic"""
+        with self._file_lock:
+            entries = {
+                key: entry for key, entry in self._load_index().items()
+                if key not in removed and self.path_for(entry).exists()
+            }
+            for key, entry in self._entries.items():
+                if self.path_for(entry).exists():
+                    entries[key] = entry
+            self._entries = entries
+            tmp_file = self.index_file.with_name(self.index_file.name + ".tmp")
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(entries, f, indent=2)
+            os.replace(tmp_file, self.index_file)
+            self._stamp = file_stamp(self.index_file)
+
+    def path_for(self, entry: dict) -> Path:
+        return self.root / entry["file"]
+
+    def lookup(self, base_checksum: str, target_checksum: str, count: bool = False) -> Optional[dict]:
+        """Tìm patch có sẵn, count=True để tăng bộ đếm yêu cầu của cặp"""
+        key = self.pair_key(base_checksum, target_checksum)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and file_stamp(self.index_file) != self._stamp:
+                # Worker khác có thể đã tạo patch này
+                self._entries = self._load_index()
+                entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if count:
+                entry["requests"] = entry.get("requests", 0) + 1
+            return entry
+
+    def schedule(self, base_path: Path, base_checksum: str, target_path: Path, target_checksum: str):
+        """Tạo patch ở background (mỗi cặp chỉ tạo một lần)"""
+        key = self.pair_key(base_checksum, target_checksum)
+        with self._lock:
+            if key in self._entries or key in self._pending or key in self._rejected:
+                return
+            self._pending.add(key)
+        self._executor.submit(self._generate, key, base_path, base_checksum, target_path, target_checksum)
+
+    def _generate(self, key, base_path, base_checksum, target_path, target_checksum):
+        try:
+            base = Path(base_path).read_bytes()
+            target = Path(target_path).read_bytes()
+            patch = make_patch(base, target)
+            # Kiểm tra lại patch trước khi công bố
+            if hashlib.sha256(apply_patch(base, patch)).hexdigest() != target_checksum:
+                raise ValueError("Patch không tái tạo đúng ảnh đích")
+            if len(patch) > len(target) * self.max_ratio or len(patch) > self.max_bytes:
+                with self._lock:
+                    self._rejected.add(key)
+                return
+            filename = f"{key}.patch"
+            # File tạm riêng mỗi process: worker khác tạo cùng cặp không ghi chung file tạm
+            tmp_file = self.root / f"{filename}.{os.getpid()}.tmp"
+            tmp_file.write_bytes(patch)
+            # Công bố (rename + index) dưới khóa file của PATCH_DIR
+            with self._lock, self._file_lock:
+                os.replace(tmp_file, self.root / filename)
+                self._entries[key] = {
+                    "file": filename,
+                    "base_checksum": base_checksum,
+                    "target_checksum": target_checksum,
+                    "size": len(patch),
+                    "checksum": hashlib.sha256(patch).hexdigest(),
+                    "requests": 0,
+                    "created_at": datetime.now().isoformat(),
+                }
+                self.generated += 1
+                self._evict(keep=key)
+                self._save_index()
+        except Exception as e:
+            print(f"Lỗi khi tạo patch {key}: {e}")
+            with self._lock:
+                self._rejected.add(key)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def _total_size(self) -> int:
+        return sum(entry["size"] for entry in self._entries.values())
+
+    def _evict(self, keep: Optional[str] = None):
+        """Xóa patch ít được yêu cầu nhất (trừ patch vừa tạo) cho đến khi nằm trong ngân sách"""
+        total = self._total_size()
+        while total > self.max_bytes:
+            candidates = [k for k in self._entries if k != keep]
+            if not candidates:
+                break
+            key = min(
+                candidates,
+                key=lambda k: (self._entries[k].get("requests", 0), self._entries[k].get("created_at", ""))
+            )
+            entry = self._entries.pop(key)
+            self.path_for(entry).unlink(missing_ok=True)
+            total -= entry["size"]
+            self.evictions += 1
+
+    def discard(self, checksum: str):
+        """Xóa mọi patch có base hoặc target là checksum (khi firmware bị xóa)"""
+        with self._lock:
+            keys = [
+                k for k, entry in self._entries.items()
+                if checksum in (entry["base_checksum"], entry["target_checksum"])
+            ]
+            for key in keys:
+                self.path_for(self._entries.pop(key)).unlink(missing_ok=True)
+            self._rejected = {k for k in self._rejected if checksum not in k}
+            if keys:
+                self._save_index(removed=keys)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "patches": len(self._entries),
+                "bytes": self._total_size(),
+                "max_bytes": self.max_bytes,
+                "pending": len(self._pending),
+                "generated": self.generated,
+                "evictions": self.evictions,
+                "requests": sum(entry.get("requests", 0) for entry in self._entries.values()),
+            }
@@ -0,0 +1,96 @@
+"""
+Serialize JSON nhanh cho các endpoint nóng (check-update, danh sách firmware)
+
+Dùng orjson nếu có cài, không thì json chuẩn với cùng định dạng như JSONResponse
+của Starlette. Endpoint trả về thẳng FastJSONResponse nên FastAPI bỏ qua bước
+jsonable_encoder/kiểm tra response. Các body hay gặp (check-update "không có
+update") được serialize một lần và giữ trong SerializedCache cho đến khi catalog đổi.
+"""
+import json
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional, Tuple
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(content, sort_keys: bool = False) -> bytes:
+    """JSON dạng bytes, không khoảng trắng, giữ nguyên ký tự Unicode"""
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, sort_keys=sort_keys,
+                      separators=(",", ":")).encode("utf-8")
+
+
+def with_field(body: bytes, name: str, value: int) -> bytes:
+    """Thêm một field số vào cuối object JSON đã serialize (không parse lại)"""
+    return b"%s,\"%s\":%d}" % (body[:-1], name.encode(), value)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse serialize bằng dumps(); content có thể là bytes đã serialize sẵn"""
+
+    def render(self, content) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return dumps(content)
+
+
+class SerializedCache:
+    """
+    Body JSON đã serialize theo khóa (generation catalog, ...), tối đa max_entries
+    (bỏ entry cũ nhất); lần tra trúng không cần lock
+
+    Khóa nên chứa catalog.generation; cache cũng được xóa khi catalog thay đổi
+    (đăng ký clear() làm listener) để không giữ body của catalog cũ.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key: Hashable) -> Optional[Tuple[bytes, Optional[str]]]:
+        """(body, etag) theo key, None nếu chưa có (caller tự build rồi put)"""
+        item = self._items.get(key)
+        if item is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return item
+
+    def put(self, key: Hashable, item: Tuple[bytes, Optional[str]]):
+        if self.max_entries > 0:
+            with self._lock:
+                self._items[key] = item
+                if len(self._items) > self.max_entries:
+                    self._items.popitem(last=False)
+
+    def get(self, key: Hashable, build: Callable[[], Tuple[bytes, Optional[str]]]) -> Tuple[bytes, Optional[str]]:
+        """(body, etag) theo key, gọi build() khi chưa có"""
+        item = self.lookup(key)
+        if item is None:
+            item = build()
+            self.put(key, item)
+        return item
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "serializer": "orjson" if orjson is not None else "json",
+            "entries": len(self._items),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+        }
@@ -2,23 +2,52 @@
 OTA Firmware Update Server
 Server để quản lý và phân phối firmware updates qua OTA
 """
-from fastapi import FastAPI, HTTPException, File, UploadFile, Depends, Header
-from fastapi.responses import FileResponse, JSONResponse, HTMLResponse
+from fastapi import FastAPI, HTTPException, File, UploadFile, Depends, Header, Request, BackgroundTasks
+from fastapi.responses import FileResponse, JSONResponse, HTMLResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, ValidationError
 import os
 import json
+import asyncio
 import hashlib
 from pathlib import Path
-from typing import Optional, List
+from datetime import datetime, time
+from typing import Optional, List, Tuple
 import uvicorn
-from config import FIRMWARE_DIR, METADATA_FILE, SERVER_HOST, SERVER_PORT, MAX_UPLOAD_SIZE
+from starlette.concurrency import run_in_threadpool
+from config import (
+    FIRMWARE_DIR, BLOB_DIR, PATCH_DIR, PATCH_CACHE_SIZE, PATCH_MAX_RATIO, METADATA_FILE, METADATA_BACKEND, METADATA_DB_FILE,
+    SERVER_HOST, SERVER_PORT, SERVER_WORKERS, LIMIT_CONCURRENCY, SERVER_BACKLOG, KEEPALIVE_TIMEOUT,
+    MAX_UPLOAD_SIZE, UPLOAD_CHUNK_SIZE,
+    DOWNLOAD_CACHE_SIZE, DOWNLOAD_CACHE_MAX_ITEM, PRECOMPRESS_FIRMWARE,
+    DOWNLOAD_MAX_CONCURRENT, DOWNLOAD_DEVICE_RATE_PER_MIN, DOWNLOAD_EGRESS_BYTES_PER_SEC, BULK_REGISTER_MAX,
+    BATCH_CHECK_MAX, BATCH_STREAM_THRESHOLD, FIRMWARE_PAGE_LIMIT, FIRMWARE_PAGE_MAX, RESPONSE_CACHE_SIZE,
+    NOTIFY_CHECK_RATE, NOTIFY_MAX_SPREAD, NOTIFY_KEEPALIVE, NOTIFY_LONGPOLL_TIMEOUT, NOTIFY_POLL_INTERVAL,
+    POLL_INTERVAL, POLL_MAX_INTERVAL, POLL_TARGET_RATE, METRICS_ENABLED,
+    PROFILE_SAMPLE_RATE, PROFILE_DIR, PROFILE_MAX_FILES, PROFILE_TRACE_UPLOADS
+)
 from auth import (
     require_api_key, require_device_token, require_auth,
-    generate_api_key, generate_device_token,
-    load_api_keys, load_device_tokens
+    generate_api_key, generate_device_token, generate_device_tokens, revoke_device_token, verify_api_key,
+    load_api_keys, load_device_tokens, flush_api_keys, api_key_store, token_cache
+)
+from catalog import (
+    FirmwareCatalog, DEFAULT_CHANNEL, parse_version, storage_key, firmware_channel, firmware_page, decode_cursor
 )
+from blobs import BlobStore
+from serving import ImageCache, firmware_response, etag_matches, CHUNK_SIZE
+from admission import DownloadLimiter
+from delta import PatchStore
+from compression import build_variants, remove_variants
+from metadata_store import open_metadata_store
+from uploads import UploadSizeLimitMiddleware, stream_to_temp
+from notify import UpdateBroadcaster, sse_message
+from rollout import rollout_target, rollout_percentage, rollout_summary
+from polling import PollScheduler
+import metrics
+from profiling import RequestProfiler, ProfilingMiddleware
+from fastjson import FastJSONResponse, SerializedCache, dumps, with_field
 
 app = FastAPI(title="OTA Firmware Update Server")
 
@@ -36,6 +65,22 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Từ chối upload quá lớn trước khi parse multipart
+app.add_middleware(UploadSizeLimitMiddleware, path="/api/upload", max_size=MAX_UPLOAD_SIZE)
+
+# Profile request theo tỉ lệ mẫu hoặc header X-Profile (kèm API key)
+request_profiler = RequestProfiler(
+    PROFILE_DIR, PROFILE_SAMPLE_RATE, PROFILE_MAX_FILES, PROFILE_TRACE_UPLOADS, verify_api_key
+)
+app.add_middleware(ProfilingMiddleware, profiler=request_profiler)
+
+# Đo latency/bytes mọi request (ngoài cùng, tính cả thời gian của các middleware khác)
+if METRICS_ENABLED:
+    app.add_middleware(metrics.MetricsMiddleware, transfer_routes={
+        "/api/download/{version}": ("firmware", "version"),
+        "/api/patch/{base_version}/{target_version}": ("patch", "target_version"),
+    })
+
 class FirmwareInfo(BaseModel):
     version: str
     filename: str
@@ -47,23 +92,129 @@ class FirmwareInfo(BaseModel):
 class UpdateCheck(BaseModel):
     current_version: str
     device_id: Optional[str] = None
+    device_type: Optional[str] = None
+    channel: Optional[str] = None
+
+class PromoteRequest(BaseModel):
+    version: Optional[str] = None
+    channel: Optional[str] = None
+    description: Optional[str] = None
+
+class RolloutStep(BaseModel):
+    at: datetime
+    percentage: float = Field(ge=0, le=100)
+
+class RolloutUpdate(BaseModel):
+    percentage: float = Field(ge=0, le=100)
+    schedule: Optional[List[RolloutStep]] = None
 
 class DeviceRegistration(BaseModel):
     device_id: str
     device_name: Optional[str] = None
     device_type: Optional[str] = None
 
-def load_metadata():
-    """Load metadata từ file"""
-    if METADATA_FILE.exists():
-        with open(METADATA_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {"firmwares": []}
+# Catalog firmware dùng chung cho cả process
+catalog = FirmwareCatalog(open_metadata_store(METADATA_BACKEND, METADATA_FILE, METADATA_DB_FILE))
+
+def load_metadata(copy_for_update: bool = False):
+    """Load metadata (từ bộ nhớ, chỉ đọc lại file khi file thay đổi)"""
+    return catalog.load(copy_for_update=copy_for_update)
 
 def save_metadata(metadata):
-    """Lưu metadata vào file"""
-    with open(METADATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(metadata, f, indent=2, ensure_ascii=False)
+    """Lưu metadata xuống backend (JSON hoặc SQLite)"""
+    catalog.save(metadata)
+
+# Kho firmware theo SHA256
+blob_store = BlobStore(BLOB_DIR)
+
+# Cache RAM cho ảnh firmware đang hot (khóa theo checksum, chỉ bỏ entry khi xóa bytes)
+image_cache = ImageCache(DOWNLOAD_CACHE_SIZE, DOWNLOAD_CACHE_MAX_ITEM)
+
+# Body JSON serialize sẵn của các response hay gặp, xóa mỗi khi catalog thay đổi
+response_cache = SerializedCache(RESPONSE_CACHE_SIZE)
+catalog.add_listener(response_cache.clear)
+
+# Giới hạn số download đồng thời, tần suất mỗi device và băng thông gửi đi
+download_limiter = DownloadLimiter(
+    DOWNLOAD_MAX_CONCURRENT, DOWNLOAD_DEVICE_RATE_PER_MIN, DOWNLOAD_EGRESS_BYTES_PER_SEC, CHUNK_SIZE
+)
+
+def client_key(request: Request, auth_info: dict) -> Optional[str]:
+    """Định danh client (giới hạn tải, slot polling): device_id trong token, không thì IP"""
+    if auth_info.get("type") == "device_token":
+        return auth_info["device_id"]
+    return request.client.host if request.client else None
+
+metrics.DOWNLOADS_IN_FLIGHT.set_function(lambda: download_limiter.active)
+
+# Gợi ý thời điểm check-update tiếp theo, rải đều thiết bị trên chu kỳ polling
+poll_scheduler = PollScheduler(POLL_INTERVAL, POLL_MAX_INTERVAL, POLL_TARGET_RATE)
+
+def poll_hint(device_id: Optional[str]) -> int:
+    """Ghi nhận một lần check-update và tính next_check_after (giây) cho device"""
+    poll_scheduler.record()
+    return poll_scheduler.next_check_after(device_id)
+
+# Thông báo firmware mới cho các thiết bị đang giữ kết nối SSE/long-poll
+def catalog_summary() -> dict:
+    """Tóm tắt gửi cho thiết bị: version mới nhất mỗi channel và phần trăm rollout"""
+    index = catalog.index()
+    channels = index.channels()
+    return {"channels": channels, "rollout": rollout_summary(index, channels)}
+
+update_broadcaster = UpdateBroadcaster(catalog_summary, NOTIFY_CHECK_RATE, NOTIFY_MAX_SPREAD)
+catalog.add_listener(update_broadcaster.notify)
+
+def firmware_path(firmware: dict) -> Path:
+    """Đường dẫn file bytes của firmware (blob, hoặc file theo tên với layout cũ)"""
+    if firmware.get("blob"):
+        return blob_store.path_for(firmware["blob"])
+    return FIRMWARE_DIR / firmware["filename"]
+
+# Cache patch giữa các phiên bản (tạo ở background, giới hạn dung lượng)
+patch_store = PatchStore(PATCH_DIR, PATCH_CACHE_SIZE, PATCH_MAX_RATIO)
+
+def patch_info(base_firmware: Optional[dict], target_firmware: dict) -> Optional[dict]:
+    """
+    Thông tin patch từ base đến target nếu đã có sẵn
+    Chưa có thì lên lịch tạo ở background, lần check sau sẽ có
+    """
+    if not patch_store.enabled or not base_firmware:
+        return None
+    if base_firmware["checksum"] == target_firmware["checksum"]:
+        return None
+    entry = patch_store.lookup(base_firmware["checksum"], target_firmware["checksum"])
+    if entry is None:
+        patch_store.schedule(
+            firmware_path(base_firmware), base_firmware["checksum"],
+            firmware_path(target_firmware), target_firmware["checksum"]
+        )
+        return None
+    return {
+        "base_version": base_firmware["version"],
+        "base_checksum": base_firmware["checksum"],
+        "size": entry["size"],
+        "checksum": entry["checksum"],
+        "download_url": f"/api/patch/{base_firmware['version']}/{target_firmware['version']}"
+    }
+
+def release_storage(firmware: dict):
+    """
+    Xóa bytes của firmware nếu không còn entry nào trong catalog trỏ đến
+    Gọi trong catalog.write_lock(): refcount được tính lại trên catalog mới nhất
+    (kể cả thay đổi của worker khác) và không đổi cho đến khi xóa xong
+    """
+    if catalog.index().refcount(storage_key(firmware)) > 0:
+        return
+    patch_store.discard(firmware["checksum"])
+    image_cache.discard(firmware["checksum"])
+    remove_variants(firmware_path(firmware))
+    if firmware.get("blob"):
+        blob_store.delete(firmware["blob"])
+    else:
+        file_path = FIRMWARE_DIR / firmware["filename"]
+        if file_path.exists():
+            file_path.unlink()
 
 def calculate_checksum(file_path: Path) -> str:
     """Tính checksum SHA256 của file"""
@@ -89,6 +240,31 @@ def compare_versions(v1: str, v2: str) -> int:
             return -1
     return 0
 
+@app.on_event("startup")
+async def start_update_notifier():
+    """Gắn broadcaster vào event loop và theo dõi catalog do worker khác thay đổi"""
+    update_broadcaster.bind(asyncio.get_running_loop())
+
+    async def watch_catalog():
+        while True:
+            await asyncio.sleep(NOTIFY_POLL_INTERVAL)
+            try:
+                # Chỉ hỏi change token, reload (và notify qua listener) khi có thay đổi
+                catalog.load()
+                # Phần trăm rollout theo schedule đổi theo thời gian, không qua catalog
+                update_broadcaster.notify()
+            except Exception as e:
+                print(f"Lỗi khi kiểm tra catalog: {e}")
+
+    app.state.catalog_watcher = asyncio.create_task(watch_catalog())
+    if METRICS_ENABLED:
+        app.state.loop_monitor = asyncio.create_task(metrics.monitor_event_loop())
+
+@app.on_event("shutdown")
+def flush_state():
+    """Ghi các thay đổi còn giữ trong bộ nhớ xuống disk khi server tắt"""
+    flush_api_keys()
+
 @app.get("/", response_class=HTMLResponse)
 async def root():
     """Trang chủ - Web UI"""
@@ -115,9 +291,15 @@ async def api_root():
         "version": "1.0.0",
         "endpoints": {
             "check_update": "/api/check-update",
+            "check_update_batch": "/api/check-update/batch",
             "download": "/api/download/{version}",
+            "patch": "/api/patch/{base_version}/{target_version}",
+            "updates_stream": "/api/updates/stream",
             "list_firmwares": "/api/firmwares",
             "upload": "/api/upload",
+            "promote": "/api/firmware/{version}/promote",
+            "rollout": "/api/firmware/{version}/rollout",
+            "stats": "/api/stats",
             "github_info": "/api/github-info"
         },
         "web_ui": "/"
@@ -159,6 +341,125 @@ async def register_device(device: DeviceRegistration, api_key: str = Depends(req
         "message": "Device registered successfully"
     }
 
+def parse_device_entry(item) -> DeviceRegistration:
+    """Một device trong lô đăng ký: chuỗi device_id hoặc object như DeviceRegistration"""
+    if isinstance(item, str):
+        item = {"device_id": item}
+    return DeviceRegistration.model_validate(item)
+
+async def read_device_batch(request: Request):
+    """
+    Đọc danh sách device từ body: JSON array (hoặc {"devices": [...]}) hay NDJSON
+
+    NDJSON được parse theo từng dòng khi nhận, không cần giữ cả body.
+
+    Returns:
+        (danh sách device hợp lệ, danh sách lỗi theo vị trí)
+    """
+    devices = []
+    errors = []
+
+    def add(index, item):
+        if len(devices) + len(errors) >= BULK_REGISTER_MAX:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Tối đa {BULK_REGISTER_MAX} device mỗi lần đăng ký"
+            )
+        try:
+            devices.append((index, parse_device_entry(item)))
+        except ValidationError as e:
+            errors.append({"index": index, "error": e.errors()[0]["msg"]})
+
+    content_type = request.headers.get("content-type", "")
+    if "ndjson" in content_type or "jsonl" in content_type:
+        buffer = b""
+        index = 0
+
+        def parse_line(line):
+            nonlocal index
+            line = line.strip()
+            if not line:
+                return
+            try:
+                item = json.loads(line)
+            except ValueError:
+                errors.append({"index": index, "error": "Dòng JSON không hợp lệ"})
+            else:
+                add(index, item)
+            index += 1
+
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                parse_line(line)
+        parse_line(buffer)
+    else:
+        try:
+            body = json.loads(await request.body())
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Body phải là JSON array hoặc NDJSON")
+        if isinstance(body, dict):
+            body = body.get("devices")
+        if not isinstance(body, list):
+            raise HTTPException(status_code=400, detail="Body phải là JSON array hoặc NDJSON")
+        for index, item in enumerate(body):
+            add(index, item)
+    return devices, errors
+
+@app.post("/api/auth/register/bulk")
+async def register_devices_bulk(request: Request, api_key: str = Depends(require_api_key)):
+    """
+    Đăng ký nhiều device một lần (dây chuyền sản xuất, gateway)
+    Yêu cầu API key
+
+    Body: JSON array hoặc NDJSON (Content-Type: application/x-ndjson), mỗi phần tử
+    là device_id hoặc {"device_id", "device_name", "device_type"}.
+    Tất cả token được ghi xuống file trong một lần, kết quả trả về dạng NDJSON.
+    """
+    devices, errors = await read_device_batch(request)
+
+    # device_id trùng trong cùng lô chỉ được cấp token một lần
+    seen = set()
+    unique = []
+    for index, device in devices:
+        if device.device_id in seen:
+            errors.append({"index": index, "device_id": device.device_id, "error": "device_id bị trùng trong lô"})
+            continue
+        seen.add(device.device_id)
+        unique.append(device.model_dump())
+
+    # Ký JWT cho cả lô tốn CPU, chạy ngoài event loop
+    issued = await run_in_threadpool(generate_device_tokens, unique) if unique else []
+
+    def results():
+        for item in issued:
+            yield json.dumps(item) + "\n"
+        for item in errors:
+            yield json.dumps(item, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(
+        results(),
+        media_type="application/x-ndjson",
+        headers={
+            "X-Registered-Count": str(len(issued)),
+            "X-Error-Count": str(len(errors))
+        }
+    )
+
+@app.post("/api/auth/revoke/{device_id}")
+async def revoke_device(device_id: str, api_key: str = Depends(require_api_key)):
+    """
+    Thu hồi token hiện tại của device
+    Yêu cầu API key
+    """
+    if not revoke_device_token(device_id):
+        raise HTTPException(status_code=404, detail=f"Device {device_id} không tồn tại")
+    return {
+        "device_id": device_id,
+        "message": "Device token revoked"
+    }
+
 @app.post("/api/auth/generate-key")
 async def create_api_key(name: str = "default"):
     """
@@ -182,170 +483,671 @@ async def list_api_keys(api_key: str = Depends(require_api_key)):
         ]
     }
 
-@app.post("/api/check-update")
-async def check_update(
-    update_check: UpdateCheck,
-    auth_info: dict = Depends(require_auth)
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    """Metrics của worker này theo định dạng text của Prometheus"""
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics đang tắt")
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/api/profiles")
+async def list_profiles(api_key: str = Depends(require_api_key)):
+    """Danh sách file profile gần đây (mới nhất trước)"""
+    profiles = await run_in_threadpool(request_profiler.list_profiles)
+    return {"profiles": profiles, **request_profiler.stats()}
+
+@app.get("/api/profiles/{name}")
+async def download_profile(
+    name: str,
+    format: Optional[str] = None,
+    sort: str = "cumulative",
+    api_key: str = Depends(require_api_key)
 ):
     """
-    Kiểm tra có firmware mới không
-    Yêu cầu authentication (API key hoặc device token)
+    Tải file profile (.prof mở bằng pstats/snakeviz, .tracemalloc bằng tracemalloc.Snapshot.load)
+    format=text với file .prof: trả về top 50 hàm theo sort (cumulative, tottime, calls)
+    """
+    path = request_profiler.path_for(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Không tìm thấy profile")
+    if format == "text" and path.suffix == ".prof":
+        if sort not in ("cumulative", "tottime", "calls"):
+            raise HTTPException(status_code=400, detail="sort phải là cumulative, tottime hoặc calls")
+        text = await run_in_threadpool(request_profiler.pstats_text, path, 50, sort)
+        return Response(text, media_type="text/plain; charset=utf-8")
+    return FileResponse(path, filename=name, media_type="application/octet-stream")
+
+@app.get("/api/stats")
+async def server_stats(api_key: str = Depends(require_api_key)):
+    """Thống kê nội bộ của server (catalog cache, ...)"""
+    return {
+        "catalog": catalog.stats(),
+        "blobs": blob_store.stats(),
+        "download_cache": image_cache.stats(),
+        "patches": patch_store.stats(),
+        "api_keys": api_key_store.stats(),
+        "notifications": update_broadcaster.stats(),
+        "downloads": download_limiter.stats(),
+        "polling": poll_scheduler.stats(),
+        "profiling": request_profiler.stats(),
+        "device_tokens": token_cache.stats(),
+        "responses": response_cache.stats()
+    }
+
+def update_check_result(index, current: str, channel: str, device_id: Optional[str] = None,
+                        target: Optional[dict] = None, resolved: bool = False) -> dict:
+    """
+    Kết quả check-update cho một phiên bản hiện tại trong một channel
+
+    Firmware đích là bản mới nhất mà device được nhận theo rollout (xem rollout.py).
+    Truyền resolved=True cùng target nếu đã tính sẵn firmware đích.
+    Raise ValueError nếu current không phải version hợp lệ
     """
-    metadata = load_metadata()
-    firmwares = metadata.get("firmwares", [])
+    latest_firmware = index.newest(channel)
     
-    if not firmwares:
+    if not latest_firmware:
         return {
             "update_available": False,
             "message": "Không có firmware nào trong hệ thống"
         }
     
-    # Lấy firmware mới nhất (sắp xếp theo version)
-    latest_firmware = max(firmwares, key=lambda x: tuple(map(int, x["version"].split('.'))))
+    # So sánh phiên bản (version trong catalog đã được parse sẵn trong index)
+    current_key = parse_version(current)
+    if not resolved:
+        target = rollout_target(index, current_key, channel, device_id)
     
-    if not latest_firmware:
-        return {
-            "update_available": False,
-            "message": "Không tìm thấy firmware"
+    if target is not None:
+        latest = target["version"]
+        firmware_info = {
+            "version": target["version"],
+            "size": target["size"],
+            "checksum": target["checksum"],
+            "description": target.get("description", ""),
+            "release_date": target.get("release_date", ""),
+            "download_url": f"/api/download/{latest}"
         }
-    
-    # So sánh phiên bản
-    current = update_check.current_version
-    latest = latest_firmware["version"]
-    
-    if compare_versions(latest, current) > 0:
+        # Patch từ phiên bản hiện tại của thiết bị (nếu đã tạo xong)
+        patch = patch_info(index.get(current), target)
+        if patch:
+            firmware_info["patch"] = patch
         return {
             "update_available": True,
             "latest_version": latest,
             "current_version": current,
-            "firmware_info": {
-                "version": latest_firmware["version"],
-                "size": latest_firmware["size"],
-                "checksum": latest_firmware["checksum"],
-                "description": latest_firmware.get("description", ""),
-                "release_date": latest_firmware.get("release_date", ""),
-                "download_url": f"/api/download/{latest}"
-            }
+            "firmware_info": firmware_info
         }
     else:
         return {
             "update_available": False,
             "current_version": current,
-            "latest_version": latest,
+            "latest_version": latest_firmware["version"],
             "message": "Đã sử dụng phiên bản mới nhất"
         }
 
+def request_device_id(auth_info: dict, device_id: Optional[str]) -> Optional[str]:
+    """device_id dùng cho rollout: lấy từ device token nếu có, không thì từ body"""
+    if auth_info.get("type") == "device_token":
+        return auth_info["device_id"]
+    return device_id
+
+def check_update_body(index, current: str, channel: str, device_id: Optional[str],
+                      with_etag: bool = True) -> Tuple[bytes, Optional[str]]:
+    """
+    Kết quả check-update đã serialize (chưa có next_check_after) và ETag của nó
+
+    Khi channel không có bản nào mới hơn current, kết quả "không có update" giống
+    nhau cho mọi device: body và ETag được tính một lần và tra cache trước cả khi
+    parse version hay xét rollout, đến khi catalog thay đổi. Kết quả phụ thuộc
+    device (có update, hoặc chưa tới lượt theo rollout) không được cache.
+    Raise ValueError nếu current không phải version hợp lệ
+    """
+    cache_key = (catalog.generation, "check-update", current, channel)
+    cached = response_cache.lookup(cache_key)
+    if cached is not None:
+        return cached
+    result = update_check_result(index, current, channel, device_id)
+    if result["update_available"]:
+        return dumps(result), check_result_etag(result) if with_etag else None
+    body = dumps(result), check_result_etag(result)
+    # Chỉ cache khi không có bản mới hơn (không phụ thuộc device_id)
+    if index.newest(channel) is None or index.newest_greater(parse_version(current), channel) is None:
+        response_cache.put(cache_key, body)
+    return body
+
+@app.post("/api/check-update")
+async def check_update(
+    update_check: UpdateCheck,
+    auth_info: dict = Depends(require_auth)
+):
+    """
+    Kiểm tra có firmware mới không
+    Yêu cầu authentication (API key hoặc device token)
+
+    Kết quả có next_check_after (giây, cũng là header X-Next-Check-After):
+    thời điểm thiết bị nên check lại, theo slot riêng của device và tải server.
+    """
+    current = update_check.current_version
+    device_id = request_device_id(auth_info, update_check.device_id)
+    try:
+        body, _ = check_update_body(
+            catalog.index(), current, update_check.channel or DEFAULT_CHANNEL, device_id, with_etag=False
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Phiên bản không hợp lệ: {current}")
+    next_check_after = poll_hint(device_id)
+    return FastJSONResponse(
+        with_field(body, "next_check_after", next_check_after),
+        headers={"X-Next-Check-After": str(next_check_after)}
+    )
+
+def check_result_etag(result: dict) -> str:
+    """
+    ETag của kết quả check-update, lấy từ nội dung (firmware đích theo rollout, patch...)
+    nên giống nhau ở mọi worker. Là ETag yếu vì next_check_after khác nhau mỗi lần.
+    """
+    return '"' + hashlib.sha256(dumps(result, sort_keys=True)).hexdigest()[:32] + '"'
+
+@app.get("/api/check-update")
+async def check_update_get(
+    request: Request,
+    current_version: str,
+    device_id: Optional[str] = None,
+    device_type: Optional[str] = None,
+    channel: Optional[str] = None,
+    auth_info: dict = Depends(require_auth)
+):
+    """
+    Kiểm tra có firmware mới (dạng GET có điều kiện, dùng được qua cache/reverse proxy)
+    Yêu cầu authentication (API key hoặc device token)
+
+    Kết quả giống POST /api/check-update, kèm ETag. Client gửi lại ETag trong
+    If-None-Match và nhận 304 không có body khi kết quả không đổi.
+    """
+    device_id = request_device_id(auth_info, device_id)
+    try:
+        body, etag = check_update_body(catalog.index(), current_version, channel or DEFAULT_CHANNEL, device_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Phiên bản không hợp lệ: {current_version}")
+    next_check_after = poll_hint(device_id)
+    headers = {
+        "ETag": "W/" + etag,
+        # Cache phải hỏi lại server mỗi lần (If-None-Match), kết quả khác nhau theo credential
+        "Cache-Control": "no-cache",
+        "Vary": "Authorization, X-API-Key",
+        "X-Next-Check-After": str(next_check_after),
+    }
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return FastJSONResponse(with_field(body, "next_check_after", next_check_after), headers=headers)
+
+@app.post("/api/check-update/batch")
+async def check_update_batch(
+    request: Request,
+    checks: List[UpdateCheck],
+    auth_info: dict = Depends(require_auth)
+):
+    """
+    Kiểm tra update cho nhiều device trong một request (gateway)
+    Yêu cầu authentication (API key hoặc device token)
+
+    Body: danh sách {device_id, current_version, device_type, channel}.
+    Các device cùng (current_version, channel, device_type) và cùng firmware đích
+    theo rollout chỉ được tính một lần.
+    Kết quả theo đúng thứ tự đầu vào, mỗi phần tử có thêm device_id (và
+    device_type nếu có); version không hợp lệ cho kết quả có field "error".
+    Lô lớn hơn BATCH_STREAM_THRESHOLD hoặc khi client gửi
+    Accept: application/x-ndjson thì trả về NDJSON theo kiểu streaming.
+    Thời điểm gateway nên gọi lại nằm trong header X-Next-Check-After
+    (và field next_check_after với kết quả JSON).
+    """
+    if len(checks) > BATCH_CHECK_MAX:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Tối đa {BATCH_CHECK_MAX} device mỗi lần kiểm tra"
+        )
+
+    # Cả lô dùng chung một snapshot của catalog
+    index = catalog.index()
+    memo = {}
+
+    def result_for(check: UpdateCheck) -> dict:
+        channel = check.channel or DEFAULT_CHANNEL
+        try:
+            # Firmware đích phụ thuộc cohort rollout của từng device (O(1)),
+            # phần còn lại của kết quả dùng chung cho cùng khóa
+            target = rollout_target(index, parse_version(check.current_version), channel, check.device_id)
+        except ValueError:
+            target = None
+        key = (check.current_version, channel, check.device_type, target["version"] if target else None)
+        result = memo.get(key)
+        if result is None:
+            try:
+                result = update_check_result(index, check.current_version, channel,
+                                             target=target, resolved=True)
+            except ValueError:
+                result = {
+                    "update_available": False,
+                    "current_version": check.current_version,
+                    "error": f"Phiên bản không hợp lệ: {check.current_version}"
+                }
+            memo[key] = result
+        item = {"device_id": check.device_id}
+        if check.device_type:
+            item["device_type"] = check.device_type
+        item.update(result)
+        return item
+
+    stream = (
+        len(checks) > BATCH_STREAM_THRESHOLD
+        or "application/x-ndjson" in request.headers.get("accept", "")
+    )
+    # Gateway có một slot polling riêng cho cả lô
+    next_check_after = poll_hint(client_key(request, auth_info))
+    hint_headers = {"X-Next-Check-After": str(next_check_after)}
+    if not stream:
+        results = [result_for(check) for check in checks]
+        return FastJSONResponse({
+            "count": len(results),
+            "updates_available": sum(1 for r in results if r["update_available"]),
+            "next_check_after": next_check_after,
+            "results": results
+        }, headers=hint_headers)
+
+    def lines():
+        for check in checks:
+            yield dumps(result_for(check)) + b"\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson", headers=hint_headers)
+
+@app.get("/api/updates/stream")
+async def updates_stream(
+    auth_info: dict = Depends(require_auth),
+    last_event_id: Optional[str] = Header(None, alias="Last-Event-ID")
+):
+    """
+    Server-Sent Events: nhận thông báo khi có firmware mới thay vì polling
+    Yêu cầu authentication (API key hoặc device token)
+
+    Sự kiện "catalog" gồm version mới nhất của mỗi channel và "spread" (giây):
+    thiết bị chỉ gọi check-update khi channel của mình có version mới, sau một
+    khoảng trễ ngẫu nhiên trong [0, spread].
+    """
+    update_broadcaster.bind(asyncio.get_running_loop())
+
+    async def events():
+        yield "retry: 5000\n\n"
+        last_id = last_event_id
+        # Gửi trạng thái hiện tại ngay khi kết nối (trừ khi thiết bị đã nhận sự kiện này)
+        event = update_broadcaster.event
+        if event is not None and event["id"] != last_id:
+            last_id = event["id"]
+            yield sse_message(event)
+        while True:
+            event = await update_broadcaster.wait(last_id, NOTIFY_KEEPALIVE)
+            if event is None:
+                yield ": keepalive\n\n"
+                continue
+            last_id = event["id"]
+            yield sse_message(event)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/api/updates/poll")
+async def updates_poll(
+    last_event_id: Optional[str] = None,
+    timeout: float = 30,
+    auth_info: dict = Depends(require_auth)
+):
+    """
+    Long-poll (khi proxy không hỗ trợ SSE): chờ đến khi có sự kiện khác last_event_id
+    Không có last_event_id thì trả về trạng thái hiện tại ngay; hết timeout trả về 204
+    """
+    update_broadcaster.bind(asyncio.get_running_loop())
+    if not last_event_id:
+        return update_broadcaster.event
+    timeout = min(max(timeout, 0), NOTIFY_LONGPOLL_TIMEOUT)
+    event = await update_broadcaster.wait(last_event_id, timeout)
+    if event is None:
+        return Response(status_code=204)
+    return event
+
 @app.get("/api/download/{version}")
 async def download_firmware(
     version: str,
+    request: Request,
     auth_info: dict = Depends(require_auth)
 ):
     """
     Tải firmware theo phiên bản
+    Hỗ trợ Range/If-Range (tải tiếp), ETag theo checksum và If-None-Match (304)
+    Server quá tải hoặc device tải quá thường xuyên: 503 kèm Retry-After
     Yêu cầu authentication (API key hoặc device token)
     """
-    metadata = load_metadata()
-    firmwares = metadata.get("firmwares", [])
-    
-    firmware = next((f for f in firmwares if f["version"] == version), None)
+    firmware = catalog.index().get(version)
     
     if not firmware:
         raise HTTPException(status_code=404, detail="Không tìm thấy firmware")
     
-    file_path = FIRMWARE_DIR / firmware["filename"]
+    file_path = firmware_path(firmware)
     
     if not file_path.exists():
         raise HTTPException(status_code=404, detail="File firmware không tồn tại")
     
-    return FileResponse(
-        path=file_path,
-        filename=firmware["filename"],
-        media_type="application/octet-stream"
-    )
+    return await firmware_response(request, firmware, file_path, image_cache,
+                                   download_limiter, client_key(request, auth_info))
+
+@app.get("/api/patch/{base_version}/{target_version}")
+async def download_patch(
+    base_version: str,
+    target_version: str,
+    request: Request,
+    auth_info: dict = Depends(require_auth)
+):
+    """
+    Tải patch (binary delta) từ base_version lên target_version
+    Yêu cầu authentication (API key hoặc device token)
+    """
+    index = catalog.index()
+    base_firmware = index.get(base_version)
+    target_firmware = index.get(target_version)
+    if not base_firmware or not target_firmware:
+        raise HTTPException(status_code=404, detail="Không tìm thấy firmware")
+    
+    entry = patch_store.lookup(base_firmware["checksum"], target_firmware["checksum"], count=True)
+    if not entry or not patch_store.path_for(entry).exists():
+        raise HTTPException(status_code=404, detail="Patch chưa sẵn sàng")
+    
+    patch = {
+        "version": target_version,
+        "filename": f"{base_version}-{target_version}.patch",
+        "size": entry["size"],
+        "checksum": entry["checksum"]
+    }
+    return await firmware_response(request, patch, patch_store.path_for(entry), image_cache,
+                                   download_limiter, client_key(request, auth_info))
+
+LIST_SORTS = {"-version": True, "version": False}
+
+def parse_date_bound(value: Optional[str], name: str, end_of_day: bool = False) -> Optional[str]:
+    """
+    Chuẩn hóa since/until về dạng isoformat để so sánh chuỗi với release_date
+    end_of_day=True (until): giá trị chỉ có ngày được tính đến hết ngày đó
+    """
+    if value is None:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} không hợp lệ: {value}")
+    if end_of_day and "T" not in value and " " not in value.strip():
+        parsed = datetime.combine(parsed.date(), time.max)
+    return parsed.isoformat()
+
+def parse_version_bound(value: Optional[str], name: str) -> Optional[tuple]:
+    if value is None:
+        return None
+    try:
+        return parse_version(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} không hợp lệ: {value}")
 
 @app.get("/api/firmwares")
-async def list_firmwares(auth_info: dict = Depends(require_auth)):
+async def list_firmwares(
+    request: Request,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    sort: str = "-version",
+    min_version: Optional[str] = None,
+    max_version: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    channel: Optional[str] = None,
+    fields: Optional[str] = None,
+    auth_info: dict = Depends(require_auth)
+):
     """
-    Liệt kê tất cả firmware có sẵn
+    Liệt kê firmware có sẵn
     Yêu cầu authentication
+
+    Không có query param nào: trả về toàn bộ catalog như trước. Khi có bất kỳ
+    param nào thì trả về từng trang lấy thẳng từ index version (không copy catalog):
+    - limit (mặc định FIRMWARE_PAGE_LIMIT, tối đa FIRMWARE_PAGE_MAX), cursor = next_cursor của trang trước
+    - sort: "-version" (mới nhất trước, mặc định) hoặc "version"
+    - min_version/max_version (tính cả hai đầu), since/until theo release_date (ISO 8601)
+    - channel
+    - fields: danh sách field cần trả về, phân cách bằng dấu phẩy (luôn có version)
+    Firmware có version không hợp lệ không có thứ tự nên không xuất hiện trong các trang.
     """
-    metadata = load_metadata()
-    return {
-        "firmwares": metadata.get("firmwares", []),
-        "count": len(metadata.get("firmwares", []))
-    }
+    if not request.query_params:
+        # Toàn bộ catalog chỉ được serialize lại khi catalog thay đổi
+        firmwares = load_metadata().get("firmwares", [])
+        body, _ = response_cache.get(
+            (catalog.generation, "firmwares"),
+            lambda: (dumps({"firmwares": firmwares, "count": len(firmwares)}), None)
+        )
+        return FastJSONResponse(body)
+
+    if sort not in LIST_SORTS:
+        raise HTTPException(status_code=400, detail=f"sort phải là một trong: {', '.join(LIST_SORTS)}")
+    limit = FIRMWARE_PAGE_LIMIT if limit is None else limit
+    if not 1 <= limit <= FIRMWARE_PAGE_MAX:
+        raise HTTPException(status_code=400, detail=f"limit phải trong khoảng 1-{FIRMWARE_PAGE_MAX}")
+    min_key = parse_version_bound(min_version, "min_version")
+    max_key = parse_version_bound(max_version, "max_version")
+    since = parse_date_bound(since, "since")
+    until = parse_date_bound(until, "until", end_of_day=True)
+    after = None
+    if cursor:
+        try:
+            after = decode_cursor(cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    match = None
+    if channel or since or until:
+        def match(firmware: dict) -> bool:
+            if channel and firmware_channel(firmware) != channel:
+                return False
+            release_date = firmware.get("release_date") or ""
+            if since and release_date < since:
+                return False
+            if until and release_date > until:
+                return False
+            return True
+
+    index = catalog.index()
+    page, next_cursor = firmware_page(index, limit, LIST_SORTS[sort], min_key, max_key, after, match)
+    if fields:
+        wanted = list(dict.fromkeys(["version"] + [name.strip() for name in fields.split(",") if name.strip()]))
+        page = [{name: fw[name] for name in wanted if name in fw} for fw in page]
+    result = {"firmwares": page, "count": len(page), "next_cursor": next_cursor}
+    # Tổng số chỉ có sẵn (O(log n)) khi lọc theo khoảng version; các bộ lọc khác cần duyệt hết
+    if match is None:
+        result["total"] = index.sorted_count(min_key, max_key)
+        if min_key is None and max_key is None:
+            result["total_size"] = index.total_size
+    return FastJSONResponse(result)
 
 @app.post("/api/upload")
 async def upload_firmware(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     version: str = None,
     description: str = None,
+    channel: str = None,
+    rollout: Optional[float] = None,
     api_key: str = Depends(require_api_key)
 ):
     """
     Upload firmware mới lên server
     Yêu cầu API key (chỉ admin/developer)
+    rollout: phần trăm device được nhận ngay (mặc định 100), đổi sau bằng /rollout
     """
     if not version:
         raise HTTPException(status_code=400, detail="Thiếu tham số version")
+    if rollout is not None and not 0 <= rollout <= 100:
+        raise HTTPException(status_code=400, detail="rollout phải trong khoảng 0-100")
     
-    # Kiểm tra kích thước file
-    content = await file.read()
-    if len(content) > MAX_UPLOAD_SIZE:
-        raise HTTPException(
-            status_code=413, 
-            detail=f"File quá lớn. Kích thước tối đa: {MAX_UPLOAD_SIZE / 1024 / 1024:.1f} MB"
-        )
-    
-    # Lưu file
-    file_path = FIRMWARE_DIR / file.filename
-    with open(file_path, "wb") as f:
-        f.write(content)
-    
-    # Tính checksum và size
-    checksum = calculate_checksum(file_path)
-    size = file_path.stat().st_size
+    # Ghi file theo chunk ra file tạm, tính checksum và size trong cùng một lượt
+    # (dừng với 413 ngay khi vượt MAX_UPLOAD_SIZE)
+    filename = Path(file.filename).name
+    tmp_path, checksum, size = await stream_to_temp(file, FIRMWARE_DIR, MAX_UPLOAD_SIZE, UPLOAD_CHUNK_SIZE)
     
-    # Cập nhật metadata
-    metadata = load_metadata()
-    firmwares = metadata.get("firmwares", [])
+    # Cả chuỗi lưu blob -> cập nhật catalog -> xóa bytes cũ nằm trong khóa ghi catalog:
+    # worker khác đang xóa version cuối cùng dùng blob này không thể xóa blob
+    # giữa lúc put thấy blob đã có và lúc version mới được ghi vào catalog
+    with catalog.write_lock():
+        # Lưu vào kho theo SHA256 (atomic rename), nội dung trùng thì không ghi lần hai
+        blob_store.put(tmp_path, checksum)
+
+        # Cập nhật metadata
+        existing = catalog.index().get(version)
+        if existing:
+            # Cập nhật thông tin
+            firmware = dict(existing)
+            firmware.update({
+                "filename": filename,
+                "blob": checksum,
+                "size": size,
+                "checksum": checksum,
+                "description": description or existing.get("description", ""),
+            })
+            if channel:
+                firmware["channel"] = channel
+        else:
+            # Thêm firmware mới
+            firmware = {
+                "version": version,
+                "filename": filename,
+                "blob": checksum,
+                "size": size,
+                "checksum": checksum,
+                "description": description or "",
+                "channel": channel or DEFAULT_CHANNEL,
+                "release_date": datetime.now().isoformat()
+            }
+        if rollout is not None:
+            if rollout >= 100:
+                firmware.pop("rollout", None)
+            else:
+                firmware["rollout"] = {"percentage": rollout}
+
+        catalog.upsert(firmware)
+
+        # Xóa bytes cũ nếu không còn version nào dùng
+        if existing:
+            release_storage(existing)
+
+    # Tạo bản nén gzip/zstd ở background, tải về sẽ chọn theo Accept-Encoding
+    if PRECOMPRESS_FIRMWARE:
+        background_tasks.add_task(build_variants, blob_store.path_for(checksum))
     
-    # Kiểm tra xem version đã tồn tại chưa
-    existing = next((f for f in firmwares if f["version"] == version), None)
-    if existing:
-        # Xóa file cũ nếu có
-        old_file = FIRMWARE_DIR / existing["filename"]
-        if old_file.exists() and old_file != file_path:
-            old_file.unlink()
-        # Cập nhật thông tin
-        existing.update({
-            "filename": file.filename,
-            "size": size,
-            "checksum": checksum,
-            "description": description or existing.get("description", ""),
-        })
-    else:
-        # Thêm firmware mới
-        from datetime import datetime
-        firmwares.append({
+    return {
+        "message": "Upload firmware thành công",
+        "firmware_info": {
             "version": version,
-            "filename": file.filename,
+            "filename": filename,
             "size": size,
             "checksum": checksum,
-            "description": description or "",
-            "release_date": datetime.now().isoformat()
-        })
+            "channel": firmware_channel(firmware),
+            "rollout_percentage": rollout_percentage(firmware)
+        }
+    }
+
+@app.put("/api/firmware/{version}/rollout")
+async def update_rollout(
+    version: str,
+    rollout: RolloutUpdate,
+    api_key: str = Depends(require_api_key)
+):
+    """
+    Đổi phần trăm rollout của firmware (không cần upload lại)
+    Yêu cầu API key (chỉ admin/developer)
+
+    schedule: các bước {at, percentage} tự tăng phần trăm theo thời gian,
+    ví dụ 10% ngay, 50% sau 6 giờ, 100% sau 24 giờ.
+    """
+    firmware = catalog.index().get(version)
+    if not firmware:
+        raise HTTPException(status_code=404, detail="Không tìm thấy firmware")
     
-    metadata["firmwares"] = firmwares
-    save_metadata(metadata)
+    firmware = dict(firmware)
+    if rollout.percentage >= 100 and not rollout.schedule:
+        firmware.pop("rollout", None)
+    else:
+        entry = {"percentage": rollout.percentage}
+        if rollout.schedule:
+            # Lưu giờ local dạng isoformat (giống release_date) để so sánh theo chuỗi
+            entry["schedule"] = [
+                {
+                    "at": (step.at.astimezone().replace(tzinfo=None) if step.at.tzinfo else step.at).isoformat(),
+                    "percentage": step.percentage
+                }
+                for step in sorted(rollout.schedule, key=lambda step: step.at.timestamp())
+            ]
+        firmware["rollout"] = entry
+    
+    catalog.upsert(firmware)
     
     return {
-        "message": "Upload firmware thành công",
+        "message": f"Đã cập nhật rollout firmware {version}",
+        "version": version,
+        "rollout": firmware.get("rollout"),
+        "rollout_percentage": rollout_percentage(firmware)
+    }
+
+@app.post("/api/firmware/{version}/promote")
+async def promote_firmware(
+    version: str,
+    promote: PromoteRequest,
+    api_key: str = Depends(require_api_key)
+):
+    """
+    Promote một build có sẵn sang version và/hoặc channel khác
+    Chỉ tạo entry metadata mới trỏ đến cùng file, không copy bytes
+    Yêu cầu API key (chỉ admin/developer)
+    """
+    index = catalog.index()
+    source = index.get(version)
+    if not source:
+        raise HTTPException(status_code=404, detail="Không tìm thấy firmware")
+    
+    target_version = promote.version or version
+    if not promote.version and not promote.channel:
+        raise HTTPException(status_code=400, detail="Cần version hoặc channel đích")
+    try:
+        parse_version(target_version)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Phiên bản không hợp lệ: {target_version}")
+    
+    replaced = index.get(target_version) if target_version != version else None
+    if replaced and storage_key(replaced) != storage_key(source):
+        raise HTTPException(status_code=409, detail=f"Version {target_version} đã tồn tại")
+    
+    firmware = dict(source)
+    firmware["version"] = target_version
+    if promote.channel:
+        firmware["channel"] = promote.channel
+    if promote.description is not None:
+        firmware["description"] = promote.description
+    if target_version != version:
+        firmware["release_date"] = datetime.now().isoformat()
+        firmware["promoted_from"] = version
+    
+    catalog.upsert(firmware)
+    
+    return {
+        "message": f"Đã promote firmware {version} -> {target_version}",
         "firmware_info": {
-            "version": version,
-            "filename": file.filename,
-            "size": size,
-            "checksum": checksum
+            "version": target_version,
+            "filename": firmware["filename"],
+            "size": firmware["size"],
+            "checksum": firmware["checksum"],
+            "channel": firmware.get("channel", DEFAULT_CHANNEL)
         }
     }
 
@@ -356,28 +1158,34 @@ async def delete_firmware(
 ):
     """
     Xóa firmware theo phiên bản
+    Bytes chỉ bị xóa khi không còn version nào khác trỏ đến
     Yêu cầu API key (chỉ admin/developer)
     """
-    metadata = load_metadata()
-    firmwares = metadata.get("firmwares", [])
-    
-    firmware = next((f for f in firmwares if f["version"] == version), None)
+    # Xóa entry và bytes trong cùng khóa ghi để upload song song không dùng lại blob sắp bị xóa
+    with catalog.write_lock():
+        firmware = catalog.remove(version)
+        if firmware:
+            # Xóa file nếu không còn được dùng
+            release_storage(firmware)
     
     if not firmware:
         raise HTTPException(status_code=404, detail="Không tìm thấy firmware")
     
-    # Xóa file
-    file_path = FIRMWARE_DIR / firmware["filename"]
-    if file_path.exists():
-        file_path.unlink()
-    
-    # Xóa khỏi metadata
-    firmwares = [f for f in firmwares if f["version"] != version]
-    metadata["firmwares"] = firmwares
-    save_metadata(metadata)
-    
     return {"message": f"Đã xóa firmware version {version}"}
 
 if __name__ == "__main__":
-    uvicorn.run(app, host=SERVER_HOST, port=SERVER_PORT)
+    if SERVER_WORKERS > 1 and METADATA_BACKEND == "json":
+        print("Cảnh báo: nhiều worker với metadata JSON sẽ ghi lại cả file mỗi lần upload, "
+              "nên dùng OTA_METADATA_BACKEND=sqlite")
+    # Nhiều worker cần app dạng "module:attr" để mỗi process tự import
+    uvicorn.run(
+        "main:app" if SERVER_WORKERS > 1 else app,
+        app_dir=str(Path(__file__).parent),
+        host=SERVER_HOST,
+        port=SERVER_PORT,
+        workers=SERVER_WORKERS,
+        limit_concurrency=LIMIT_CONCURRENCY or None,
+        backlog=SERVER_BACKLOG,
+        timeout_keep_alive=KEEPALIVE_TIMEOUT
+    )
 
@@ -0,0 +1,217 @@
+"""
+Backend lưu metadata firmware
+- JsonMetadataStore: file metadata.json (mặc định, giống trước đây)
+- SqliteMetadataStore: SQLite ở chế độ WAL, upsert theo từng dòng trong transaction
+"""
+import json
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Optional
+
+from locks import FileLock, file_stamp
+
+
+class JsonMetadataStore:
+    """Lưu toàn bộ metadata trong một file JSON"""
+
+    name = "json"
+
+    def __init__(self, metadata_file: Path):
+        self.metadata_file = Path(metadata_file)
+        self._write_lock = FileLock(self.metadata_file.with_name(self.metadata_file.name + ".lock"))
+
+    def write_lock(self) -> FileLock:
+        """Khóa giữa các process cho chuỗi đọc-sửa-ghi catalog"""
+        return self._write_lock
+
+    def change_token(self):
+        """Dấu hiệu thay đổi của file: (inode, mtime_ns, size)"""
+        return file_stamp(self.metadata_file)
+
+    def load(self) -> dict:
+        if self.metadata_file.exists():
+            with open(self.metadata_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        return {"firmwares": []}
+
+    def save(self, metadata: dict):
+        """Ghi cả file qua file tạm rồi os.replace (atomic)"""
+        tmp_file = self.metadata_file.with_name(self.metadata_file.name + ".tmp")
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(metadata, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_file, self.metadata_file)
+
+    def upsert(self, firmware: dict, metadata: dict):
+        """metadata: toàn bộ metadata sau khi cập nhật (JSON phải ghi lại cả file)"""
+        self.save(metadata)
+
+    def delete(self, version: str, metadata: dict):
+        self.save(metadata)
+
+
+class SqliteMetadataStore:
+    """
+    Lưu metadata trong SQLite (WAL)
+
+    Mỗi firmware là một dòng, các cột version/filename/checksum/release_date
+    có index, toàn bộ entry được giữ trong cột data (JSON) để không mất field.
+    Ở chế độ WAL người đọc không chặn người ghi, và upload/delete chỉ ghi
+    đúng một dòng trong transaction thay vì ghi lại cả catalog.
+    """
+
+    name = "sqlite"
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS firmwares (
+        version TEXT PRIMARY KEY,
+        filename TEXT NOT NULL,
+        checksum TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        release_date TEXT,
+        data TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_firmwares_filename ON firmwares(filename);
+    CREATE INDEX IF NOT EXISTS idx_firmwares_checksum ON firmwares(checksum);
+    CREATE INDEX IF NOT EXISTS idx_firmwares_release_date ON firmwares(release_date);
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    """
+
+    UPSERT_SQL = """
+    INSERT INTO firmwares (version, filename, checksum, size, release_date, data)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(version) DO UPDATE SET
+        filename = excluded.filename,
+        checksum = excluded.checksum,
+        size = excluded.size,
+        release_date = excluded.release_date,
+        data = excluded.data
+    """
+
+    def __init__(self, db_file: Path, json_file: Optional[Path] = None):
+        self.db_file = Path(db_file)
+        self._lock = threading.Lock()
+        self._write_lock = FileLock(self.db_file.with_name(self.db_file.name + ".lock"))
+        self._conn = sqlite3.connect(
+            str(self.db_file),
+            timeout=30,
+            isolation_level=None,
+            check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        if json_file is not None:
+            self.migrate_from_json(json_file)
+
+    @staticmethod
+    def _row(firmware: dict) -> tuple:
+        return (
+            firmware["version"],
+            firmware.get("filename", ""),
+            firmware.get("checksum", ""),
+            int(firmware.get("size", 0)),
+            firmware.get("release_date"),
+            json.dumps(firmware, ensure_ascii=False),
+        )
+
+    def write_lock(self) -> FileLock:
+        """
+        Khóa giữa các process cho chuỗi đọc-sửa-ghi catalog
+        Mỗi lệnh ghi đã là một transaction, khóa này giữ cho change token
+        đọc sau khi ghi không bỏ sót commit của process khác
+        """
+        return self._write_lock
+
+    def change_token(self):
+        """PRAGMA data_version đổi khi connection khác (process khác) commit"""
+        with self._lock:
+            return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def load(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute("SELECT data FROM firmwares ORDER BY rowid").fetchall()
+        return {"firmwares": [json.loads(row[0]) for row in rows]}
+
+    def save(self, metadata: dict):
+        """Thay toàn bộ catalog trong một transaction"""
+        rows = [self._row(f) for f in metadata.get("firmwares", [])]
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM firmwares")
+                self._conn.executemany(self.UPSERT_SQL, rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def upsert(self, firmware: dict, metadata: Optional[dict] = None):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(self.UPSERT_SQL, self._row(firmware))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def delete(self, version: str, metadata: Optional[dict] = None):
+        with self._lock:
+            self._conn.execute("DELETE FROM firmwares WHERE version = ?", (version,))
+
+    def migrate_from_json(self, json_file: Path, force: bool = False) -> int:
+        """
+        Import metadata.json vào database (chỉ chạy một lần)
+        Trả về số firmware đã import
+        """
+        json_file = Path(json_file)
+        with self._lock:
+            done = self._conn.execute(
+                "SELECT value FROM meta WHERE key = 'migrated_from_json'"
+            ).fetchone()
+        if (done and not force) or not json_file.exists():
+            return 0
+
+        metadata = JsonMetadataStore(json_file).load()
+        rows = [self._row(f) for f in metadata.get("firmwares", [])]
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(self.UPSERT_SQL, rows)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated_from_json', ?)",
+                    (str(json_file),)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return len(rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def open_metadata_store(backend: str, metadata_file: Path, db_file: Path):
+    """Tạo backend metadata theo cấu hình (json hoặc sqlite)"""
+    if backend == "sqlite":
+        return SqliteMetadataStore(db_file, json_file=metadata_file)
+    if backend == "json":
+        return JsonMetadataStore(metadata_file)
+    raise ValueError(f"Metadata backend không hỗ trợ: {backend}")
+
+
+if __name__ == "__main__":
+    # Migrate thủ công: python metadata_store.py [--force]
+    import sys
+    from config import METADATA_FILE, METADATA_DB_FILE
+
+    store = SqliteMetadataStore(METADATA_DB_FILE)
+    count = store.migrate_from_json(METADATA_FILE, force="--force" in sys.argv)
+    print(f"Đã import {count} firmware từ {METADATA_FILE} vào {METADATA_DB_FILE}")
@@ -0,0 +1,315 @@
+"""
+Metrics trong process theo định dạng text của Prometheus (/metrics)
+
+Counter/Gauge/Histogram tự viết, không cần prometheus_client: mỗi lần ghi chỉ là
+một lần tra dict và vài phép cộng dưới lock, đủ rẻ để gọi trên mọi request.
+Số liệu tính theo từng worker process; Prometheus scrape worker nào thì thấy số
+của worker đó.
+"""
+import abc
+import asyncio
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+# Bucket mặc định (giây), từ 100µs đến 10s
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric(abc.ABC):
+    """Phần chung: tên, mô tả, label và các child theo giá trị label"""
+
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    @abc.abstractmethod
+    def _new_child(self):
+        """Child mới cho một bộ giá trị label"""
+
+    def labels(self, *values):
+        """Child theo giá trị label (tạo lần đầu, sau đó chỉ là một lần tra dict)"""
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    @abc.abstractmethod
+    def _samples(self):
+        """[(hậu tố tên, chuỗi label, giá trị)]"""
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for suffix, labels, value in self._samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class _Value:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(_Metric):
+    """Bộ đếm chỉ tăng"""
+
+    type_name = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def _samples(self):
+        return [("_total" if not self.name.endswith("_total") else "",
+                 _format_labels(self.labelnames, values), child.value)
+                for values, child in list(self._children.items())]
+
+
+class Gauge(_Metric):
+    """Giá trị tức thời; có thể lấy từ một hàm lúc scrape (set_function)"""
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._function: Optional[Callable[[], float]] = None
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self.labels().dec(amount)
+
+    def set_function(self, function: Callable[[], float]):
+        """Lấy giá trị bằng function() mỗi lần scrape (không tốn gì trên đường request)"""
+        self._function = function
+
+    def _samples(self):
+        if self._function is not None:
+            return [("", "", float(self._function()))]
+        return [("", _format_labels(self.labelnames, values), child.value)
+                for values, child in list(self._children.items())]
+
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "count", "_lock")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Histogram(_Metric):
+    """Histogram với bucket cố định (cộng dồn lúc render, không lúc observe)"""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _samples(self):
+        samples = []
+        for values, child in list(self._children.items()):
+            with child._lock:
+                counts = list(child.counts)
+                total, count = child.sum, child.count
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="' + _format_value(bound) + '"'
+                samples.append(("_bucket", _format_labels(self.labelnames, values, le), cumulative))
+            labels = _format_labels(self.labelnames, values)
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, count))
+        return samples
+
+
+def render() -> str:
+    """Toàn bộ metrics theo định dạng text của Prometheus (version 0.0.4)"""
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+# Metrics dùng chung giữa các module
+HTTP_REQUESTS = Counter("ota_http_requests_total", "Số HTTP request theo route, method và status",
+                        ["route", "method", "status"])
+HTTP_LATENCY = Histogram("ota_http_request_duration_seconds", "Thời gian xử lý request (đến byte cuối)",
+                         ["route", "method"])
+HTTP_IN_FLIGHT = Gauge("ota_http_requests_in_flight", "Số request đang xử lý")
+HTTP_BYTES_SENT = Counter("ota_http_response_bytes_total", "Bytes body đã gửi theo route", ["route"])
+FIRMWARE_BYTES_SENT = Counter("ota_firmware_bytes_sent_total", "Bytes firmware/patch đã gửi theo version",
+                              ["kind", "version"])
+DOWNLOADS_IN_FLIGHT = Gauge("ota_downloads_in_flight", "Số download firmware/patch đang gửi")
+UPLOAD_HASH_SECONDS = Histogram("ota_upload_hash_seconds", "Thời gian tính SHA256 của một upload")
+UPLOAD_BYTES = Counter("ota_upload_bytes_total", "Bytes firmware đã nhận qua upload")
+METADATA_LOAD_SECONDS = Histogram("ota_metadata_load_seconds", "Thời gian đọc lại metadata từ backend")
+AUTH_SECONDS = Histogram("ota_auth_seconds", "Thời gian xác thực theo kết quả", ["scheme"])
+EVENT_LOOP_LAG = Gauge("ota_event_loop_lag_seconds", "Độ trễ event loop lần đo gần nhất")
+EVENT_LOOP_LAG_HISTOGRAM = Histogram("ota_event_loop_lag_distribution_seconds", "Phân bố độ trễ event loop")
+
+
+async def monitor_event_loop(interval: float = 0.5):
+    """Đo độ trễ event loop: thời gian ngủ thực tế trừ thời gian hẹn"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - started - interval)
+        EVENT_LOOP_LAG.set(lag)
+        EVENT_LOOP_LAG_HISTOGRAM.observe(lag)
+
+
+class MetricsMiddleware:
+    """
+    Đo latency, status và bytes gửi đi của mọi HTTP request (ASGI thuần)
+
+    Route lấy theo path template (/api/download/{version}) để số series không
+    phụ thuộc URL. transfer_routes: {path template: (kind, tên path param chứa
+    version)} của các route tải firmware, bytes của chúng được đếm thêm theo version.
+
+    Middleware chỉ chạy trên event loop nên cập nhật thẳng các series của mình,
+    không qua lock; series của mỗi (route, method, status) được tra một lần rồi giữ lại.
+    """
+
+    in_flight = 0
+
+    def __init__(self, app, transfer_routes: Optional[Dict[str, Tuple[str, str]]] = None):
+        self.app = app
+        self.transfer_routes = transfer_routes or {}
+        self._route_paths = None
+        self._series = {}
+
+    def _route_of(self, scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "other"
+        if self._route_paths is None:
+            paths = {}
+            for route in getattr(scope.get("app"), "routes", ()):
+                target = getattr(route, "endpoint", None) or getattr(route, "app", None)
+                if target is not None:
+                    paths.setdefault(target, getattr(route, "path", "other") or "/")
+            self._route_paths = paths
+        return self._route_paths.get(endpoint, "other")
+
+    def _series_for(self, route: str, method: str, status: int):
+        key = (route, method, status)
+        series = self._series.get(key)
+        if series is None:
+            series = (
+                HTTP_LATENCY.labels(route, method),
+                HTTP_REQUESTS.labels(route, method, str(status)),
+                HTTP_BYTES_SENT.labels(route),
+            )
+            self._series[key] = series
+        return series
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+        sent = 0
+
+        async def counting_send(message):
+            nonlocal status, sent
+            message_type = message["type"]
+            if message_type == "http.response.body":
+                sent += len(message.get("body", b""))
+            elif message_type == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        MetricsMiddleware.in_flight += 1
+        try:
+            await self.app(scope, receive, counting_send)
+        finally:
+            MetricsMiddleware.in_flight -= 1
+            elapsed = time.perf_counter() - started
+            route = self._route_of(scope)
+            latency, requests, sent_bytes = self._series_for(route, scope["method"], status)
+            latency.counts[bisect_left(latency.buckets, elapsed)] += 1
+            latency.sum += elapsed
+            latency.count += 1
+            requests.value += 1
+            if sent:
+                sent_bytes.value += sent
+                transfer = self.transfer_routes.get(route)
+                if transfer is not None and status in (200, 206):
+                    kind, param = transfer
+                    version = scope.get("path_params", {}).get(param, "")
+                    FIRMWARE_BYTES_SENT.labels(kind, version).inc(sent)
+
+
+HTTP_IN_FLIGHT.set_function(lambda: MetricsMiddleware.in_flight)
@@ -0,0 +1,117 @@
+"""
+Thông báo firmware mới cho thiết bị (Server-Sent Events và long-poll)
+
+Mọi kết nối đang chờ cùng await một asyncio.Future: khi catalog đổi, event loop
+chỉ set_result một lần và đánh thức tất cả, không có task hay thread riêng cho
+từng kết nối. Sự kiện chỉ chứa version mới nhất của mỗi channel (kèm phần trăm
+rollout nếu đang rollout dở) và khoảng "spread" (giây) để thiết bị tự rải lần
+check-update, tránh dồn request.
+"""
+import asyncio
+import hashlib
+import json
+from typing import Callable, Optional
+
+
+class UpdateBroadcaster:
+    """
+    Phát sự kiện "catalog thay đổi" tới mọi subscriber trên event loop
+
+    notify() gọi được từ thread bất kỳ (listener của catalog); nhiều lần notify
+    liên tiếp được gộp lại, và sự kiện chỉ được phát khi nội dung tóm tắt
+    (version mới nhất mỗi channel, phần trăm rollout) thực sự đổi.
+    """
+
+    def __init__(self, summary: Callable[[], dict], check_rate: float, max_spread: float):
+        """
+        Args:
+            summary: Hàm trả về {"channels": {channel: version mới nhất}, "rollout": {version: %}}
+            check_rate: Số check-update mỗi giây server muốn nhận sau một thông báo
+            max_spread: Giới hạn trên của spread (giây)
+        """
+        self.summary = summary
+        self.check_rate = check_rate
+        self.max_spread = max_spread
+        self._loop = None
+        self._future = None
+        self._pending = False
+        self.event = None
+        self.subscribers = 0
+        self.published = 0
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        """Gắn với event loop của server (gọi lúc startup)"""
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self._future = loop.create_future()
+        if self.event is None:
+            self.event = self._make_event(self.summary())
+
+    @staticmethod
+    def event_id(summary: dict) -> str:
+        """
+        Id sự kiện lấy từ nội dung (không phải bộ đếm) nên giống nhau ở mọi worker,
+        thiết bị kết nối lại vào worker khác vẫn so sánh được Last-Event-ID
+        """
+        data = json.dumps(summary, sort_keys=True).encode()
+        return hashlib.sha256(data).hexdigest()[:16]
+
+    def _make_event(self, summary: dict) -> dict:
+        spread = min(self.max_spread, self.subscribers / self.check_rate) if self.check_rate > 0 else 0.0
+        event = {"id": self.event_id(summary)}
+        event.update(summary)
+        event["spread"] = round(spread, 1)
+        return event
+
+    def notify(self):
+        """Báo catalog có thể đã đổi (thread-safe)"""
+        loop = self._loop
+        if loop is None or self._pending:
+            return
+        self._pending = True
+        try:
+            loop.call_soon_threadsafe(self._publish)
+        except RuntimeError:
+            # Event loop đã đóng (server đang tắt)
+            self._pending = False
+
+    def _publish(self):
+        self._pending = False
+        summary = self.summary()
+        if self.event is not None and self.event["id"] == self.event_id(summary):
+            return
+        self.event = self._make_event(summary)
+        self.published += 1
+        future, self._future = self._future, self._loop.create_future()
+        future.set_result(self.event)
+
+    async def wait(self, last_event_id: Optional[str], timeout: float) -> Optional[dict]:
+        """
+        Chờ sự kiện tiếp theo
+
+        Nếu thiết bị đã bỏ lỡ sự kiện hiện tại (last_event_id khác) thì trả về ngay.
+        Hết timeout thì trả về None.
+        """
+        self.bind(asyncio.get_running_loop())
+        if last_event_id and self.event is not None and self.event["id"] != last_event_id:
+            return self.event
+        self.subscribers += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(self._future), timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self.subscribers -= 1
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": self.subscribers,
+            "published": self.published,
+            "event_id": self.event["id"] if self.event else None,
+        }
+
+
+def sse_message(event: dict) -> str:
+    """Định dạng một sự kiện SSE"""
+    return f"id: {event['id']}\nevent: catalog\ndata: {json.dumps(event)}\n\n"
@@ -0,0 +1,78 @@
+"""
+Gợi ý lịch polling cho thiết bị (next_check_after trong kết quả check-update)
+
+Mỗi device có một slot cố định trong chu kỳ polling, tính từ SHA256(device_id)
+và neo theo giờ hệ thống: thiết bị khởi động cùng lúc (ví dụ sau mất điện) vẫn
+gọi lại vào các thời điểm khác nhau, và request được rải đều trên cả chu kỳ.
+Chu kỳ kéo dài ra khi tốc độ check-update vượt mức server muốn nhận.
+"""
+import hashlib
+import random
+import time
+from typing import Optional
+
+
+class PollScheduler:
+    """
+    Tính next_check_after (giây) cho từng device
+
+    - base_interval: chu kỳ polling khi server không tải nặng
+    - max_interval: chu kỳ dài nhất khi quá tải
+    - target_rate: số check-update mỗi giây server muốn nhận (mỗi worker)
+    """
+
+    # Khoảng đo tốc độ request (giây)
+    RATE_WINDOW = 10.0
+
+    def __init__(self, base_interval: float, max_interval: float, target_rate: float):
+        self.base_interval = base_interval
+        self.max_interval = max(max_interval, base_interval)
+        self.target_rate = target_rate
+        self.rate = 0.0
+        self._count = 0
+        self._window_start = time.monotonic()
+
+    def record(self):
+        """Ghi nhận một lần check-update (dùng để ước lượng tải)"""
+        self._count += 1
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed >= self.RATE_WINDOW:
+            self.rate = 0.7 * self.rate + 0.3 * self._count / elapsed
+            self._count = 0
+            self._window_start = now
+
+    def interval(self) -> float:
+        """Chu kỳ polling hiện tại: dài ra theo tỉ lệ tốc độ request / target_rate"""
+        if self.target_rate <= 0:
+            return self.base_interval
+        load = max(1.0, self.rate / self.target_rate)
+        return min(self.base_interval * load, self.max_interval)
+
+    @staticmethod
+    def device_slot(device_id: Optional[str]) -> float:
+        """Vị trí cố định của device trong chu kỳ, trong [0, 1)"""
+        if not device_id:
+            return random.random()
+        digest = hashlib.sha256(b"poll:" + device_id.encode()).digest()
+        return int.from_bytes(digest[:8], "big") / 2 ** 64
+
+    def next_check_after(self, device_id: Optional[str], now: Optional[float] = None) -> int:
+        """
+        Số giây đến slot tiếp theo của device
+
+        Slot neo theo giờ hệ thống (time.time()) nên giống nhau ở mọi worker.
+        Slot quá gần (dưới 1/4 chu kỳ) thì dời sang chu kỳ sau, tránh gọi lại ngay.
+        """
+        window = self.interval()
+        now = time.time() if now is None else now
+        delay = (self.device_slot(device_id) * window - now) % window
+        if delay < window / 4:
+            delay += window
+        return max(1, int(delay))
+
+    def stats(self) -> dict:
+        return {
+            "check_rate": round(self.rate, 2),
+            "interval": round(self.interval(), 1),
+        }
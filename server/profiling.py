@@ -0,0 +1,198 @@
+"""
+Profile từng request (cProfile) và theo dõi cấp phát bộ nhớ (tracemalloc)
+
+Bật theo tỉ lệ mẫu (PROFILE_SAMPLE_RATE) hoặc cho một request bằng header
+X-Profile kèm API key hợp lệ:
+    X-Profile: cpu      cProfile, ghi file .prof (pstats)
+    X-Profile: memory   tracemalloc, ghi snapshot .tracemalloc và top cấp phát .txt
+
+cProfile đo theo thread: request async chạy trên event loop nên các request khác
+chạy xen kẽ cũng xuất hiện trong profile, còn phần chạy trong threadpool (dependency
+sync, ghi file) thì không. Mỗi lúc chỉ một request được profile.
+
+Route stream/truyền file (SSE, long-poll, download, patch) không bao giờ được
+profile: request có thể kéo dài hàng phút, chiếm slot profile suốt thời gian đó
+và phần lớn profile chỉ là thời gian chờ mạng.
+"""
+import cProfile
+import io
+import pstats
+import random
+import re
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, List, Optional
+
+import anyio
+
+PROFILE_SUFFIXES = (".prof", ".tracemalloc", ".txt")
+
+# Route stream/truyền file, không profile (xem docstring module)
+UNPROFILED_PATHS = ("/api/updates/stream", "/api/updates/poll")
+UNPROFILED_PREFIXES = ("/api/download/", "/api/patch/")
+
+
+class RequestProfiler:
+    """Chọn request cần profile, ghi kết quả vào thư mục xoay vòng"""
+
+    def __init__(self, directory: Path, sample_rate: float, max_files: int,
+                 trace_uploads: bool, verify_key: Callable[[str], bool]):
+        self.directory = Path(directory)
+        self.sample_rate = sample_rate
+        self.max_files = max_files
+        self.trace_uploads = trace_uploads
+        self.verify_key = verify_key
+        self._busy = False
+        self.captured = 0
+        self.skipped_busy = 0
+
+    def mode_for(self, scope) -> Optional[str]:
+        """"cpu", "memory" hoặc None (không profile request này)"""
+        path = scope["path"]
+        if path in UNPROFILED_PATHS or path.startswith(UNPROFILED_PREFIXES):
+            return None
+        requested = None
+        api_key = None
+        for name, value in scope["headers"]:
+            if name == b"x-profile":
+                requested = value.decode("latin-1").strip().lower()
+            elif name == b"x-api-key":
+                api_key = value.decode("latin-1")
+        if requested and api_key and self.verify_key(api_key):
+            return "memory" if requested == "memory" else "cpu"
+        if self.trace_uploads and scope["method"] == "POST" and path == "/api/upload":
+            return "memory"
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return "cpu"
+        return None
+
+    def _file_stem(self, scope, elapsed: float) -> str:
+        route = re.sub(r"[^A-Za-z0-9]+", "_", scope["path"]).strip("_")[:60] or "root"
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        return f"{stamp}-{int(time.time() * 1000) % 1000:03d}-{scope['method']}-{route}-{elapsed * 1000:.0f}ms"
+
+    async def run(self, mode: str, app, scope, receive, send):
+        """Chạy request dưới profiler (bỏ qua nếu đang có request khác được profile)"""
+        if self._busy:
+            self.skipped_busy += 1
+            await app(scope, receive, send)
+            return
+        self._busy = True
+        try:
+            if mode == "memory":
+                await self._run_tracemalloc(app, scope, receive, send)
+            else:
+                await self._run_cprofile(app, scope, receive, send)
+        finally:
+            self._busy = False
+
+    async def _run_cprofile(self, app, scope, receive, send):
+        profile = cProfile.Profile()
+        started = time.perf_counter()
+        profile.enable()
+        try:
+            await app(scope, receive, send)
+        finally:
+            profile.disable()
+            path = self.directory / (self._file_stem(scope, time.perf_counter() - started) + ".prof")
+            await anyio.to_thread.run_sync(self._save, profile.dump_stats, path)
+
+    async def _run_tracemalloc(self, app, scope, receive, send):
+        was_tracing = tracemalloc.is_tracing()
+        if not was_tracing:
+            tracemalloc.start(25)
+        tracemalloc.reset_peak()
+        started = time.perf_counter()
+        try:
+            await app(scope, receive, send)
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            if not was_tracing:
+                tracemalloc.stop()
+            stem = self._file_stem(scope, time.perf_counter() - started)
+            await anyio.to_thread.run_sync(self._save_snapshot, snapshot, peak, stem)
+
+    def _save(self, dump: Callable[[str], None], path: Path):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        dump(str(path))
+        self.captured += 1
+        self._rotate()
+
+    def _save_snapshot(self, snapshot, peak: int, stem: str):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        snapshot.dump(str(self.directory / (stem + ".tracemalloc")))
+        lines = [f"Peak traced memory: {peak / 1024:.1f} KB", ""]
+        for stat in snapshot.statistics("lineno")[:25]:
+            lines.append(str(stat))
+        (self.directory / (stem + ".txt")).write_text("\n".join(lines) + "\n", encoding="utf-8")
+        self.captured += 1
+        self._rotate()
+
+    def list_profiles(self) -> List[dict]:
+        """Các file profile, mới nhất trước"""
+        if not self.directory.exists():
+            return []
+        files = [p for p in self.directory.iterdir() if p.suffix in PROFILE_SUFFIXES]
+        files.sort(key=lambda p: p.stat().st_mtime, reverse=True)
+        return [
+            {"name": p.name, "size": p.stat().st_size, "created": p.stat().st_mtime}
+            for p in files
+        ]
+
+    def _rotate(self):
+        """Chỉ giữ max_files profile mới nhất (các file cùng một profile bị xóa cùng nhau)"""
+        groups = {}
+        for path in self.directory.iterdir():
+            if path.suffix in PROFILE_SUFFIXES:
+                mtime = path.stat().st_mtime
+                paths, newest = groups.get(path.stem, ([], 0.0))
+                paths.append(path)
+                groups[path.stem] = (paths, max(newest, mtime))
+        if len(groups) <= self.max_files:
+            return
+        oldest = sorted(groups.values(), key=lambda group: group[1])
+        for paths, _ in oldest[:len(groups) - self.max_files]:
+            for path in paths:
+                path.unlink(missing_ok=True)
+
+    def path_for(self, name: str) -> Optional[Path]:
+        """Đường dẫn file profile theo tên (chặn path traversal), None nếu không có"""
+        if "/" in name or "\\" in name or name.startswith(".") or Path(name).suffix not in PROFILE_SUFFIXES:
+            return None
+        path = self.directory / name
+        return path if path.is_file() else None
+
+    @staticmethod
+    def pstats_text(path: Path, limit: int = 50, sort: str = "cumulative") -> str:
+        """Tóm tắt file .prof dạng text (top hàm theo sort)"""
+        out = io.StringIO()
+        stats = pstats.Stats(str(path), stream=out)
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def stats(self) -> dict:
+        return {
+            "sample_rate": self.sample_rate,
+            "captured": self.captured,
+            "skipped_busy": self.skipped_busy,
+        }
+
+
+class ProfilingMiddleware:
+    """Middleware ASGI: chạy request dưới RequestProfiler khi được chọn"""
+
+    def __init__(self, app, profiler: RequestProfiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        mode = self.profiler.mode_for(scope)
+        if mode is None:
+            await self.app(scope, receive, send)
+            return
+        await self.profiler.run(mode, self.app, scope, receive, send)
@@ -0,0 +1,85 @@
+"""
+Rollout theo phần trăm (staged rollout)
+
+Entry firmware có thể có field "rollout":
+    {"percentage": 10, "schedule": [{"at": "2024-05-01T08:00:00", "percentage": 50}, ...]}
+Không có field này nghĩa là 100%. Các bước trong schedule (sắp xếp theo "at",
+giờ local dạng isoformat như release_date) thay percentage khi đến giờ.
+
+Mỗi device thuộc một bucket cố định trong [0, BUCKETS) tính từ SHA256(device_id),
+device được nhận firmware khi bucket < percentage. Tăng percentage chỉ thêm
+device mới vào nhóm được nhận, không device nào bị rút ra.
+"""
+import hashlib
+from datetime import datetime
+from typing import Optional
+
+from catalog import firmware_channel
+
+BUCKETS = 10000
+
+
+def device_bucket(device_id: str) -> int:
+    """Bucket cố định của device, O(1)"""
+    digest = hashlib.sha256(device_id.encode()).digest()
+    return int.from_bytes(digest[:8], "big") % BUCKETS
+
+
+def rollout_percentage(firmware: dict, now: Optional[str] = None) -> float:
+    """Phần trăm rollout hiện tại của firmware (theo schedule nếu có)"""
+    rollout = firmware.get("rollout")
+    if not rollout:
+        return 100.0
+    percentage = rollout.get("percentage", 100.0)
+    schedule = rollout.get("schedule")
+    if schedule:
+        now = now or datetime.now().isoformat()
+        for step in schedule:
+            if step["at"] > now:
+                break
+            percentage = step["percentage"]
+    return float(percentage)
+
+
+def is_eligible(firmware: dict, bucket: Optional[int], now: Optional[str] = None) -> bool:
+    """
+    Device (theo bucket) có được nhận firmware không
+    Device không rõ device_id (bucket None) chỉ nhận firmware đã rollout 100%
+    """
+    percentage = rollout_percentage(firmware, now)
+    if percentage >= 100:
+        return True
+    if bucket is None or percentage <= 0:
+        return False
+    return bucket < percentage * BUCKETS / 100
+
+
+def rollout_target(index, current_key: tuple, channel: str, device_id: Optional[str],
+                   now: Optional[str] = None) -> Optional[dict]:
+    """
+    Firmware mới nhất trong channel, có version > current_key, mà device được nhận
+
+    Trường hợp thường gặp (bản mới nhất đã rollout 100%) chỉ tốn một lần tra index;
+    khi bản mới nhất đang rollout dở thì lùi dần về các bản cũ hơn.
+    """
+    newest = index.newest_greater(current_key, channel)
+    if newest is None or "rollout" not in newest:
+        return newest
+    now = now or datetime.now().isoformat()
+    bucket = device_bucket(device_id) if device_id else None
+    for firmware in index.newer_than(current_key):
+        if firmware_channel(firmware) == channel and is_eligible(firmware, bucket, now):
+            return firmware
+    return None
+
+
+def rollout_summary(index, channels: dict, now: Optional[str] = None) -> dict:
+    """{version: percentage} của các bản mới nhất mỗi channel đang rollout dở"""
+    summary = {}
+    for version in channels.values():
+        firmware = index.get(version)
+        if firmware is not None and "rollout" in firmware:
+            percentage = rollout_percentage(firmware, now)
+            if percentage < 100:
+                summary[version] = percentage
+    return summary
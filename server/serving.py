@@ -0,0 +1,363 @@
+"""
+Phục vụ file firmware: Range/If-Range (206), ETag mạnh theo checksum, 304
+ETag và digest lấy từ checksum trong catalog nên không phụ thuộc cách lưu file
+
+Ảnh firmware đang hot được giữ trong ImageCache (LRU theo dung lượng), còn
+lại đọc từ disk theo chunk CHUNK_SIZE.
+Bản nén sẵn (compression.py) được chọn theo Accept-Encoding.
+Khi có DownloadLimiter (admission.py), body chỉ được gửi sau khi xin được slot,
+và đi qua token bucket băng thông nếu có giới hạn egress.
+"""
+import asyncio
+import base64
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Optional, Tuple
+from urllib.parse import quote
+
+import anyio
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+
+from admission import AdmittedResponse
+from compression import SUFFIXES, choose_encoding, variant_path
+
+# Chunk đọc file/gửi body: uvicorn không hỗ trợ sendfile nên mỗi chunk là một lần
+# đọc trong threadpool và một lần send; 256 KB giảm chi phí đó khoảng 2.5 lần so với
+# 64 KB (mặc định của FileResponse) mà bộ nhớ mỗi lượt tải vẫn nhỏ
+CHUNK_SIZE = 256 * 1024
+
+
+class ImageCache:
+    """
+    Cache bytes firmware trong RAM, LRU giới hạn theo tổng dung lượng
+
+    Khóa là checksum (kèm encoding với bản nén) nên nội dung không bao giờ cũ:
+    chỉ bỏ entry khi bytes bị xóa khỏi disk (discard), còn lại để LRU tự đẩy ra.
+    Khi cache trượt, chỉ một request đọc file (load), các request khác cùng khóa
+    chờ kết quả đó thay vì mỗi request tự đọc cả ảnh vào RAM.
+    """
+
+    def __init__(self, max_bytes: int, max_item_bytes: int):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        # Khóa đang được đọc từ disk -> Future chứa bytes (None nếu đọc lỗi)
+        self._loading = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_from_ram = 0
+        self.bytes_from_disk = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._items.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.max_item_bytes or len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                return
+            self._items[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= len(evicted)
+                self.evictions += 1
+
+    async def load(self, key: str, read: Callable[[], bytes]) -> Optional[bytes]:
+        """
+        Bytes của key, cache trượt thì đọc bằng read() trong threadpool (một lần cho
+        mọi request đồng thời cùng khóa). Lượt đọc lỗi thì request đọc nhận exception,
+        các request đang chờ nhận None và tự đọc từ disk.
+        """
+        data = self.get(key)
+        if data is not None:
+            return data
+        future = self._loading.get(key)
+        if future is not None:
+            # shield: request chờ bị hủy không hủy lượt đọc dùng chung
+            return await asyncio.shield(future)
+        future = asyncio.get_running_loop().create_future()
+        self._loading[key] = future
+        try:
+            data = await anyio.to_thread.run_sync(read)
+            self.put(key, data)
+        finally:
+            del self._loading[key]
+            future.set_result(data)
+        return data
+
+    def discard(self, checksum: str):
+        """Bỏ ảnh theo checksum (cả bản nén) khi bytes của nó bị xóa"""
+        with self._lock:
+            for key in [k for k in self._items if k == checksum or k.startswith(checksum + ":")]:
+                self._size -= len(self._items.pop(key))
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._items),
+            "bytes_cached": self._size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "bytes_from_ram": self.bytes_from_ram,
+            "bytes_from_disk": self.bytes_from_disk,
+        }
+
+
+def read_file(file_path: Path) -> bytes:
+    with open(file_path, "rb") as f:
+        return f.read()
+
+
+def firmware_etag(firmware: dict) -> str:
+    """ETag mạnh = checksum SHA256 của firmware"""
+    return f'"{firmware["checksum"]}"'
+
+
+def digest_header(checksum: str) -> str:
+    """Header Digest (RFC 3230): sha-256=<base64>"""
+    return "sha-256=" + base64.b64encode(bytes.fromhex(checksum)).decode()
+
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    """So khớp If-None-Match (danh sách ETag hoặc *), chấp nhận cả dạng W/"..." """
+    if not header:
+        return False
+    header = header.strip()
+    if header == "*":
+        return True
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def if_range_matches(header: str, checksum: str) -> bool:
+    """
+    So khớp If-Range (chỉ ETag mạnh) với checksum của firmware
+
+    Chấp nhận cả ETag của bản nén ("<checksum>-gzip"...): client lưu ETag của lần
+    tải trước, nội dung sau giải nén vẫn trùng từng byte với bản gốc.
+    """
+    tag = header.strip()
+    if not (tag.startswith('"') and tag.endswith('"')):
+        return False
+    value, _, encoding = tag[1:-1].partition("-")
+    return value == checksum and (not encoding or encoding in SUFFIXES)
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse header Range, trả về (start, end) bao gồm cả end
+
+    Chỉ hỗ trợ một khoảng byte; header không hợp lệ hoặc nhiều khoảng thì
+    trả về None (gửi toàn bộ file, được phép theo RFC 9110).
+    Khoảng nằm ngoài file thì raise RangeNotSatisfiable (416).
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    start_s, sep, end_s = spec.strip().partition("-")
+    start_s, end_s = start_s.strip(), end_s.strip()
+    # Chỉ chấp nhận số không dấu; "bytes=-", "bytes=--5" là cú pháp sai
+    if not sep or not (start_s.isdigit() or end_s.isdigit()):
+        return None
+    if (start_s and not start_s.isdigit()) or (end_s and not end_s.isdigit()):
+        return None
+    if start_s == "":
+        # bytes=-N: N byte cuối
+        length = int(end_s)
+        if length <= 0 or size == 0:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+    start = int(start_s)
+    end = int(end_s) if end_s else size - 1
+    if start >= size or start > end:
+        raise RangeNotSatisfiable()
+    return start, min(end, size - 1)
+
+
+def content_disposition(filename: str) -> str:
+    """
+    Content-Disposition giống FileResponse của Starlette: tên có ký tự ngoài ASCII
+    (hoặc cần escape) được gửi dạng RFC 5987 filename*=utf-8''...
+    Dấu ngoặc kép và CR/LF bị bỏ để không phá header.
+    """
+    filename = filename.replace('"', "").replace("\r", "").replace("\n", "")
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+async def iter_bytes(data: bytes, start: int, length: int, throttle=None):
+    """Trả về đoạn [start, start + length) của ảnh trong RAM theo chunk"""
+    view = memoryview(data)
+    end = start + length
+    for offset in range(start, end, CHUNK_SIZE):
+        chunk = bytes(view[offset:min(offset + CHUNK_SIZE, end)])
+        if throttle is not None:
+            await throttle(len(chunk))
+        yield chunk
+
+
+async def iter_file(file_path: Path, start: int, length: int, throttle=None):
+    """Đọc file theo chunk trong khoảng [start, start + length)"""
+    async with await anyio.open_file(file_path, "rb") as f:
+        await f.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = await f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            if throttle is not None:
+                await throttle(len(chunk))
+            yield chunk
+
+
+async def firmware_response(request: Request, firmware: dict, file_path: Path,
+                            cache: Optional[ImageCache] = None, limiter=None,
+                            client_key: Optional[str] = None) -> Response:
+    """
+    Tạo response tải firmware có hỗ trợ Range, If-Range và If-None-Match
+
+    Khi không có Range và client chấp nhận gzip/zstd, gửi bản nén sẵn (nếu có)
+    với Content-Encoding, Content-Length và ETag riêng của bản nén đó.
+    304/416 không cần slot; response có body phải qua limiter (503 nếu quá tải).
+    """
+    encoding = None
+    range_header = request.headers.get("range")
+    if not range_header:
+        encoding = choose_encoding(request.headers.get("accept-encoding"), file_path)
+
+    if encoding:
+        # Mỗi representation có ETag mạnh riêng
+        etag = f'"{firmware["checksum"]}-{encoding}"'
+        file_path = variant_path(file_path, encoding)
+        cache_key = f'{firmware["checksum"]}:{encoding}'
+    else:
+        etag = firmware_etag(firmware)
+        cache_key = firmware["checksum"]
+
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Vary": "Accept-Encoding",
+        "Digest": digest_header(firmware["checksum"]),
+        "X-Firmware-Checksum": firmware["checksum"],
+        "X-Firmware-Size": str(firmware["size"]),
+        "X-Firmware-Version": firmware["version"],
+    }
+    if encoding:
+        headers["Content-Encoding"] = encoding
+
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    if limiter is not None:
+        busy = limiter.admit(client_key)
+        if busy is not None:
+            return busy
+        try:
+            response = await _body_response(request, firmware, file_path, cache, headers,
+                                             cache_key, range_header, limiter)
+        except BaseException:
+            limiter.release_callback()()
+            raise
+        if response.status_code >= 300:
+            limiter.release_callback()()
+            return response
+        return AdmittedResponse(response, limiter.release_callback())
+    return await _body_response(request, firmware, file_path, cache, headers,
+                                cache_key, range_header, None)
+
+
+async def _body_response(request: Request, firmware: dict, file_path: Path, cache: Optional[ImageCache],
+                         headers: dict, cache_key: str, range_header: Optional[str],
+                         limiter) -> Response:
+    """Phần gửi body của firmware_response (200/206, hoặc 416)"""
+    throttle = limiter.throttle if limiter is not None and limiter.shaping else None
+
+    # Ảnh hot được phục vụ từ RAM, lần đầu đọc từ disk rồi đưa vào cache
+    data = None
+    if cache is not None and cache.enabled:
+        data = cache.get(cache_key)
+        if data is None and firmware["size"] <= cache.max_item_bytes:
+            data = await cache.load(cache_key, lambda: read_file(file_path))
+    size = len(data) if data is not None else file_path.stat().st_size
+
+    headers["Content-Disposition"] = content_disposition(firmware["filename"])
+
+    byte_range = None
+    if range_header:
+        if_range = request.headers.get("if-range")
+        # If-Range không khớp firmware hiện tại: bỏ qua Range, gửi toàn bộ file
+        if if_range is None or if_range_matches(if_range, firmware["checksum"]):
+            try:
+                byte_range = parse_range(range_header, size)
+            except RangeNotSatisfiable:
+                headers["Content-Range"] = f"bytes */{size}"
+                return Response(status_code=416, headers=headers)
+
+    if byte_range is None:
+        start, length, status_code = 0, size, 200
+    else:
+        start, end = byte_range
+        length = end - start + 1
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+    headers["Content-Length"] = str(length)
+    if data is not None:
+        cache.bytes_from_ram += length
+        if status_code == 200 and throttle is None:
+            return Response(content=data, headers=headers, media_type="application/octet-stream")
+        return StreamingResponse(
+            iter_bytes(data, start, length, throttle),
+            status_code=status_code,
+            headers=headers,
+            media_type="application/octet-stream"
+        )
+
+    if cache is not None:
+        cache.bytes_from_disk += length
+    return StreamingResponse(
+        iter_file(file_path, start, length, throttle),
+        status_code=status_code,
+        headers=headers,
+        media_type="application/octet-stream"
+    )
@@ -0,0 +1,105 @@
+"""
+Xử lý upload firmware theo kiểu streaming
+Ghi từng chunk ra file tạm, tính SHA256 và size trong cùng một lượt
+"""
+import hashlib
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from fastapi import HTTPException, UploadFile
+from fastapi.responses import JSONResponse
+
+from metrics import UPLOAD_BYTES, UPLOAD_HASH_SECONDS
+
+# Phần dư cho header/boundary của multipart khi so với MAX_UPLOAD_SIZE
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+def too_large_detail(max_size: int) -> str:
+    return f"File quá lớn. Kích thước tối đa: {max_size / 1024 / 1024:.1f} MB"
+
+
+async def stream_to_temp(file: UploadFile, dest_dir: Path, max_size: int, chunk_size: int):
+    """
+    Đọc upload theo chunk, ghi ra file tạm trong dest_dir
+
+    Dừng với 413 ngay khi vượt max_size. File tạm nằm cùng filesystem với
+    kho firmware nên có thể os.replace() vào vị trí thật một cách atomic.
+
+    Returns:
+        (đường dẫn file tạm, checksum SHA256, size)
+    """
+    fd, tmp_name = tempfile.mkstemp(dir=dest_dir, prefix=".upload-", suffix=".part")
+    tmp_path = Path(tmp_name)
+    sha256_hash = hashlib.sha256()
+    size = 0
+    hash_seconds = 0.0
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while True:
+                chunk = await file.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_size:
+                    raise HTTPException(status_code=413, detail=too_large_detail(max_size))
+                started = time.perf_counter()
+                sha256_hash.update(chunk)
+                hash_seconds += time.perf_counter() - started
+                f.write(chunk)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    UPLOAD_HASH_SECONDS.observe(hash_seconds)
+    UPLOAD_BYTES.inc(size)
+    return tmp_path, sha256_hash.hexdigest(), size
+
+
+class UploadSizeLimitMiddleware:
+    """
+    Chặn upload quá lớn trước khi multipart được parse
+
+    - Content-Length vượt giới hạn: trả 413 ngay, không đọc body
+    - Không có Content-Length (chunked): đếm byte khi nhận, vượt thì dừng với 413
+    """
+
+    def __init__(self, app, path: str, max_size: int):
+        self.app = app
+        self.path = path
+        self.limit = max_size + MULTIPART_OVERHEAD
+        self.max_size = max_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] != self.path:
+            await self.app(scope, receive, send)
+            return
+
+        for name, value in scope["headers"]:
+            if name == b"content-length":
+                try:
+                    content_length = int(value)
+                except ValueError:
+                    break
+                if content_length > self.limit:
+                    response = JSONResponse(
+                        status_code=413,
+                        content={"detail": too_large_detail(self.max_size)}
+                    )
+                    await response(scope, receive, send)
+                    return
+                break
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.limit:
+                    raise HTTPException(status_code=413, detail=too_large_detail(self.max_size))
+            return message
+
+        await self.app(scope, limited_receive, send)
@@ -0,0 +1,104 @@
+"""
+Cấu hình chung cho test: thêm server/ và client/ vào sys.path
+(client/ đặt sau vì có config.py riêng trùng tên với server/config.py)
+
+Thư mục firmware/auth/profiles của server được trỏ vào thư mục tạm trước khi
+bất kỳ test nào import main, nên test không ghi gì vào repo.
+"""
+import io
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT / "server"))
+sys.path.append(str(ROOT / "client"))
+
+_TMP_ROOT = tempfile.TemporaryDirectory(prefix="ota-tests-")
+os.environ["OTA_FIRMWARE_DIR"] = os.path.join(_TMP_ROOT.name, "firmware")
+os.environ["OTA_AUTH_DIR"] = os.path.join(_TMP_ROOT.name, "auth")
+os.environ["PROFILE_DIR"] = os.path.join(_TMP_ROOT.name, "profiles")
+os.environ["JWT_SECRET"] = "test-secret"
+
+
+@pytest.fixture(scope="session")
+def server():
+    """Module main của server (import một lần cho cả phiên test)"""
+    import main
+    return main
+
+
+@pytest.fixture(scope="session")
+def api_client(server):
+    """(TestClient, headers có API key hợp lệ)"""
+    from fastapi.testclient import TestClient
+    api_key = server.generate_api_key("tests")
+    return TestClient(server.app), {"X-API-Key": api_key}
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def metadata_backend(request, server, monkeypatch, tmp_path):
+    """
+    Chạy test với catalog trên backend OTA_METADATA_BACKEND=json|sqlite
+    (database/file riêng trong thư mục tạm của test)
+    """
+    from catalog import FirmwareCatalog
+    from metadata_store import open_metadata_store
+
+    store = open_metadata_store(request.param, tmp_path / "metadata.json", tmp_path / "metadata.db")
+    catalog = FirmwareCatalog(store)
+    catalog.add_listener(server.response_cache.clear)
+    catalog.add_listener(server.update_broadcaster.notify)
+    monkeypatch.setattr(server, "catalog", catalog)
+    server.response_cache.clear()
+    yield request.param
+    server.response_cache.clear()
+    if hasattr(store, "close"):
+        store.close()
+
+
+@pytest.fixture
+def upload(api_client):
+    """upload(version, data, filename="fw.bin", **params) -> response của /api/upload"""
+    client, headers = api_client
+
+    def post(version: str, data: bytes, filename: str = "fw.bin", **params):
+        params["version"] = version
+        return client.post("/api/upload", params=params, headers=headers,
+                           files={"file": (filename, io.BytesIO(data))})
+    return post
+
+
+@pytest.fixture
+def device_http(api_client, monkeypatch):
+    """
+    Chuyển requests.get/post của client/ota_client.py sang TestClient của server
+    Trả về list các request đã gửi: (method, url, headers)
+    """
+    import requests
+    import ota_client
+
+    client, _ = api_client
+    sent = []
+
+    def forward(method):
+        def call(url, headers=None, params=None, json=None, **kwargs):
+            sent.append((method, url, dict(headers or {})))
+            r = client.request(method, url.replace("http://testserver", ""),
+                               headers=headers, params=params, json=json)
+            response = requests.models.Response()
+            response.status_code = r.status_code
+            # TestClient đã giải nén body
+            response.headers = requests.structures.CaseInsensitiveDict(
+                {k: v for k, v in r.headers.items() if k != "content-encoding"})
+            response.raw = io.BytesIO(r.content)
+            response.url = url
+            return response
+        return call
+
+    monkeypatch.setattr(ota_client.requests, "get", forward("GET"))
+    monkeypatch.setattr(ota_client.requests, "post", forward("POST"))
+    return sent
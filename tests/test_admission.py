@@ -0,0 +1,97 @@
+"""Giới hạn tải firmware: 503 + Retry-After và trả slot (admission.py)"""
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+import serving
+from admission import DownloadLimiter, TokenBucket
+from serving import CHUNK_SIZE, ImageCache
+
+
+def test_token_bucket_take_and_reserve():
+    bucket = TokenBucket(rate=10, burst=2)
+    assert bucket.try_take() == 0
+    assert bucket.try_take() == 0
+    wait = bucket.try_take()
+    assert 0 < wait <= 0.1
+    # reserve luôn lấy token, các lượt sau xếp hàng chờ lâu hơn
+    first = bucket.reserve(5)
+    second = bucket.reserve(5)
+    assert 0 < first < second
+
+
+@pytest.fixture
+def limited(server, api_client, upload, monkeypatch):
+    """Server với DOWNLOAD_MAX_CONCURRENT=1 và một firmware 12.0.0"""
+    limiter = DownloadLimiter(1, 0, 0, CHUNK_SIZE)
+    monkeypatch.setattr(server, "download_limiter", limiter)
+    data = os.urandom(4096)
+    assert upload("12.0.0", data).status_code == 200
+    client, auth = api_client
+    return client, {**auth, "Accept-Encoding": "identity"}, limiter, data
+
+
+def test_busy_when_concurrency_cap_reached(limited):
+    client, auth, limiter, data = limited
+    assert limiter.admit("someone-else") is None
+    response = client.get("/api/download/12.0.0", headers=auth)
+    assert response.status_code == 503
+    assert int(response.headers["retry-after"]) >= 1
+    assert limiter.rejected_busy == 1
+
+    limiter.release_callback()()
+    response = client.get("/api/download/12.0.0", headers=auth)
+    assert response.status_code == 200
+    assert response.content == data
+    assert limiter.active == 0
+
+
+def test_busy_when_device_rate_exhausted(server, api_client, upload, monkeypatch):
+    limiter = DownloadLimiter(0, 1, 0, CHUNK_SIZE)
+    monkeypatch.setattr(server, "download_limiter", limiter)
+    assert upload("12.1.0", os.urandom(512)).status_code == 200
+    client, auth = api_client
+    headers = {**auth, "Accept-Encoding": "identity"}
+    assert client.get("/api/download/12.1.0", headers=headers).status_code == 200
+    response = client.get("/api/download/12.1.0", headers=headers)
+    assert response.status_code == 503
+    assert int(response.headers["retry-after"]) >= 1
+    assert limiter.rejected_rate == 1
+    assert limiter.active == 0
+
+
+def test_slot_released_after_304_206_and_416(limited):
+    client, auth, limiter, data = limited
+    etag = client.get("/api/download/12.0.0", headers=auth).headers["etag"]
+    assert client.get("/api/download/12.0.0", headers={**auth, "If-None-Match": etag}).status_code == 304
+    assert client.get("/api/download/12.0.0", headers={**auth, "Range": "bytes=100-199"}).status_code == 206
+    assert client.get("/api/download/12.0.0", headers={**auth, "Range": "bytes=9999-"}).status_code == 416
+    assert limiter.active == 0
+    # Slot vẫn dùng được sau các lượt trên
+    assert client.get("/api/download/12.0.0", headers=auth).status_code == 200
+
+
+def test_slot_released_when_response_fails(server, limited, monkeypatch):
+    _, auth, limiter, _ = limited
+    client = TestClient(server.app, raise_server_exceptions=False)
+
+    # Lỗi trước khi gửi header (đọc ảnh vào cache thất bại)
+    def broken_read(path):
+        raise OSError("disk error")
+
+    monkeypatch.setattr(server, "image_cache", ImageCache(1 << 20, 1 << 20))
+    monkeypatch.setattr(serving, "read_file", broken_read)
+    assert client.get("/api/download/12.0.0", headers=auth).status_code == 500
+    assert limiter.active == 0
+
+    # Lỗi giữa lúc stream body từ disk
+    async def broken_stream(*args, **kwargs):
+        yield b"partial"
+        raise OSError("disk error")
+
+    monkeypatch.setattr(server, "image_cache", ImageCache(0, 0))
+    monkeypatch.setattr(serving, "iter_file", broken_stream)
+    with pytest.raises(Exception):
+        TestClient(server.app).get("/api/download/12.0.0", headers=auth)
+    assert limiter.active == 0
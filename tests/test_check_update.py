@@ -0,0 +1,119 @@
+"""check-update: cache kết quả không có update, ETag/304 (main.py)"""
+import os
+
+import ota_client
+
+
+def test_no_update_body_is_cached_before_computing(server, upload):
+    assert upload("9.0.0", os.urandom(64), channel="cache-test").status_code == 200
+    index = server.catalog.index()
+    body, etag = server.check_update_body(index, "9.0.0", "cache-test", "device-a")
+    hits = server.response_cache.hits
+    # Lần sau (device khác) trả đúng body đó từ cache
+    assert server.check_update_body(index, "9.0.0", "cache-test", "device-b") == (body, etag)
+    assert server.response_cache.hits == hits + 1
+
+
+def test_device_dependent_results_are_not_cached(server, upload):
+    assert upload("9.1.0", os.urandom(64), channel="cache-rollout").status_code == 200
+    assert upload("9.2.0", os.urandom(64), channel="cache-rollout", rollout=0).status_code == 200
+    index = server.catalog.index()
+    # 9.2.0 đang rollout 0%: device chưa được nhận, kết quả phụ thuộc device nên không cache
+    body, _ = server.check_update_body(index, "9.1.0", "cache-rollout", "device-a")
+    assert b'"update_available":false' in body
+    key = (server.catalog.generation, "check-update", "9.1.0", "cache-rollout")
+    assert server.response_cache.lookup(key) is None
+
+
+def get_check(client, auth, etag=None, **params):
+    headers = dict(auth)
+    if etag:
+        headers["If-None-Match"] = etag
+    return client.get("/api/check-update", params=params, headers=headers)
+
+
+def test_304_has_no_body_but_keeps_poll_hint(api_client, upload):
+    client, auth = api_client
+    assert upload("13.0.0", os.urandom(64), channel="etag-304").status_code == 200
+    params = {"current_version": "13.0.0", "channel": "etag-304", "device_id": "device-1"}
+    first = get_check(client, auth, **params)
+    assert first.status_code == 200
+    etag = first.headers["etag"]
+    assert etag.startswith('W/"')
+    assert first.json()["next_check_after"] == int(first.headers["x-next-check-after"])
+
+    again = get_check(client, auth, etag, **params)
+    assert again.status_code == 304
+    assert again.content == b""
+    assert again.headers["etag"] == etag
+    assert int(again.headers["x-next-check-after"]) > 0
+
+
+def test_etag_changes_with_rollout_step(api_client, upload):
+    client, auth = api_client
+    channel = "etag-rollout"
+    assert upload("13.1.0", os.urandom(64), channel=channel).status_code == 200
+    assert upload("13.2.0", os.urandom(64), channel=channel, rollout=0).status_code == 200
+    params = {"current_version": "13.1.0", "channel": channel, "device_id": "device-2"}
+    before = get_check(client, auth, **params)
+    assert before.json()["update_available"] is False
+
+    # Bước schedule đã tới giờ: device được nhận 13.2.0, ETag cũ không còn khớp
+    response = client.put("/api/firmware/13.2.0/rollout", headers=auth, json={
+        "percentage": 0, "schedule": [{"at": "2000-01-01T00:00:00", "percentage": 100}]})
+    assert response.status_code == 200
+    after = get_check(client, auth, before.headers["etag"], **params)
+    assert after.status_code == 200
+    assert after.json()["firmware_info"]["version"] == "13.2.0"
+    assert after.headers["etag"] != before.headers["etag"]
+
+
+def test_etag_changes_when_patch_becomes_available(server, api_client, upload):
+    client, auth = api_client
+    channel = "etag-patch"
+    base = os.urandom(64 * 1024)
+    assert upload("13.3.0", base, channel=channel).status_code == 200
+    assert upload("13.4.0", base[:1000] + b"changed" + base[1007:], channel=channel).status_code == 200
+    params = {"current_version": "13.3.0", "channel": channel}
+    before = get_check(client, auth, **params)
+    assert "patch" not in before.json()["firmware_info"]
+
+    # Đợi patch được tạo ở background
+    server.patch_store._executor.submit(lambda: None).result(timeout=30)
+    after = get_check(client, auth, before.headers["etag"], **params)
+    assert after.status_code == 200
+    assert after.json()["firmware_info"]["patch"]["base_version"] == "13.3.0"
+    assert after.headers["etag"] != before.headers["etag"]
+
+
+def test_client_reuses_result_on_304(api_client, upload, device_http, monkeypatch, tmp_path):
+    client, auth = api_client
+    assert upload("13.5.0", os.urandom(64), channel="stable").status_code == 200
+    monkeypatch.chdir(tmp_path)
+    device = ota_client.OTAClient("http://testserver", device_id="device-3", api_key=auth["X-API-Key"])
+    device.current_version = "0.0.1"
+    first = device.check_update()
+    second = device.check_update()
+    assert second["update_available"] is True
+    assert second["firmware_info"] == first["firmware_info"]
+    _, _, headers = device_http[-1]
+    assert headers["If-None-Match"] == device._check_etag
+    assert device.next_check_after is not None
+
+
+def test_client_falls_back_to_post_on_405(api_client, upload, device_http, monkeypatch, tmp_path):
+    client, auth = api_client
+    assert upload("13.6.0", os.urandom(64), channel="stable").status_code == 200
+    def old_server_get(url, **kwargs):
+        device_http.append(("GET", url, dict(kwargs.get("headers") or {})))
+        response = ota_client.requests.models.Response()
+        response.status_code = 405
+        return response
+
+    monkeypatch.setattr(ota_client.requests, "get", old_server_get)
+    monkeypatch.chdir(tmp_path)
+    device = ota_client.OTAClient("http://testserver", device_id="device-4", api_key=auth["X-API-Key"])
+    device.current_version = "0.0.1"
+    result = device.check_update()
+    assert [method for method, _, _ in device_http] == ["GET", "POST"]
+    assert result["update_available"] is True
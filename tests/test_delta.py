@@ -0,0 +1,73 @@
+"""Patch OTAPATCH1: make_patch của server phải giải được bằng cả hai apply_patch"""
+import hashlib
+import random
+
+import pytest
+
+import delta
+from ota_client import apply_patch as client_apply_patch
+
+_rng = random.Random(1234)
+BASE = bytes(_rng.getrandbits(8) for _ in range(64 * 1024))
+
+
+def _edit(data: bytes, offset: int, new: bytes) -> bytes:
+    return data[:offset] + new + data[offset + len(new):]
+
+
+CASES = {
+    "identical": (BASE, BASE),
+    "small_edits": (BASE, _edit(_edit(BASE, 100, b"\x00" * 7), 40000, b"patched")),
+    "insertion": (BASE, BASE[:5000] + b"inserted block" * 50 + BASE[5000:]),
+    "deletion": (BASE, BASE[:1000] + BASE[9000:]),
+    "appended": (BASE, BASE + b"\xff" * 3000),
+    "truncated": (BASE, BASE[:12345]),
+    "reordered": (BASE, BASE[32768:] + BASE[:32768]),
+    "unrelated": (BASE, bytes(_rng.getrandbits(8) for _ in range(20000))),
+    "empty_base": (b"", BASE[:4096]),
+    "empty_target": (BASE, b""),
+    "shorter_than_block": (b"abc", b"abcd"),
+}
+
+
+@pytest.mark.parametrize("name", list(CASES))
+@pytest.mark.parametrize("decode", [delta.apply_patch, client_apply_patch], ids=["server", "client"])
+def test_patch_round_trip(name, decode):
+    base, target = CASES[name]
+    patch = delta.make_patch(base, target)
+    rebuilt = decode(base, patch)
+    assert rebuilt == target
+    assert hashlib.sha256(rebuilt).hexdigest() == hashlib.sha256(target).hexdigest()
+
+
+def test_similar_images_give_small_patch():
+    base, target = CASES["small_edits"]
+    assert len(delta.make_patch(base, target)) < len(target) // 10
+
+
+@pytest.mark.parametrize("decode", [delta.apply_patch, client_apply_patch], ids=["server", "client"])
+def test_bad_magic_rejected(decode):
+    patch = delta.make_patch(BASE, BASE)
+    with pytest.raises(ValueError):
+        decode(BASE, b"NOTPATCH1" + patch[len(delta.PATCH_MAGIC):])
+
+
+def test_two_stores_sharing_patch_dir_publish_a_valid_patch(tmp_path):
+    """Hai worker (PatchStore riêng, chung PATCH_DIR) cùng tạo một cặp"""
+    base, target = CASES["small_edits"]
+    base_path, target_path = tmp_path / "base.bin", tmp_path / "target.bin"
+    base_path.write_bytes(base)
+    target_path.write_bytes(target)
+    base_sum, target_sum = hashlib.sha256(base).hexdigest(), hashlib.sha256(target).hexdigest()
+    stores = [delta.PatchStore(tmp_path / "patches", 1 << 20) for _ in range(2)]
+    for store in stores:
+        store.schedule(base_path, base_sum, target_path, target_sum)
+    for store in stores:
+        store._executor.submit(lambda: None).result(timeout=30)
+
+    assert not list((tmp_path / "patches").glob("*.tmp"))
+    for store in stores:
+        entry = store.lookup(base_sum, target_sum)
+        patch = store.path_for(entry).read_bytes()
+        assert hashlib.sha256(patch).hexdigest() == entry["checksum"]
+        assert delta.apply_patch(base, patch) == target
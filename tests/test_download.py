@@ -0,0 +1,173 @@
+"""Tải firmware: Range/If-Range, ETag và Content-Disposition (serving.py)"""
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from urllib.parse import quote
+
+import pytest
+
+import ota_client
+from serving import ImageCache, RangeNotSatisfiable, content_disposition, etag_matches, if_range_matches, parse_range
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 999)),
+    ("bytes=900-5000", (900, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=-5000", (0, 999)),
+    ("bytes=999-999", (999, 999)),
+    ("BYTES = 10-19", (10, 19)),
+    # Không hợp lệ hoặc không hỗ trợ: bỏ qua Range, gửi toàn bộ file
+    ("bytes=0-9,20-29", None),
+    ("items=0-9", None),
+    ("bytes=a-b", None),
+    ("bytes=10", None),
+    ("bytes=--5", None),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header, size", [
+    ("bytes=1000-", 1000),
+    ("bytes=20-10", 1000),
+    ("bytes=-0", 1000),
+    ("bytes=0-", 0),
+    ("bytes=-10", 0),
+])
+def test_parse_range_not_satisfiable(header, size):
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range(header, size)
+
+
+def test_etag_matches():
+    assert etag_matches('"abc"', '"abc"')
+    assert etag_matches('W/"abc"', '"abc"')
+    assert etag_matches('"x", "abc"', '"abc"')
+    assert etag_matches("*", '"abc"')
+    assert not etag_matches('"abcd"', '"abc"')
+    assert not etag_matches(None, '"abc"')
+
+
+def test_if_range_matches_any_representation_of_checksum():
+    assert if_range_matches('"abc"', "abc")
+    assert if_range_matches('"abc-gzip"', "abc")
+    assert if_range_matches('"abc-zstd"', "abc")
+    assert not if_range_matches('"abc-br"', "abc")
+    assert not if_range_matches('W/"abc"', "abc")
+    assert not if_range_matches('"abcd"', "abc")
+
+
+def test_content_disposition():
+    assert content_disposition("fw.bin") == 'attachment; filename="fw.bin"'
+    assert content_disposition("bản_mới.bin") == "attachment; filename*=utf-8''" + quote("bản_mới.bin")
+    header = content_disposition('a"b\r\nX-Injected: 1.bin')
+    assert "\r" not in header and "\n" not in header and 'a"b' not in header
+
+
+def test_range_and_if_range(metadata_backend, api_client, upload):
+    client, auth = api_client
+    data = os.urandom(4096)
+    assert upload("6.0.0", data).status_code == 200
+
+    full = client.get("/api/download/6.0.0", headers={**auth, "Accept-Encoding": "identity"})
+    assert full.status_code == 200
+    assert full.content == data
+    etag = full.headers["etag"]
+
+    part = client.get("/api/download/6.0.0", headers={**auth, "Range": "bytes=1000-", "If-Range": etag})
+    assert part.status_code == 206
+    assert part.headers["content-range"] == "bytes 1000-4095/4096"
+    assert part.content == data[1000:]
+
+    # ETag của bản nén cùng checksum vẫn tải tiếp được
+    checksum = full.headers["x-firmware-checksum"]
+    part = client.get("/api/download/6.0.0", headers={**auth, "Range": "bytes=1000-", "If-Range": f'"{checksum}-gzip"'})
+    assert part.status_code == 206
+    assert part.content == data[1000:]
+
+    # If-Range không khớp: gửi lại toàn bộ file
+    stale = client.get("/api/download/6.0.0", headers={**auth, "Range": "bytes=1000-", "If-Range": '"stale"'})
+    assert stale.status_code == 200
+    assert stale.content == data
+
+    unsatisfiable = client.get("/api/download/6.0.0", headers={**auth, "Range": "bytes=5000-"})
+    assert unsatisfiable.status_code == 416
+    assert unsatisfiable.headers["content-range"] == "bytes */4096"
+
+    assert client.get("/api/download/6.0.0", headers={**auth, "If-None-Match": etag}).status_code == 304
+
+
+def test_download_non_ascii_filename(metadata_backend, api_client, upload):
+    client, auth = api_client
+    data = os.urandom(512)
+    assert upload("6.1.0", data, filename="bản_mới.bin").status_code == 200
+    response = client.get("/api/download/6.1.0", headers={**auth, "Accept-Encoding": "identity"})
+    assert response.status_code == 200
+    assert response.content == data
+    assert response.headers["content-disposition"] == "attachment; filename*=utf-8''" + quote("bản_mới.bin")
+
+
+def test_client_resumes_with_identity_etag(api_client, upload, device_http, monkeypatch, tmp_path):
+    client, auth = api_client
+    data = os.urandom(8192)
+    assert upload("6.2.0", data).status_code == 200
+    monkeypatch.chdir(tmp_path)
+    device = ota_client.OTAClient("http://testserver", api_key=auth["X-API-Key"])
+    checksum = hashlib.sha256(data).hexdigest()
+
+    # Lần tải trước bị ngắt và đã lưu ETag của bản gzip
+    (device.download_dir / "firmware_6.2.0.part").write_bytes(data[:3000])
+    (device.download_dir / "firmware_6.2.0.etag").write_text(f'"{checksum}-gzip"')
+    path = device.download_firmware("6.2.0")
+    assert path.read_bytes() == data
+    _, _, headers = device_http[-1]
+    assert headers["Range"] == "bytes=3000-"
+    assert headers["Accept-Encoding"] == "identity"
+
+
+def test_image_cache_reads_once_for_concurrent_misses():
+    cache = ImageCache(max_bytes=1 << 20, max_item_bytes=1 << 20)
+    reads = []
+
+    def read():
+        reads.append(threading.get_ident())
+        time.sleep(0.05)
+        return b"x" * 1000
+
+    async def main():
+        return await asyncio.gather(*(cache.load("abc", read) for _ in range(20)))
+
+    results = asyncio.run(main())
+    assert len(reads) == 1
+    assert all(data == b"x" * 1000 for data in results)
+    assert cache.get("abc") == b"x" * 1000
+
+
+def test_image_cache_waiters_fall_back_when_read_fails():
+    cache = ImageCache(max_bytes=1 << 20, max_item_bytes=1 << 20)
+
+    def read():
+        time.sleep(0.05)
+        raise OSError("disk")
+
+    async def main():
+        return await asyncio.gather(*(cache.load("abc", read) for _ in range(3)), return_exceptions=True)
+
+    first, *others = asyncio.run(main())
+    assert isinstance(first, OSError)
+    assert others == [None, None]
+    assert cache.get("abc") is None
+
+
+def test_image_cache_discard_drops_variants_only_for_checksum():
+    cache = ImageCache(max_bytes=1 << 20, max_item_bytes=1 << 20)
+    for key in ("abc", "abc:gzip", "abd"):
+        cache.put(key, b"123")
+    cache.discard("abc")
+    assert cache.get("abc") is None and cache.get("abc:gzip") is None
+    assert cache.get("abd") == b"123"
+    assert cache.stats()["bytes_cached"] == 3
@@ -0,0 +1,52 @@
+"""Phân trang /api/firmwares và cursor (catalog.py)"""
+import pytest
+
+from catalog import decode_cursor, encode_cursor
+
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor("1.10.0")) == "1.10.0"
+
+
+@pytest.mark.parametrize("cursor", ["!!!", encode_cursor("dev-build"), encode_cursor(""), "%%"])
+def test_invalid_cursor_rejected(cursor):
+    with pytest.raises(ValueError, match="Cursor không hợp lệ"):
+        decode_cursor(cursor)
+
+
+def test_pages_follow_cursor(api_client, upload):
+    client, auth = api_client
+    for version in ("8.1.0", "8.2.0", "8.10.0"):
+        assert upload(version, version.encode()).status_code == 200
+    params = {"limit": 2, "min_version": "8.0.0", "max_version": "8.99.0", "fields": "size"}
+    first = client.get("/api/firmwares", params=params, headers=auth).json()
+    assert [fw["version"] for fw in first["firmwares"]] == ["8.10.0", "8.2.0"]
+    assert first["total"] == 3
+    second = client.get("/api/firmwares", params={**params, "cursor": first["next_cursor"]}, headers=auth).json()
+    assert [fw["version"] for fw in second["firmwares"]] == ["8.1.0"]
+    assert second["next_cursor"] is None
+
+
+def test_invalid_cursor_is_400(api_client):
+    client, auth = api_client
+    response = client.get("/api/firmwares", params={"cursor": "!!!"}, headers=auth)
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Cursor không hợp lệ: !!!"
+
+
+def test_date_only_until_includes_whole_day(server, api_client):
+    client, auth = api_client
+    for version, released in (("8.20.0", "2024-01-30T12:00:00"), ("8.21.0", "2024-01-31T00:00:00"),
+                              ("8.22.0", "2024-01-31T18:45:10.123456"), ("8.23.0", "2024-02-01T00:00:00")):
+        server.catalog.upsert({"version": version, "filename": f"{version}.bin", "size": 1,
+                               "checksum": version, "channel": "dates", "release_date": released})
+    params = {"channel": "dates", "fields": "release_date"}
+
+    def versions(**extra):
+        response = client.get("/api/firmwares", params={**params, **extra}, headers=auth)
+        assert response.status_code == 200
+        return [fw["version"] for fw in response.json()["firmwares"]]
+
+    assert versions(since="2024-01-31", until="2024-01-31") == ["8.22.0", "8.21.0"]
+    assert versions(until="2024-01-31T12:00:00") == ["8.21.0", "8.20.0"]
+    assert versions(since="2024-02-01") == ["8.23.0"]
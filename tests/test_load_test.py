@@ -0,0 +1,32 @@
+"""Thiết bị ảo của utils/load_test.py đối với check-update có ETag"""
+import argparse
+import asyncio
+import sys
+from pathlib import Path
+
+import httpx
+
+sys.path.append(str(Path(__file__).parent.parent / "utils"))
+import load_test  # noqa: E402
+
+
+def test_hint_is_refreshed_on_304(server, api_client, monkeypatch):
+    _, auth = api_client
+    args = argparse.Namespace(server="http://testserver", api_key=auth["X-API-Key"],
+                              download_fraction=0.0, follow_hints=True, poll_interval=60)
+    hints = iter([111, 222])
+    monkeypatch.setattr(server, "poll_hint", lambda device_id: next(hints))
+
+    async def run():
+        tester = load_test.LoadTest(args)
+        device = {"id": "load-device", "version": "0.0.1", "etag": None, "hint": None}
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport) as client:
+            await tester.check(client, device)
+            assert device["hint"] == 111 and device["etag"]
+            await tester.check(client, device)
+        return tester, device
+
+    tester, device = asyncio.run(run())
+    assert tester.recorder.statuses["check_update"] == {200: 1, 304: 1}
+    assert device["hint"] == 222
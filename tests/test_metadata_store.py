@@ -0,0 +1,78 @@
+"""Backend metadata SQLite: import từ metadata.json, upsert/delete, phát hiện thay đổi (metadata_store.py)"""
+import json
+
+import pytest
+
+from catalog import FirmwareCatalog
+from metadata_store import JsonMetadataStore, SqliteMetadataStore
+
+
+def firmware(version: str, **extra) -> dict:
+    entry = {"version": version, "filename": f"{version}.bin", "checksum": "c" + version,
+             "size": 10, "release_date": "2024-01-01T00:00:00"}
+    entry.update(extra)
+    return entry
+
+
+@pytest.fixture
+def open_sqlite(tmp_path):
+    stores = []
+
+    def open_store(json_file=None):
+        store = SqliteMetadataStore(tmp_path / "metadata.db", json_file=json_file)
+        stores.append(store)
+        return store
+    yield open_store
+    for store in stores:
+        store.close()
+
+
+def test_json_import_runs_once(tmp_path, open_sqlite):
+    json_file = tmp_path / "metadata.json"
+    json_file.write_text(json.dumps({"firmwares": [firmware("1.0.0"), firmware("1.1.0", description="mô tả")]}),
+                         encoding="utf-8")
+    store = open_sqlite(json_file)
+    assert store.load()["firmwares"] == [firmware("1.0.0"), firmware("1.1.0", description="mô tả")]
+
+    # metadata.json đổi sau khi đã import: không import lại (database là nguồn chính)
+    json_file.write_text(json.dumps({"firmwares": [firmware("9.9.9")]}), encoding="utf-8")
+    assert [f["version"] for f in open_sqlite(json_file).load()["firmwares"]] == ["1.0.0", "1.1.0"]
+    assert store.migrate_from_json(json_file) == 0
+    assert store.migrate_from_json(json_file, force=True) == 1
+    assert [f["version"] for f in store.load()["firmwares"]] == ["1.0.0", "1.1.0", "9.9.9"]
+
+
+def test_upsert_and_delete_round_trip(open_sqlite):
+    store = open_sqlite()
+    store.upsert(firmware("1.0.0"))
+    store.upsert(firmware("2.0.0", channel="beta"))
+    store.upsert(firmware("1.0.0", description="sửa"))
+    assert store.load()["firmwares"] == [firmware("1.0.0", description="sửa"), firmware("2.0.0", channel="beta")]
+    store.delete("1.0.0")
+    store.delete("404.0.0")
+    assert store.load()["firmwares"] == [firmware("2.0.0", channel="beta")]
+    store.save({"firmwares": [firmware("3.0.0")]})
+    assert store.load()["firmwares"] == [firmware("3.0.0")]
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_catalog_reloads_after_write_from_other_process(backend, tmp_path, open_sqlite):
+    """Ghi qua connection/đối tượng store khác (như worker khác) làm catalog load lại"""
+    if backend == "sqlite":
+        mine, other = open_sqlite(), open_sqlite()
+    else:
+        mine, other = JsonMetadataStore(tmp_path / "metadata.json"), JsonMetadataStore(tmp_path / "metadata.json")
+    catalog = FirmwareCatalog(mine)
+    catalog.upsert(firmware("1.0.0"))
+    assert catalog.index().latest["version"] == "1.0.0"
+    token = mine.change_token()
+    assert catalog.index().latest["version"] == "1.0.0"
+    assert catalog.stats()["reloads"] == 0
+
+    other.save({"firmwares": [firmware("1.0.0"), firmware("2.0.0")]})
+    assert mine.change_token() != token
+    assert catalog.index().latest["version"] == "2.0.0"
+    assert catalog.stats()["reloads"] == 1
+
+    other.delete("2.0.0", {"firmwares": [firmware("1.0.0")]})
+    assert "2.0.0" not in catalog.index()
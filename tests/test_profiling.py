@@ -0,0 +1,28 @@
+"""Chọn request cần profile (profiling.py)"""
+import pytest
+
+from profiling import RequestProfiler
+
+
+def scope(path: str, method: str = "GET", headers=()):
+    return {"type": "http", "method": method, "path": path, "headers": list(headers)}
+
+
+@pytest.fixture
+def profiler(tmp_path):
+    return RequestProfiler(tmp_path, sample_rate=1.0, max_files=5, trace_uploads=True,
+                           verify_key=lambda key: key == "good")
+
+
+def test_regular_requests_are_sampled(profiler):
+    assert profiler.mode_for(scope("/api/check-update")) == "cpu"
+    assert profiler.mode_for(scope("/api/upload", "POST")) == "memory"
+    assert profiler.mode_for(scope("/api/firmwares", headers=[(b"x-profile", b"memory"), (b"x-api-key", b"good")])) == "memory"
+
+
+@pytest.mark.parametrize("path", [
+    "/api/updates/stream", "/api/updates/poll", "/api/download/1.0.0", "/api/patch/1.0.0/2.0.0",
+])
+def test_streaming_routes_are_never_profiled(profiler, path):
+    assert profiler.mode_for(scope(path)) is None
+    assert profiler.mode_for(scope(path, headers=[(b"x-profile", b"cpu"), (b"x-api-key", b"good")])) is None
@@ -0,0 +1,117 @@
+"""Staged rollout theo phần trăm (rollout.py, PUT /api/firmware/{version}/rollout)"""
+import os
+
+from catalog import VersionIndex, parse_version
+from rollout import BUCKETS, device_bucket, is_eligible, rollout_percentage, rollout_target
+
+DEVICES = [f"device-{i:05d}" for i in range(2000)]
+
+
+def firmware(version: str, channel: str = "stable", rollout=None) -> dict:
+    entry = {"version": version, "filename": f"{version}.bin", "checksum": version, "size": 1, "channel": channel}
+    if rollout is not None:
+        entry["rollout"] = rollout
+    return entry
+
+
+def device_in_bucket(low: int, high: int) -> str:
+    """device_id đầu tiên có bucket trong [low, high)"""
+    return next(d for d in DEVICES if low <= device_bucket(d) < high)
+
+
+def test_bucket_is_stable_and_in_range():
+    for device_id in DEVICES[:50]:
+        assert device_bucket(device_id) == device_bucket(device_id)
+        assert 0 <= device_bucket(device_id) < BUCKETS
+    # Phân bố đủ đều để phần trăm có ý nghĩa
+    share = sum(device_bucket(d) < BUCKETS // 2 for d in DEVICES) / len(DEVICES)
+    assert 0.45 < share < 0.55
+
+
+def test_raising_percentage_only_adds_devices():
+    previous = set()
+    for percentage in (0, 1, 5, 10, 25, 50, 75, 99, 100):
+        fw = firmware("2.0.0", rollout={"percentage": percentage})
+        eligible = {d for d in DEVICES if is_eligible(fw, device_bucket(d))}
+        assert previous <= eligible
+        previous = eligible
+    assert previous == set(DEVICES)
+
+
+def test_unknown_device_only_gets_full_rollout():
+    assert not is_eligible(firmware("2.0.0", rollout={"percentage": 99}), None)
+    assert is_eligible(firmware("2.0.0"), None)
+
+
+def test_schedule_steps_apply_in_order():
+    fw = firmware("2.0.0", rollout={"percentage": 5, "schedule": [
+        {"at": "2024-05-01T08:00:00", "percentage": 25},
+        {"at": "2024-05-02T08:00:00", "percentage": 100},
+    ]})
+    assert rollout_percentage(fw, "2024-04-30T23:59:59") == 5
+    assert rollout_percentage(fw, "2024-05-01T08:00:00") == 25
+    assert rollout_percentage(fw, "2024-05-01T20:00:00") == 25
+    assert rollout_percentage(fw, "2024-05-03T00:00:00") == 100
+    assert rollout_percentage(firmware("1.0.0")) == 100
+
+
+def test_target_falls_back_to_older_full_rollout():
+    index = VersionIndex([
+        firmware("1.0.0"),
+        firmware("1.1.0"),
+        firmware("2.0.0", rollout={"percentage": 30}),
+        firmware("3.0.0", "beta"),
+    ])
+    inside = device_in_bucket(0, BUCKETS * 30 // 100)
+    outside = device_in_bucket(BUCKETS * 30 // 100, BUCKETS)
+    current = parse_version("1.0.0")
+    assert rollout_target(index, current, "stable", inside)["version"] == "2.0.0"
+    assert rollout_target(index, current, "stable", outside)["version"] == "1.1.0"
+    assert rollout_target(index, current, "stable", None)["version"] == "1.1.0"
+    # Đã ở bản 100% mới nhất và chưa tới lượt bản đang rollout: không có update
+    assert rollout_target(index, parse_version("1.1.0"), "stable", outside) is None
+
+
+def test_put_rollout_endpoint(api_client, upload):
+    client, auth = api_client
+    channel = "rollout-api"
+    assert upload("10.0.0", os.urandom(64), channel=channel).status_code == 200
+    assert upload("10.1.0", os.urandom(64), channel=channel, rollout=0).status_code == 200
+    device = DEVICES[0]
+
+    def target():
+        response = client.get("/api/check-update", headers=auth, params={
+            "current_version": "10.0.0", "channel": channel, "device_id": device})
+        assert response.status_code == 200
+        return response.json().get("firmware_info", {}).get("version")
+
+    assert target() is None
+
+    response = client.put("/api/firmware/10.1.0/rollout", headers=auth,
+                          json={"percentage": 0, "schedule": [{"at": "2000-01-01T00:00:00", "percentage": 100}]})
+    assert response.status_code == 200
+    assert response.json()["rollout_percentage"] == 100
+    assert target() == "10.1.0"
+
+    response = client.put("/api/firmware/10.1.0/rollout", headers=auth, json={"percentage": 100})
+    assert response.status_code == 200
+    assert response.json()["rollout"] is None
+    assert client.put("/api/firmware/404.0.0/rollout", headers=auth, json={"percentage": 50}).status_code == 404
+    assert client.put("/api/firmware/10.1.0/rollout", headers=auth, json={"percentage": 150}).status_code == 422
+
+
+def test_batch_memo_keeps_devices_in_different_cohorts_apart(api_client, upload):
+    client, auth = api_client
+    channel = "rollout-batch"
+    assert upload("11.0.0", os.urandom(64), channel=channel).status_code == 200
+    assert upload("11.1.0", os.urandom(64), channel=channel, rollout=50).status_code == 200
+    inside = device_in_bucket(0, BUCKETS // 2)
+    outside = device_in_bucket(BUCKETS // 2, BUCKETS)
+    checks = [{"device_id": d, "current_version": "11.0.0", "channel": channel}
+              for d in (inside, outside, inside)]
+    response = client.post("/api/check-update/batch", headers=auth, json=checks)
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [r["device_id"] for r in results] == [inside, outside, inside]
+    assert [r["update_available"] for r in results] == [True, False, True]
+    assert results[0]["firmware_info"]["version"] == "11.1.0"
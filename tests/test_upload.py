@@ -0,0 +1,89 @@
+"""
+Upload firmware vào kho blob (main.upload_firmware)
+Mỗi test chạy với cả hai backend metadata (json, sqlite)
+"""
+import hashlib
+import threading
+
+
+def test_upload_stores_blob_by_checksum(metadata_backend, server, upload):
+    data = b"blob-store-test" * 100
+    response = upload("5.0.0", data)
+    assert response.status_code == 200
+    info = response.json()["firmware_info"]
+    assert info["checksum"] == hashlib.sha256(data).hexdigest()
+    assert info["channel"] == "stable"
+    assert server.blob_store.path_for(info["checksum"]).read_bytes() == data
+
+
+def test_reupload_over_legacy_entry_without_channel(metadata_backend, server, upload):
+    """Entry cũ (layout file theo tên, không có field channel) được upload đè được"""
+    legacy_file = server.FIRMWARE_DIR / "legacy_5.1.0.bin"
+    legacy_file.write_bytes(b"old firmware")
+    server.catalog.upsert({
+        "version": "5.1.0",
+        "filename": legacy_file.name,
+        "size": 12,
+        "checksum": hashlib.sha256(b"old firmware").hexdigest(),
+        "description": "legacy",
+        "release_date": "2020-01-01T00:00:00",
+    })
+
+    response = upload("5.1.0", b"new firmware")
+    assert response.status_code == 200, response.text
+    assert response.json()["firmware_info"]["channel"] == "stable"
+
+    entry = server.catalog.index().get("5.1.0")
+    assert entry["blob"] == hashlib.sha256(b"new firmware").hexdigest()
+    assert entry["description"] == "legacy"
+    # Bytes cũ không còn entry nào dùng nên bị xóa
+    assert not legacy_file.exists()
+
+
+def test_blob_kept_while_another_version_uses_it(metadata_backend, server, api_client, upload):
+    client, auth = api_client
+    data = b"shared-bytes" * 50
+    checksum = hashlib.sha256(data).hexdigest()
+    assert upload("5.2.0", data).status_code == 200
+    assert upload("5.3.0", data).status_code == 200
+    assert client.delete("/api/firmware/5.2.0", headers=auth).status_code == 200
+    assert server.blob_store.exists(checksum)
+    assert client.delete("/api/firmware/5.3.0", headers=auth).status_code == 200
+    assert not server.blob_store.exists(checksum)
+
+
+def test_delete_and_reupload_of_same_bytes_are_serialized(metadata_backend, server, api_client, upload):
+    """Upload chờ khóa ghi catalog nên không thể dùng blob mà delete đang xóa"""
+    client, auth = api_client
+    data = b"race-bytes" * 50
+    checksum = hashlib.sha256(data).hexdigest()
+    assert upload("5.4.0", data).status_code == 200
+
+    results = {}
+    with server.catalog.write_lock():
+        # Giữa lúc giữ khóa: như một worker khác đang xóa version cuối cùng dùng blob
+        removed = server.catalog.remove("5.4.0")
+        worker = threading.Thread(target=lambda: results.setdefault("upload", upload("5.5.0", data)))
+        worker.start()
+        worker.join(0.3)
+        assert worker.is_alive()
+        server.release_storage(removed)
+        assert not server.blob_store.exists(checksum)
+    worker.join(5)
+    assert results["upload"].status_code == 200
+    download = client.get("/api/download/5.5.0", headers={**auth, "Accept-Encoding": "identity"})
+    assert download.status_code == 200
+    assert download.content == data
+
+
+def test_blob_stats_count_variants_separately(tmp_path):
+    from blobs import BlobStore
+    store = BlobStore(tmp_path)
+    data = b"x" * 100
+    digest = hashlib.sha256(data).hexdigest()
+    tmp_file = tmp_path / "upload.tmp"
+    tmp_file.write_bytes(data)
+    store.put(tmp_file, digest)
+    store.path_for(digest).with_name(digest + ".gz").write_bytes(b"g" * 10)
+    store.path_for(digest).with_name(digest + ".zst").write_bytes(b"z" * 8)
+    assert store.stats() == {"blobs": 1, "bytes": 100, "variants": 2, "variant_bytes": 18}
@@ -0,0 +1,65 @@
+"""Thứ tự version trong VersionIndex (catalog.py)"""
+from catalog import VersionIndex, parse_version
+
+
+def firmware(version: str, channel: str = "stable") -> dict:
+    return {"version": version, "filename": f"{version}.bin", "checksum": version, "size": 1, "channel": channel}
+
+
+def test_parse_version_ignores_trailing_zeros():
+    assert parse_version("1.2.0") == parse_version("1.2") == (1, 2)
+    assert parse_version("0") == (0,)
+
+
+def test_latest_compares_numerically_not_as_strings():
+    index = VersionIndex([firmware("1.9.0"), firmware("1.10.0"), firmware("1.2")])
+    assert index.latest["version"] == "1.10.0"
+    assert [f["version"] for f in index.newer_than(parse_version("1.2"))] == ["1.10.0", "1.9.0"]
+
+
+def test_newest_greater_respects_channel():
+    index = VersionIndex([firmware("1.0.0"), firmware("2.0.0", "beta"), firmware("1.5.0")])
+    assert index.newest_greater(parse_version("1.0.0"))["version"] == "2.0.0"
+    assert index.newest_greater(parse_version("1.0.0"), "stable")["version"] == "1.5.0"
+    assert index.newest_greater(parse_version("1.5.0"), "stable") is None
+    assert index.newest_greater(parse_version("2.0.0")) is None
+
+
+def test_add_and_remove_keep_order():
+    index = VersionIndex([firmware("1.0.0"), firmware("3.0.0")])
+    index.add(firmware("2.0.0"))
+    assert [f["version"] for f in index.newer_than(())] == ["3.0.0", "2.0.0", "1.0.0"]
+    index.remove("3.0.0")
+    assert index.latest["version"] == "2.0.0"
+    # Thay thế cùng version không tạo entry trùng
+    index.add(firmware("2.0.0", "beta"))
+    assert len(index) == 2
+    assert index.newest("beta")["version"] == "2.0.0"
+    assert index.newest("stable")["version"] == "1.0.0"
+
+
+def test_invalid_version_is_looked_up_but_not_ordered():
+    index = VersionIndex([firmware("1.0.0"), firmware("dev-build")])
+    assert index.get("dev-build") is not None
+    assert index.key_of("dev-build") is None
+    assert index.latest["version"] == "1.0.0"
+    assert [f["version"] for f in index.newer_than(())] == ["1.0.0"]
+
+
+def test_copy_is_independent():
+    index = VersionIndex([firmware("1.0.0"), firmware("2.0.0", "beta")])
+    assert index.newest("stable")["version"] == "1.0.0"
+    clone = index.copy()
+    clone.add(firmware("3.0.0"))
+    clone.remove("1.0.0")
+    assert [f["version"] for f in index.newer_than(())] == ["2.0.0", "1.0.0"]
+    assert index.newest("stable")["version"] == "1.0.0"
+    assert [f["version"] for f in clone.newer_than(())] == ["3.0.0", "2.0.0"]
+    assert clone.newest("stable")["version"] == "3.0.0"
+
+
+def test_catalog_snapshot_not_mutated_by_upload(server, upload):
+    snapshot = server.catalog.index()
+    assert upload("7.0.0", b"snapshot test").status_code == 200
+    assert "7.0.0" not in snapshot
+    assert "7.0.0" in server.catalog.index()
@@ -0,0 +1,85 @@
+"""
+Microbenchmark chi phí xác thực mỗi request của OTA server
+So sánh require_auth với device token khi không có cache (jwt.decode mỗi lần)
+và khi có cache token đã xác minh. Dữ liệu nằm trong thư mục tạm.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "server"))
+
+# Trỏ thư mục auth (API key, token, jwt_secret, file khóa) vào thư mục tạm
+# trước khi import auth, để không ghi gì vào auth/ của repo
+TMP_DIR = Path(tempfile.mkdtemp(prefix="bench-auth-"))
+os.environ["OTA_AUTH_DIR"] = str(TMP_DIR)
+os.environ.setdefault("JWT_SECRET", "bench-auth-secret")
+
+import jwt
+from fastapi.security import HTTPAuthorizationCredentials
+
+import auth
+
+
+def make_tokens(count: int):
+    """Tạo token giống generate_device_token nhưng không ghi file"""
+    exp = datetime.utcnow() + timedelta(days=30)
+    return [
+        jwt.encode({"device_id": f"device_{i:06d}", "exp": exp, "iat": datetime.utcnow()},
+                   auth.JWT_SECRET, algorithm="HS256")
+        for i in range(count)
+    ]
+
+
+def bench(label: str, func, requests: int) -> float:
+    start = time.perf_counter()
+    for i in range(requests):
+        func(i)
+    elapsed = time.perf_counter() - start
+    per_request = elapsed / requests * 1e6
+    print(f"  {label:<34} {per_request:8.2f} µs/request  ({requests / elapsed:,.0f} req/s)")
+    return per_request
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Đo chi phí xác thực mỗi request")
+    parser.add_argument("--devices", type=int, default=50000, help="Số thiết bị (token khác nhau)")
+    parser.add_argument("--requests", type=int, default=200000, help="Số request mỗi lượt đo")
+    args = parser.parse_args()
+
+    tmp_dir = TMP_DIR
+    auth.api_key_store = auth.ApiKeyStore(tmp_dir / "api_keys.json", 3600)
+    api_key = auth.generate_api_key("bench")
+
+    print(f"Tạo {args.devices} token...")
+    tokens = make_tokens(args.devices)
+    credentials = [HTTPAuthorizationCredentials(scheme="Bearer", credentials=t) for t in tokens]
+    n = len(tokens)
+
+    def device_request(i):
+        return auth.require_auth(api_key=None, credentials=credentials[i % n])
+
+    def api_key_request(i):
+        return auth.require_auth(api_key=api_key, credentials=None)
+
+    print(f"\n{args.requests} request, {n} thiết bị:")
+    bench("API key", api_key_request, args.requests)
+
+    auth.token_cache = auth.TokenCache(0, tmp_dir / "revoked_tokens.json")
+    before = bench("Device token, không cache", device_request, args.requests)
+
+    auth.token_cache = auth.TokenCache(max(n, 1), tmp_dir / "revoked_tokens.json")
+    for i in range(n):
+        device_request(i)
+    after = bench("Device token, có cache", device_request, args.requests)
+
+    print(f"\nNhanh hơn {before / after:.1f}x")
+    print(f"Cache: {auth.token_cache.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,48 +2,80 @@
 Utility script để liệt kê firmware có sẵn trên server
 """
 import requests
+import os
 import sys
 import argparse
 from datetime import datetime
 
-def list_firmwares(server_url: str):
+def iter_firmwares(server_url: str, api_key: str = None, page_size: int = 100, **filters):
     """
-    Liệt kê tất cả firmware có sẵn
-    
+    Duyệt firmware theo từng trang (cursor), chỉ tải trang tiếp theo khi cần
+
     Args:
         server_url: URL của OTA server
+        api_key: API key (header X-API-Key)
+        page_size: Số firmware mỗi trang
+        filters: Tham số lọc của /api/firmwares (channel, min_version, since, sort, ...)
     """
-    try:
-        url = f"{server_url.rstrip('/')}/api/firmwares"
-        response = requests.get(url, timeout=10)
+    url = f"{server_url.rstrip('/')}/api/firmwares"
+    headers = {"X-API-Key": api_key} if api_key else {}
+    params = {k: v for k, v in filters.items() if v is not None}
+    params["limit"] = page_size
+    while True:
+        response = requests.get(url, params=params, headers=headers, timeout=10)
         response.raise_for_status()
-        
         data = response.json()
-        firmwares = data.get("firmwares", [])
-        
-        print(f"\nDanh sách firmware có sẵn ({len(firmwares)}):")
+        yield from data.get("firmwares", [])
+        if not data.get("next_cursor"):
+            return
+        params["cursor"] = data["next_cursor"]
+
+def print_firmware(fw: dict, server_url: str):
+    print(f"\nVersion: {fw['version']}")
+    print(f"  File: {fw['filename']}")
+    print(f"  Size: {fw['size']:,} bytes ({fw['size'] / 1024:.2f} KB)")
+    print(f"  Checksum: {fw['checksum']}")
+    if fw.get('channel'):
+        print(f"  Channel: {fw['channel']}")
+    if fw.get('description'):
+        print(f"  Mô tả: {fw['description']}")
+    if fw.get('release_date'):
+        try:
+            date = datetime.fromisoformat(fw['release_date'].replace('Z', '+00:00'))
+            print(f"  Ngày phát hành: {date.strftime('%Y-%m-%d %H:%M:%S')}")
+        except:
+            print(f"  Ngày phát hành: {fw['release_date']}")
+    print(f"  Download: {server_url}/api/download/{fw['version']}")
+
+def list_firmwares(server_url: str, api_key: str = None, page_size: int = 100,
+                   max_results: int = None, **filters):
+    """
+    Liệt kê firmware có sẵn (mới nhất trước, in dần theo từng trang)
+    
+    Args:
+        server_url: URL của OTA server
+        api_key: API key (header X-API-Key)
+        page_size: Số firmware mỗi trang
+        max_results: Dừng sau khi in chừng này firmware (None = tất cả)
+        filters: Tham số lọc của /api/firmwares
+    """
+    try:
+        print("\nDanh sách firmware có sẵn:")
         print("=" * 80)
         
-        if not firmwares:
+        count = 0
+        for fw in iter_firmwares(server_url, api_key, page_size, **filters):
+            print_firmware(fw, server_url)
+            count += 1
+            if max_results is not None and count >= max_results:
+                break
+        
+        if count == 0:
             print("Không có firmware nào")
             return
         
-        for fw in sorted(firmwares, key=lambda x: x["version"], reverse=True):
-            print(f"\nVersion: {fw['version']}")
-            print(f"  File: {fw['filename']}")
-            print(f"  Size: {fw['size']:,} bytes ({fw['size'] / 1024:.2f} KB)")
-            print(f"  Checksum: {fw['checksum']}")
-            if fw.get('description'):
-                print(f"  Mô tả: {fw['description']}")
-            if fw.get('release_date'):
-                try:
-                    date = datetime.fromisoformat(fw['release_date'].replace('Z', '+00:00'))
-                    print(f"  Ngày phát hành: {date.strftime('%Y-%m-%d %H:%M:%S')}")
-                except:
-                    print(f"  Ngày phát hành: {fw['release_date']}")
-            print(f"  Download: {server_url}/api/download/{fw['version']}")
-        
         print("\n" + "=" * 80)
+        print(f"Đã liệt kê {count} firmware")
         
     except requests.exceptions.RequestException as e:
         print(f"Lỗi khi lấy danh sách firmware: {e}")
@@ -53,10 +85,28 @@ def main():
     parser = argparse.ArgumentParser(description='Liệt kê firmware có sẵn trên OTA server')
     parser.add_argument('-s', '--server', default='http://localhost:8000',
                        help='URL của OTA server (mặc định: http://localhost:8000)')
+    parser.add_argument('-k', '--api-key', default=os.getenv('OTA_API_KEY'),
+                       help='API key (mặc định: biến môi trường OTA_API_KEY)')
+    parser.add_argument('--page-size', type=int, default=100,
+                       help='Số firmware mỗi trang (mặc định: 100)')
+    parser.add_argument('-n', '--max', type=int, default=None, dest='max_results',
+                       help='Chỉ liệt kê tối đa N firmware')
+    parser.add_argument('--channel', help='Chỉ firmware thuộc channel này')
+    parser.add_argument('--min-version', help='Version nhỏ nhất (tính cả)')
+    parser.add_argument('--max-version', help='Version lớn nhất (tính cả)')
+    parser.add_argument('--since', help='Phát hành từ ngày (ISO 8601, ví dụ 2024-01-01)')
+    parser.add_argument('--until', help='Phát hành đến ngày (ISO 8601)')
+    parser.add_argument('--oldest-first', action='store_true',
+                       help='Sắp xếp version tăng dần (mặc định mới nhất trước)')
     
     args = parser.parse_args()
-    list_firmwares(args.server)
+    list_firmwares(
+        args.server, args.api_key, args.page_size, args.max_results,
+        channel=args.channel,
+        min_version=args.min_version, max_version=args.max_version,
+        since=args.since, until=args.until,
+        sort='version' if args.oldest_first else '-version'
+    )
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,348 @@
+"""
+Giả lập cả fleet thiết bị (asyncio) để đo tải OTA server
+
+Mỗi thiết bị ảo là một coroutine: đăng ký lấy token, check-update định kỳ có
+jitter (GET có ETag như OTAClient), tải firmware đầy đủ hoặc tải tiếp bằng Range,
+rồi xác minh checksum. Kiểu dồn request:
+    steady          thiết bị rải đều trên chu kỳ polling
+    reboot-storm    cả fleet khởi động trong --storm-window giây (sau mất điện)
+    release-storm   polling đều, tới --release-at thì upload firmware mới và cả
+                    fleet check + tải trong --storm-window giây (như khi nhận push)
+
+Kết quả (throughput, p50/p95/p99 theo endpoint, tỉ lệ lỗi) in ra dạng JSON và
+ghi vào --output để so sánh giữa các lần chạy.
+
+Cần httpx: pip install httpx
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Percentile theo nearest-rank trên danh sách đã sắp xếp"""
+    if not sorted_values:
+        return 0.0
+    rank = math.ceil(fraction * len(sorted_values))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+class Recorder:
+    """Gom latency, status và lỗi theo endpoint"""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Counter] = defaultdict(Counter)
+        self.errors: Dict[str, Counter] = defaultdict(Counter)
+        self.bytes_downloaded = 0
+        self.checksum_failures = 0
+        self.updates_installed = 0
+        self.started = time.perf_counter()
+
+    def record(self, endpoint: str, status: int, seconds: float):
+        self.latencies[endpoint].append(seconds)
+        self.statuses[endpoint][status] += 1
+
+    def error(self, endpoint: str, exc: Exception):
+        self.errors[endpoint][type(exc).__name__] += 1
+
+    def report(self, settings: dict) -> dict:
+        duration = time.perf_counter() - self.started
+        endpoints = {}
+        for endpoint in sorted(set(self.latencies) | set(self.errors)):
+            values = sorted(self.latencies[endpoint])
+            statuses = self.statuses[endpoint]
+            failures = sum(n for status, n in statuses.items() if status >= 400 and status != 503)
+            rejected = statuses.get(503, 0)
+            exceptions = sum(self.errors[endpoint].values())
+            total = len(values) + exceptions
+            endpoints[endpoint] = {
+                "requests": total,
+                "throughput_rps": round(total / duration, 2) if duration else 0.0,
+                "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+                "p95_ms": round(percentile(values, 0.95) * 1000, 2),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+                "max_ms": round(values[-1] * 1000, 2) if values else 0.0,
+                "error_rate": round((failures + exceptions) / total, 4) if total else 0.0,
+                "rejected_503": rejected,
+                "statuses": {str(k): v for k, v in sorted(statuses.items())},
+                "exceptions": dict(self.errors[endpoint]),
+            }
+        return {
+            "settings": settings,
+            "duration_s": round(duration, 2),
+            "total_requests": sum(e["requests"] for e in endpoints.values()),
+            "bytes_downloaded": self.bytes_downloaded,
+            "download_mb_per_s": round(self.bytes_downloaded / duration / 1024 / 1024, 2) if duration else 0.0,
+            "updates_installed": self.updates_installed,
+            "checksum_failures": self.checksum_failures,
+            "endpoints": endpoints,
+        }
+
+
+class LoadTest:
+    """Chạy một kịch bản tải với args từ dòng lệnh"""
+
+    def __init__(self, args):
+        self.args = args
+        self.base = args.server.rstrip("/")
+        self.recorder = Recorder()
+        self.deadline = 0.0
+        self.release_event = asyncio.Event()
+        self.tokens: Dict[str, str] = {}
+
+    def admin_headers(self) -> dict:
+        return {"X-API-Key": self.args.api_key} if self.args.api_key else {}
+
+    async def timed(self, client, endpoint: str, method: str, url: str, **kwargs):
+        """Gửi request, ghi latency theo endpoint; trả về response hoặc None nếu lỗi kết nối"""
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError as e:
+            self.recorder.error(endpoint, e)
+            return None
+        self.recorder.record(endpoint, response.status_code, time.perf_counter() - started)
+        return response
+
+    async def register(self, client, device_ids: List[str]):
+        """Đăng ký thiết bị: một lần cho cả fleet (bulk) hoặc từng thiết bị"""
+        if self.args.register == "none":
+            return
+        if self.args.register == "bulk":
+            response = await self.timed(
+                client, "register_bulk", "POST", f"{self.base}/api/auth/register/bulk",
+                json=device_ids, headers=self.admin_headers(), timeout=600
+            )
+            if response is not None and response.status_code == 200:
+                for line in response.text.splitlines():
+                    item = json.loads(line)
+                    if "token" in item:
+                        self.tokens[item["device_id"]] = item["token"]
+            return
+        semaphore = asyncio.Semaphore(self.args.connections)
+
+        async def register_one(device_id):
+            async with semaphore:
+                response = await self.timed(
+                    client, "register", "POST", f"{self.base}/api/auth/register",
+                    json={"device_id": device_id}, headers=self.admin_headers()
+                )
+                if response is not None and response.status_code == 200:
+                    self.tokens[device_id] = response.json()["token"]
+
+        await asyncio.gather(*(register_one(device_id) for device_id in device_ids))
+
+    def device_headers(self, device_id: str) -> dict:
+        token = self.tokens.get(device_id)
+        if token:
+            return {"Authorization": f"Bearer {token}"}
+        return self.admin_headers()
+
+    async def download(self, client, device_id: str, firmware: dict) -> bool:
+        """Tải firmware (đầy đủ, hoặc hai nửa bằng Range/If-Range) và xác minh checksum"""
+        url = f"{self.base}{firmware['download_url']}"
+        headers = self.device_headers(device_id)
+        # Tải bản gốc để checksum so được trực tiếp
+        headers["Accept-Encoding"] = "identity"
+        sha256 = hashlib.sha256()
+        ranged = random.random() < self.args.range_fraction and firmware["size"] > 1
+        if ranged:
+            # Giả lập tải bị ngắt giữa chừng rồi tải tiếp phần còn lại
+            split = random.randint(1, firmware["size"] - 1)
+            parts = [("download_range", {"Range": f"bytes=0-{split - 1}"}),
+                     ("download_resume", {"Range": f"bytes={split}-"})]
+        else:
+            parts = [("download", {})]
+        etag = None
+        for endpoint, extra in parts:
+            if etag:
+                extra["If-Range"] = etag
+            for attempt in range(self.args.max_retries + 1):
+                started = time.perf_counter()
+                try:
+                    async with client.stream("GET", url, headers={**headers, **extra}) as response:
+                        if response.status_code == 503 and attempt < self.args.max_retries:
+                            self.recorder.record(endpoint, 503, time.perf_counter() - started)
+                            try:
+                                retry_after = float(response.headers.get("retry-after", "1"))
+                            except ValueError:
+                                retry_after = 1.0
+                            await asyncio.sleep(retry_after * random.uniform(1.0, 1.5))
+                            continue
+                        if response.status_code not in (200, 206):
+                            self.recorder.record(endpoint, response.status_code, time.perf_counter() - started)
+                            return False
+                        if response.status_code == 200 and endpoint == "download_resume":
+                            # If-Range không khớp (firmware đã đổi): server gửi lại toàn bộ
+                            sha256 = hashlib.sha256()
+                        etag = response.headers.get("etag")
+                        async for chunk in response.aiter_bytes(64 * 1024):
+                            sha256.update(chunk)
+                            self.recorder.bytes_downloaded += len(chunk)
+                        self.recorder.record(endpoint, response.status_code, time.perf_counter() - started)
+                        break
+                except httpx.HTTPError as e:
+                    self.recorder.error(endpoint, e)
+                    return False
+            else:
+                return False
+        if self.args.verify and sha256.hexdigest() != firmware["checksum"]:
+            self.recorder.checksum_failures += 1
+            return False
+        return True
+
+    async def check(self, client, device: dict):
+        """Một lần check-update (GET có ETag), tải về nếu có bản mới"""
+        headers = self.device_headers(device["id"])
+        if device.get("etag"):
+            headers["If-None-Match"] = device["etag"]
+        params = {"current_version": device["version"], "device_id": device["id"]}
+        response = await self.timed(client, "check_update", "GET", f"{self.base}/api/check-update",
+                                    params=params, headers=headers)
+        if response is None or response.status_code not in (200, 304):
+            return
+        # Header có cả ở 304 (không có body), để thiết bị không giữ gợi ý cũ
+        hint = response.headers.get("x-next-check-after")
+        if hint:
+            device["hint"] = int(hint)
+        if response.status_code == 304:
+            return
+        device["etag"] = response.headers.get("etag")
+        data = response.json()
+        device["hint"] = data.get("next_check_after", device.get("hint"))
+        if not data.get("update_available") or random.random() >= self.args.download_fraction:
+            return
+        firmware = data["firmware_info"]
+        if await self.download(client, device["id"], firmware):
+            device["version"] = firmware["version"]
+            device["etag"] = None
+            self.recorder.updates_installed += 1
+
+    def next_delay(self, device: dict) -> float:
+        if self.args.follow_hints and device.get("hint"):
+            return float(device["hint"])
+        return self.args.poll_interval * random.uniform(0.9, 1.1)
+
+    async def run_device(self, client, device: dict):
+        """Vòng đời một thiết bị ảo cho tới hết --duration"""
+        loop = asyncio.get_running_loop()
+        if self.args.pattern == "reboot-storm":
+            first = random.uniform(0, self.args.storm_window)
+        else:
+            first = random.uniform(0, self.args.poll_interval)
+        next_at = loop.time() + first
+        while True:
+            wait = next_at - loop.time()
+            if self.args.pattern == "release-storm" and not self.release_event.is_set():
+                # Chờ tới lượt polling hoặc tới lúc phát hành (lượt nào đến trước)
+                try:
+                    await asyncio.wait_for(self.release_event.wait(), max(wait, 0))
+                    wait = random.uniform(0, self.args.storm_window)
+                    next_at = loop.time() + wait
+                except asyncio.TimeoutError:
+                    wait = 0
+            if loop.time() + max(wait, 0) >= self.deadline:
+                return
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await self.check(client, device)
+            next_at = loop.time() + self.next_delay(device)
+
+    async def release(self, client):
+        """release-storm: upload firmware mới tại --release-at rồi báo cho cả fleet"""
+        await asyncio.sleep(self.args.release_at)
+        image = os.urandom(self.args.release_size * 1024)
+        response = await self.timed(
+            client, "upload", "POST", f"{self.base}/api/upload",
+            params={"version": self.args.release_version},
+            files={"file": (f"firmware_{self.args.release_version}.bin", image)},
+            headers=self.admin_headers(), timeout=600
+        )
+        if response is None or response.status_code != 200:
+            print(f"Upload firmware {self.args.release_version} thất bại", file=sys.stderr)
+        self.release_event.set()
+
+    async def run(self) -> dict:
+        args = self.args
+        limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+        timeout = httpx.Timeout(args.timeout)
+        async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+            device_ids = [f"{args.prefix}{i:06d}" for i in range(args.devices)]
+            await self.register(client, device_ids)
+            devices = [{"id": device_id, "version": args.current_version} for device_id in device_ids]
+            self.deadline = asyncio.get_running_loop().time() + args.duration
+            tasks = [self.run_device(client, device) for device in devices]
+            if args.pattern == "release-storm":
+                tasks.append(self.release(client))
+            await asyncio.gather(*tasks)
+        settings = {k: v for k, v in vars(args).items() if k != "api_key"}
+        return self.recorder.report(settings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Giả lập fleet thiết bị để đo tải OTA server")
+    parser.add_argument("-s", "--server", default="http://localhost:8000", help="URL của OTA server")
+    parser.add_argument("-k", "--api-key", default=os.getenv("OTA_API_KEY"),
+                        help="API key (đăng ký device, upload khi release-storm)")
+    parser.add_argument("-n", "--devices", type=int, default=1000, help="Số thiết bị ảo (mặc định 1000)")
+    parser.add_argument("-d", "--duration", type=float, default=60, help="Thời gian chạy (giây, mặc định 60)")
+    parser.add_argument("--pattern", choices=["steady", "reboot-storm", "release-storm"], default="steady",
+                        help="Kiểu dồn request (mặc định steady)")
+    parser.add_argument("--poll-interval", type=float, default=30,
+                        help="Chu kỳ check-update của mỗi thiết bị (giây, jitter ±10%%)")
+    parser.add_argument("--follow-hints", action="store_true",
+                        help="Chờ theo next_check_after của server thay vì --poll-interval")
+    parser.add_argument("--storm-window", type=float, default=5,
+                        help="Khoảng thời gian cả fleet dồn request trong storm (giây)")
+    parser.add_argument("--release-at", type=float, default=10, help="release-storm: giây thứ mấy thì upload")
+    parser.add_argument("--release-version", default="99.0.0", help="release-storm: version firmware mới")
+    parser.add_argument("--release-size", type=int, default=512, help="release-storm: kích thước firmware (KB)")
+    parser.add_argument("--current-version", default="1.0.0", help="Version ban đầu của thiết bị")
+    parser.add_argument("--download-fraction", type=float, default=1.0,
+                        help="Tỉ lệ thiết bị tải khi có bản mới (mặc định 1.0)")
+    parser.add_argument("--range-fraction", type=float, default=0.2,
+                        help="Tỉ lệ lượt tải bị ngắt rồi tải tiếp bằng Range (mặc định 0.2)")
+    parser.add_argument("--no-verify", dest="verify", action="store_false", help="Không kiểm tra checksum")
+    parser.add_argument("--register", choices=["bulk", "each", "none"], default="bulk",
+                        help="Đăng ký device: bulk (một request), each (từng device), none (dùng API key)")
+    parser.add_argument("--connections", type=int, default=500, help="Số kết nối HTTP tối đa")
+    parser.add_argument("--timeout", type=float, default=30, help="Timeout mỗi request (giây)")
+    parser.add_argument("--max-retries", type=int, default=3, help="Số lần thử lại download khi gặp 503")
+    parser.add_argument("--prefix", default="load_", help="Tiền tố device_id")
+    parser.add_argument("--seed", type=int, default=None, help="Seed ngẫu nhiên để lặp lại kịch bản")
+    parser.add_argument("-o", "--output", default=None, help="Ghi báo cáo JSON vào file")
+    args = parser.parse_args()
+
+    if httpx is None:
+        print("Cần cài httpx: pip install httpx", file=sys.stderr)
+        sys.exit(1)
+    if args.register != "none" and not args.api_key:
+        print("Cần --api-key để đăng ký device (hoặc dùng --register none)", file=sys.stderr)
+        sys.exit(1)
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    report = asyncio.run(LoadTest(args).run())
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
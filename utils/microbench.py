@@ -0,0 +1,472 @@
+"""
+Microbenchmark các hot path của OTA server và client
+
+Đo ops/giây và cấp phát bộ nhớ (tracemalloc) của:
+    compare_versions, load_metadata, calculate_checksum (server/main.py)
+    verify_api_key, verify_device_token (server/auth.py)
+    OTAClient.verify_checksum (client/ota_client.py)
+với catalog giả (10 đến 100k firmware), kho API key và ảnh firmware 256 KB đến 16 MB.
+Mọi dữ liệu nằm trong thư mục tạm, không cần mạng.
+
+    python utils/microbench.py --save baseline.json
+    python utils/microbench.py --compare baseline.json
+
+Nhóm serialization so sánh đường serialize mặc định của FastAPI (jsonable_encoder +
+json) với FastJSONResponse và body serialize sẵn, kèm tỉ trọng serialize trong thời
+gian một request check-update.
+
+Kết quả (--save) là JSON để so sánh với các lần tối ưu sau (--compare).
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import secrets
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT / "server"))
+# client/ có config.py riêng nên đặt sau server/
+sys.path.append(str(ROOT / "client"))
+
+# Mọi thư mục server tạo khi import (firmware/, blobs, patches, auth/, profiles/)
+# trỏ vào thư mục tạm, không ghi gì vào repo
+TMP_ROOT = tempfile.TemporaryDirectory(prefix="ota-microbench-")
+os.environ["OTA_FIRMWARE_DIR"] = os.path.join(TMP_ROOT.name, "firmware")
+os.environ["OTA_AUTH_DIR"] = os.path.join(TMP_ROOT.name, "auth")
+os.environ["PROFILE_DIR"] = os.path.join(TMP_ROOT.name, "profiles")
+os.environ.setdefault("JWT_SECRET", "microbench-secret")
+
+import jwt
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+import auth
+import main
+from catalog import FirmwareCatalog, firmware_page, parse_version
+from fastjson import FastJSONResponse, with_field
+from metadata_store import JsonMetadataStore
+from ota_client import OTAClient
+
+Case = Tuple[str, Callable[[], object]]
+
+# Các nhóm benchmark: tên -> hàm setup(args, tmp_dir) trả về danh sách (tên case, hàm đo)
+BENCHMARKS: Dict[str, Callable[[argparse.Namespace, Path], List[Case]]] = {}
+# Tóm tắt in sau khi chạy xong: hàm(results) -> các dòng cần in
+SUMMARIES: List[Callable[[Dict[str, dict]], List[str]]] = []
+
+
+def benchmark(group: str):
+    """Đăng ký một nhóm benchmark"""
+    def register(setup):
+        BENCHMARKS[group] = setup
+        return setup
+    return register
+
+
+def summary(func):
+    """Đăng ký một hàm tóm tắt kết quả"""
+    SUMMARIES.append(func)
+    return func
+
+
+def parse_size(text: str) -> int:
+    """"256K", "4M", "1024" -> bytes"""
+    text = text.strip().upper()
+    units = {"K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def format_size(size: int) -> str:
+    if size >= 1024 * 1024 and size % (1024 * 1024) == 0:
+        return f"{size // (1024 * 1024)}MB"
+    if size >= 1024 and size % 1024 == 0:
+        return f"{size // 1024}KB"
+    return f"{size}B"
+
+
+def synthetic_firmwares(count: int) -> List[dict]:
+    """count entry firmware giống entry do /api/upload tạo"""
+    now = datetime.now()
+    firmwares = []
+    for i in range(count):
+        version = f"{i // 10000}.{(i // 100) % 100}.{i % 100}"
+        checksum = secrets.token_hex(32)
+        firmwares.append({
+            "version": version,
+            "filename": f"firmware_{version}.bin",
+            "blob": checksum,
+            "size": 1024 * 1024 + i,
+            "checksum": checksum,
+            "description": f"Bản build tự động {i}",
+            "channel": "stable" if i % 10 else "beta",
+            "release_date": (now - timedelta(minutes=count - i)).isoformat(),
+        })
+    return firmwares
+
+
+@benchmark("versions")
+def bench_versions(args, tmp_dir: Path) -> List[Case]:
+    versions = [f"{i % 7}.{i % 13}.{i % 31}" for i in range(1000)]
+    pairs = itertools.cycle(list(zip(versions, reversed(versions))))
+    names = itertools.cycle(versions)
+    return [
+        ("compare_versions", lambda: main.compare_versions(*next(pairs))),
+        ("parse_version", lambda: parse_version(next(names))),
+    ]
+
+
+@benchmark("metadata")
+def bench_metadata(args, tmp_dir: Path) -> List[Case]:
+    cases = []
+    for count in args.catalog_sizes:
+        metadata_file = tmp_dir / f"metadata_{count}" / "metadata.json"
+        metadata_file.parent.mkdir()
+        JsonMetadataStore(metadata_file).save({"firmwares": synthetic_firmwares(count)})
+        catalog = FirmwareCatalog(JsonMetadataStore(metadata_file))
+
+        def cached(catalog=catalog):
+            main.catalog = catalog
+            return main.load_metadata()
+
+        def reload(catalog=catalog):
+            main.catalog = catalog
+            catalog.invalidate()
+            return main.load_metadata()
+
+        cases.append((f"load_metadata[cached,n={count}]", cached))
+        cases.append((f"load_metadata[reload,n={count}]", reload))
+    return cases
+
+
+@benchmark("checksum")
+def bench_checksum(args, tmp_dir: Path) -> List[Case]:
+    # OTAClient tạo thư mục downloads/ trong thư mục hiện tại
+    os.chdir(tmp_dir)
+    client = OTAClient("http://localhost:8000")
+    cases = []
+    for size in args.image_sizes:
+        path = tmp_dir / f"image_{size}.bin"
+        with open(path, "wb") as f:
+            remaining = size
+            while remaining > 0:
+                chunk = os.urandom(min(remaining, 1024 * 1024))
+                f.write(chunk)
+                remaining -= len(chunk)
+        expected = main.calculate_checksum(path)
+        label = format_size(size)
+        cases.append((f"calculate_checksum[{label}]", lambda path=path: main.calculate_checksum(path)))
+        cases.append((f"OTAClient.verify_checksum[{label}]",
+                      lambda path=path, expected=expected: client.verify_checksum(path, expected)))
+    return cases
+
+
+@benchmark("auth")
+def bench_auth(args, tmp_dir: Path) -> List[Case]:
+    cases = []
+    for count in args.key_counts:
+        keys_file = tmp_dir / f"api_keys_{count}.json"
+        keys = {
+            secrets.token_urlsafe(32): {"name": f"key_{i}", "created_at": datetime.now().isoformat(), "last_used": None}
+            for i in range(count)
+        }
+        keys_file.write_text(json.dumps(keys))
+        store = auth.ApiKeyStore(keys_file, 3600)
+        valid = itertools.cycle(list(keys))
+        invalid = secrets.token_urlsafe(32)
+
+        def hit(store=store, valid=valid):
+            auth.api_key_store = store
+            return auth.verify_api_key(next(valid))
+
+        def miss(store=store):
+            auth.api_key_store = store
+            return auth.verify_api_key(invalid)
+
+        cases.append((f"verify_api_key[hit,keys={count}]", hit))
+        cases.append((f"verify_api_key[miss,keys={count}]", miss))
+
+    exp = datetime.utcnow() + timedelta(days=30)
+    tokens = [
+        jwt.encode({"device_id": f"device_{i:06d}", "exp": exp, "iat": datetime.utcnow(), "jti": secrets.token_hex(8)},
+                   auth.JWT_SECRET, algorithm="HS256")
+        for i in range(args.tokens)
+    ]
+    revoked_file = tmp_dir / "revoked_tokens.json"
+    uncached_cache = auth.TokenCache(0, revoked_file)
+    warm_cache = auth.TokenCache(len(tokens), revoked_file)
+    for token in tokens:
+        auth.token_cache = warm_cache
+        auth.verify_device_token(token)
+    uncached_tokens = itertools.cycle(tokens)
+    cached_tokens = itertools.cycle(tokens)
+
+    def uncached():
+        auth.token_cache = uncached_cache
+        return auth.verify_device_token(next(uncached_tokens))
+
+    def cached():
+        auth.token_cache = warm_cache
+        return auth.verify_device_token(next(cached_tokens))
+
+    cases.append((f"verify_device_token[uncached,tokens={args.tokens}]", uncached))
+    cases.append((f"verify_device_token[cached,tokens={args.tokens}]", cached))
+    return cases
+
+
+def asgi_request(app, method: str, path: str, headers: dict, body: bytes = b"") -> Callable[[], int]:
+    """Hàm gửi một request thẳng vào ứng dụng ASGI (không qua socket), trả về status"""
+    loop = asyncio.new_event_loop()
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": method, "scheme": "http", "path": path, "raw_path": path.encode(),
+        "query_string": b"", "root_path": "", "client": ("127.0.0.1", 50000), "server": ("testserver", 80),
+        "headers": [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+    }
+
+    async def call():
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+        status = []
+
+        async def receive():
+            return messages.pop() if messages else {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                status.append(message["status"])
+
+        await app(dict(scope), receive, send)
+        return status[0]
+
+    return lambda: loop.run_until_complete(call())
+
+
+@benchmark("serialization")
+def bench_serialization(args, tmp_dir: Path) -> List[Case]:
+    metadata_file = tmp_dir / "metadata.json"
+    JsonMetadataStore(metadata_file).save({"firmwares": synthetic_firmwares(1000)})
+    catalog = FirmwareCatalog(JsonMetadataStore(metadata_file))
+    main.catalog = catalog
+    main.response_cache.clear()
+    index = catalog.index()
+    latest = index.newest("stable")["version"]
+    no_update = main.update_check_result(index, latest, "stable")
+    no_update["next_check_after"] = 1800
+    # Version không có trong catalog nên không tạo patch
+    update = main.update_check_result(index, "0.0.0.1", "stable")
+    update["next_check_after"] = 1800
+    page, _ = firmware_page(index, 100)
+    page_result = {"firmwares": page, "count": len(page), "next_cursor": None}
+
+    def default(content):
+        # Đường mặc định khi endpoint trả về dict: jsonable_encoder rồi JSONResponse (json)
+        return JSONResponse(jsonable_encoder(content)).body
+
+    # Body "không có update" đã có trong cache: check_update_body chỉ còn tra cache
+    # (trước cả parse version/rollout), rồi ghép next_check_after
+    main.check_update_body(index, latest, "stable", None)
+
+    def cached():
+        body, _ = main.check_update_body(index, latest, "stable", None)
+        return FastJSONResponse(with_field(body, "next_check_after", 1800)).body
+
+    def uncached():
+        # Cùng kết quả nhưng tính lại mỗi lần rồi serialize bằng orjson
+        result = main.update_check_result(index, latest, "stable")
+        result["next_check_after"] = 1800
+        return FastJSONResponse(result).body
+
+    keys_file = tmp_dir / "api_keys.json"
+    api_key = secrets.token_urlsafe(32)
+    keys_file.write_text(json.dumps({api_key: {"name": "bench", "created_at": datetime.now().isoformat(), "last_used": None}}))
+    store = auth.ApiKeyStore(keys_file, 3600)
+    request = asgi_request(
+        main.app, "POST", "/api/check-update",
+        {"X-API-Key": api_key, "Content-Type": "application/json"},
+        json.dumps({"current_version": latest, "device_id": "device_000001"}).encode()
+    )
+
+    def check_update_request():
+        main.catalog = catalog
+        auth.api_key_store = store
+        return request()
+
+    return [
+        ("serialize[default,no-update]", lambda: default(no_update)),
+        ("serialize[fast,no-update]", lambda: FastJSONResponse(no_update).body),
+        ("serialize[cached,no-update]", cached),
+        ("check_update_body[uncached+fast,no-update]", uncached),
+        ("serialize[default,update]", lambda: default(update)),
+        ("serialize[fast,update]", lambda: FastJSONResponse(update).body),
+        ("serialize[default,page=100]", lambda: default(page_result)),
+        ("serialize[fast,page=100]", lambda: FastJSONResponse(page_result).body),
+        ("request[POST /api/check-update,no-update]", check_update_request),
+    ]
+
+
+@summary
+def serialization_share(results: Dict[str, dict]) -> List[str]:
+    """Tỉ trọng serialize trong một request check-update, trước (đường mặc định) và sau"""
+    names = ("serialize[default,no-update]", "serialize[cached,no-update]", "request[POST /api/check-update,no-update]")
+    if not all(name in results for name in names):
+        return []
+    default, cached, request = (results[name]["us_per_op"] for name in names)
+    # Request đo trên code hiện tại (body serialize sẵn); "trước" = thay phần serialize bằng đường mặc định
+    before = request - cached + default
+    return [
+        "Tỉ trọng serialize trong POST /api/check-update (không có update):",
+        f"  trước: {default:.1f} / {before:.1f} µs = {default / before:.1%}",
+        f"  sau:   {cached:.1f} / {request:.1f} µs = {cached / request:.1%}",
+    ]
+
+
+def measure(func: Callable[[], object], min_time: float, repeat: int) -> dict:
+    """Đo thời gian (lấy lượt nhanh nhất) rồi đo cấp phát trong một lượt riêng"""
+    func()
+    # Tăng số lần gọi tới khi một lượt đủ dài để đo chính xác
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / repeat or number >= 1 << 24:
+            break
+        number *= 2 if elapsed <= 0 else max(2, min(10, int(min_time / repeat / elapsed) + 1))
+    best = elapsed
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, time.perf_counter() - start)
+    per_op = best / number
+
+    # tracemalloc làm chậm code nên đo riêng, với ít lần gọi hơn
+    alloc_runs = max(1, min(number, 100))
+    tracemalloc.start()
+    try:
+        base_current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        for _ in range(alloc_runs):
+            func()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "ops_per_sec": round(1 / per_op, 2) if per_op > 0 else float("inf"),
+        "us_per_op": round(per_op * 1e6, 3),
+        "alloc_peak_kb": round((peak - base_current) / 1024, 2),
+        "alloc_retained_bytes_per_op": round((current - base_current) / alloc_runs, 1),
+        "iterations": number,
+    }
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], threshold: float) -> List[str]:
+    """In so sánh với baseline, trả về tên các case chậm hơn quá threshold"""
+    regressions = []
+    print(f"\n{'Benchmark':<48} {'ops/s':>14} {'baseline':>14} {'thay đổi':>10}")
+    for name, result in results.items():
+        old = baseline.get(name)
+        if not old:
+            print(f"{name:<48} {result['ops_per_sec']:>14,.1f} {'-':>14} {'mới':>10}")
+            continue
+        change = result["ops_per_sec"] / old["ops_per_sec"] - 1
+        flag = ""
+        if change < -threshold:
+            flag = "  CHẬM HƠN"
+            regressions.append(name)
+        print(f"{name:<48} {result['ops_per_sec']:>14,.1f} {old['ops_per_sec']:>14,.1f} {change:>+9.1%}{flag}")
+    return regressions
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Microbenchmark hot path của OTA server/client")
+    parser.add_argument("--catalog-sizes", default="10,1000,100000",
+                        help="Số firmware trong catalog giả (mặc định 10,1000,100000)")
+    parser.add_argument("--image-sizes", default="256K,1M,4M,16M",
+                        help="Kích thước ảnh firmware (mặc định 256K,1M,4M,16M)")
+    parser.add_argument("--key-counts", default="10,1000,100000",
+                        help="Số API key trong kho (mặc định 10,1000,100000)")
+    parser.add_argument("--tokens", type=int, default=10000, help="Số device token khác nhau (mặc định 10000)")
+    parser.add_argument("--quick", action="store_true", help="Kích thước nhỏ, chạy nhanh (kiểm tra nhanh)")
+    parser.add_argument("--group", action="append", choices=sorted(BENCHMARKS),
+                        help="Chỉ chạy nhóm này (lặp lại được)")
+    parser.add_argument("--filter", default=None, help="Chỉ chạy case có tên chứa chuỗi này")
+    parser.add_argument("--min-time", type=float, default=0.3, help="Thời gian đo tối thiểu mỗi case (giây)")
+    parser.add_argument("--repeat", type=int, default=3, help="Số lượt đo, lấy lượt nhanh nhất")
+    parser.add_argument("--save", default=None, help="Ghi kết quả ra file JSON (baseline)")
+    parser.add_argument("--compare", default=None, help="So sánh với file baseline JSON")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="Chậm hơn baseline quá tỉ lệ này thì báo (mặc định 0.10)")
+    parser.add_argument("--fail-on-regression", action="store_true",
+                        help="Thoát với mã 1 nếu có case chậm hơn baseline")
+    args = parser.parse_args()
+
+    if args.quick:
+        args.catalog_sizes, args.image_sizes, args.key_counts = "10,1000", "256K,1M", "10,1000"
+        args.tokens = min(args.tokens, 1000)
+        args.min_time = min(args.min_time, 0.1)
+    args.catalog_sizes = [int(x) for x in args.catalog_sizes.split(",") if x]
+    args.image_sizes = [parse_size(x) for x in args.image_sizes.split(",") if x]
+    args.key_counts = [int(x) for x in args.key_counts.split(",") if x]
+
+    cwd = os.getcwd()
+    original_catalog, original_store, original_cache = main.catalog, auth.api_key_store, auth.token_cache
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="run-", dir=TMP_ROOT.name) as tmp:
+        tmp_dir = Path(tmp)
+        try:
+            for group in args.group or BENCHMARKS:
+                group_dir = tmp_dir / group
+                group_dir.mkdir()
+                print(f"[{group}] chuẩn bị dữ liệu...")
+                for name, func in BENCHMARKS[group](args, group_dir):
+                    if args.filter and args.filter not in name:
+                        continue
+                    result = measure(func, args.min_time, args.repeat)
+                    results[name] = result
+                    print(f"  {name:<46} {result['ops_per_sec']:>14,.1f} ops/s "
+                          f"{result['us_per_op']:>12,.2f} µs/op  peak {result['alloc_peak_kb']:>10,.1f} KB")
+        finally:
+            os.chdir(cwd)
+            main.catalog, auth.api_key_store, auth.token_cache = original_catalog, original_store, original_cache
+            main.response_cache.clear()
+
+    report = {
+        "created_at": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+    for summarize in SUMMARIES:
+        lines = summarize(results)
+        if lines:
+            print()
+            print("\n".join(lines))
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"\nĐã lưu kết quả vào {args.save}")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} case chậm hơn baseline quá {args.threshold:.0%}")
+            if args.fail_on_regression:
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()